@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class AssessmentConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "assessment"
+
+    def ready(self):
+        # Đăng ký signals invalidate cache (item bank, ...)
+        from assessment import signals  # noqa: F401
+        # System check: cảnh báo cache không dùng chung giữa các worker
+        from assessment import checks  # noqa: F401
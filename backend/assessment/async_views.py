@@ -0,0 +1,182 @@
+# assessment/async_views.py
+"""
+Bản async của 2 endpoint CAT (start / answer) cho deploy ASGI
+(vd: uvicorn my_app.asgi:application).
+
+DRF chưa hỗ trợ view async nên đây là view Django thuần: I/O (async ORM, cache)
+được await để không chặn event loop (Django vẫn chạy chúng lần lượt trên 1 thread
+qua sync_to_async); phần tính toán (luật, chọn câu) và transaction ghi bước chạy
+qua sync_to_async, dùng chung logic với CATViewSet (services/cat_steps.py).
+
+Xác thực / phân quyền giống CATViewSet: chạy DEFAULT_AUTHENTICATION_CLASSES
+(JWT) và DEFAULT_PERMISSION_CLASSES của REST_FRAMEWORK (_check_access); lỗi trả
+JSON {"detail": ...} như DRF.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import Http404, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from assessment.models import TestSession
+from assessment.serializers import AnswerCatSerializer, StartCatSerializer
+from assessment.services.cat_steps import (
+    aload_answer_inputs, answer_retries, commit_answer_step, commit_first_item,
+    compute_answer_step, pick_first_item,
+)
+from assessment.services.idempotency import (
+    IN_FLIGHT, MISMATCH, REPLAY, abegin_step, afinish_step, step_key,
+)
+from assessment.services.session_state import abuild_state
+
+
+def _check_access(request):
+    """
+    Như APIView.initial của CATViewSet: token sai / hết hạn -> 401, không qua
+    permission -> 401/403. Trả về JsonResponse lỗi hoặc None nếu được phép.
+    """
+    drf_request = Request(
+        request, authenticators=[cls() for cls in api_settings.DEFAULT_AUTHENTICATION_CLASSES],
+    )
+    try:
+        drf_request.user  # chạy authenticator (query User nếu có token)
+        for permission in (cls() for cls in api_settings.DEFAULT_PERMISSION_CLASSES):
+            if not permission.has_permission(drf_request, None):
+                if drf_request.authenticators and not drf_request.successful_authenticator:
+                    raise exceptions.NotAuthenticated()
+                raise exceptions.PermissionDenied(getattr(permission, "message", None))
+    except exceptions.APIException as exc:
+        detail = exc.detail if isinstance(exc.detail, dict) else {"detail": exc.detail}
+        response = JsonResponse(detail, status=exc.status_code)
+        if isinstance(exc, (exceptions.AuthenticationFailed, exceptions.NotAuthenticated)):
+            # Như APIView.handle_exception: 401 kèm WWW-Authenticate, không có header -> 403
+            header = drf_request.authenticators[0].authenticate_header(drf_request) \
+                if drf_request.authenticators else None
+            if header:
+                response["WWW-Authenticate"] = header
+            else:
+                response.status_code = 403
+        return response
+    return None
+
+
+def _json_body(request):
+    try:
+        return json.loads(request.body or b"{}")
+    except ValueError:
+        return None
+
+
+@csrf_exempt
+@require_POST
+async def cat_start(request):
+    """POST /api/cat/async/start/ — cùng input / output với /api/cat/start/."""
+    denied = await sync_to_async(_check_access)(request)
+    if denied is not None:
+        return denied
+    body = _json_body(request)
+    if body is None:
+        return JsonResponse({"detail": "JSON không hợp lệ."}, status=400)
+    # validate có query Topic (kiểm tra topic thuộc môn) + Subject (gộp luật dừng)
+    ser = StartCatSerializer(data=body)
+    if not await sync_to_async(ser.is_valid)():
+        return JsonResponse(ser.errors, status=400)
+    data = ser.validated_data
+
+    session = await TestSession.objects.acreate(
+        student_id=data["student_id"],
+        subject_id=data["subject_id"],
+        topic_id=data.get("topic_id"),
+        target_items=data["target_items"],
+        mode="CAT",
+        status="ONGOING",
+        stopping_policy=data["stopping_policy"],  # đã gộp với của môn + kiểm tra
+    )
+    # Profile năng lực + mastery
+    state = await abuild_state(session, used_ids=[])
+
+    next_qid, next_q_data = await sync_to_async(pick_first_item)(session, state)
+    if next_qid is None:
+        # Không có transaction bao ngoài như bản sync -> tự xoá phiên rỗng
+        await session.adelete()
+        return JsonResponse({"error": "Không tìm thấy câu hỏi nào cho môn học này."}, status=404)
+    await sync_to_async(commit_first_item)(session, state, next_qid)
+
+    return JsonResponse(
+        {
+            "session_id": str(session.id),
+            "ability_vector": state.abilities,
+            "next_question": next_q_data,
+            "stop": False,
+            "current_position": 1,
+            "target_items": session.target_items,
+        },
+        status=201,
+    )
+
+
+@csrf_exempt
+@require_POST
+async def cat_answer(request):
+    """POST /api/cat/async/answer/ — cùng input / output / 409 với /api/cat/answer/."""
+    denied = await sync_to_async(_check_access)(request)
+    if denied is not None:
+        return denied
+    body = _json_body(request)
+    if body is None:
+        return JsonResponse({"detail": "JSON không hợp lệ."}, status=400)
+    ser = AnswerCatSerializer(data=body)
+    if not ser.is_valid():
+        return JsonResponse(ser.errors, status=400)
+    d = ser.validated_data
+
+    # Chống request trùng như CATViewSet.post_answer (services/idempotency.py)
+    request_id = request.headers.get("Idempotency-Key") or d.get("request_id")
+    key = step_key(d["session_id"], request_id, d["question_id"])
+    fingerprint = (d["question_id"], d["option_id"])
+    outcome, stored = await abegin_step(key, fingerprint)
+    if outcome == REPLAY:
+        return JsonResponse(stored, headers={"Idempotent-Replayed": "true"})
+    if outcome == IN_FLIGHT:
+        return JsonResponse({"error": "Yêu cầu này đang được xử lý, vui lòng chờ kết quả."}, status=409)
+    if outcome == MISMATCH:
+        return JsonResponse({"error": "Khoá idempotency đã được dùng cho một đáp án khác."}, status=409)
+
+    response = payload = None
+    try:
+        response, payload = await _answer(d)
+    finally:
+        ok = response is not None and response.status_code == 200
+        await afinish_step(key, fingerprint, payload if ok else None)
+    return response
+
+
+async def _answer(d):
+    """(JsonResponse, payload của bước thành công hoặc None)."""
+    for attempt in range(answer_retries() + 1):
+        session = await TestSession.objects.filter(id=d["session_id"], status="ONGOING").afirst()
+        if session is None:
+            if attempt == 0:
+                return JsonResponse({"detail": "Không tìm thấy phiên đang làm."}, status=404), None
+            return JsonResponse({"error": "Phiên đã kết thúc bởi một yêu cầu khác."}, status=409), None
+
+        # Đáp án, profile năng lực, trạng thái phiên
+        state, opt, profiles = await aload_answer_inputs(session, d)
+        try:
+            step = await sync_to_async(compute_answer_step)(session, d, state, opt, profiles)
+        except Http404 as e:
+            # Đáp án không thuộc câu: cùng dạng lỗi 404 của DRF
+            return JsonResponse({"detail": str(e)}, status=404), None
+        if step is None:
+            return JsonResponse(
+                {"error": "Câu hỏi này không phải câu đang chờ trả lời (đã trả lời hoặc chưa được phát)."},
+                status=409,
+            ), None
+        if await sync_to_async(commit_answer_step)(session, step):
+            return JsonResponse(step["payload"]), step["payload"]
+
+    return JsonResponse({"error": "Phiên đang được cập nhật đồng thời, vui lòng thử lại."}, status=409), None
@@ -0,0 +1,19 @@
+# assessment/checks.py
+from django.conf import settings
+from django.core.checks import Warning, register
+
+
+@register()
+def shared_cache_check(app_configs, **kwargs):
+    """Production mà cache mặc định là LocMem -> version counter / idempotency không dùng chung giữa worker."""
+    backend = settings.CACHES.get("default", {}).get("BACKEND", "")
+    if settings.DEBUG or not backend.endswith("LocMemCache"):
+        return []
+    return [
+        Warning(
+            "Cache mặc định là LocMemCache: invalidate (item bank, luật, câu hỏi), "
+            "chống request trùng và exposure chỉ có hiệu lực trong từng process.",
+            hint="Đặt REDIS_URL (hoặc cấu hình CACHES dùng chung) khi chạy nhiều worker.",
+            id="assessment.W001",
+        )
+    ]
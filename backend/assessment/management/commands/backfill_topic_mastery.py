@@ -0,0 +1,63 @@
+# assessment/management/commands/backfill_topic_mastery.py
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from assessment.models import QuestionTag, TestResponse, TopicMastery
+from assessment.services.mastery import decayed, mastery_decay
+
+
+class Command(BaseCommand):
+    help = "Dựng lại TopicMastery (bộ đếm suy giảm theo học sinh + topic) từ toàn bộ TestResponse."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--student-id", type=int, action="append", help="Chỉ backfill học sinh này (lặp lại được). Mặc định: tất cả")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Số bản ghi mỗi lần bulk_create")
+
+    def handle(self, *args, **opts):
+        decay = mastery_decay()
+
+        # question_id -> [topic_id] (1 query)
+        question_topics = defaultdict(list)
+        for qid, tid in QuestionTag.objects.values_list("question_id", "topic_id").distinct():
+            question_topics[qid].append(tid)
+
+        responses = TestResponse.objects.order_by("session__student_id", "answered_at", "id")
+        if opts["student_id"]:
+            responses = responses.filter(session__student_id__in=opts["student_id"])
+
+        # (student, topic) -> [correct, total, n]; phát lại theo thứ tự thời gian
+        counters = defaultdict(lambda: [0.0, 0.0, 0])
+        n_responses = 0
+        for student_id, qid, is_correct in responses.values_list(
+            "session__student_id", "question_id", "is_correct"
+        ).iterator(chunk_size=5000):
+            y = 1 if is_correct else 0
+            for tid in question_topics.get(qid, ()):
+                c = counters[(student_id, tid)]
+                c[0], c[1] = decayed(c[0], c[1], y, decay)
+                c[2] += 1
+            n_responses += 1
+
+        with transaction.atomic():
+            existing = TopicMastery.objects.all()
+            if opts["student_id"]:
+                existing = existing.filter(student_id__in=opts["student_id"])
+            existing.delete()
+            TopicMastery.objects.bulk_create(
+                [
+                    TopicMastery(
+                        student_id=student_id, topic_id=tid,
+                        correct_weight=cw, total_weight=tw, n_responses=n,
+                    )
+                    for (student_id, tid), (cw, tw, n) in counters.items()
+                ],
+                batch_size=opts["batch_size"],
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Đã dựng {len(counters)} bản ghi TopicMastery từ {n_responses} phản hồi (decay={decay})"
+            )
+        )
@@ -0,0 +1,163 @@
+# assessment/management/commands/bench_cat_asgi.py
+import asyncio
+import random
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from assessment.models import Subject
+
+User = get_user_model()
+
+BENCH_EMAIL = "bench-asgi-{}@example.com"
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test phiên CAT song song: đường WSGI (CATViewSet, thread pool) so với "
+        "đường ASGI (view async, event loop). Mặc định chạy trong process qua transport "
+        "WSGI/ASGI của httpx; truyền --wsgi-url / --asgi-url để bắn vào server thật "
+        "(vd: gunicorn my_app.wsgi vs uvicorn my_app.asgi:application)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subject-id", type=int, help="Môn dùng để chạy (mặc định: môn đầu tiên)")
+        parser.add_argument("--sessions", type=int, default=50, help="Tổng số phiên CAT mỗi đường")
+        parser.add_argument("--concurrency", type=int, default=16, help="Số phiên chạy đồng thời")
+        parser.add_argument("--target-items", type=int, default=10)
+        parser.add_argument("--mode", choices=["wsgi", "asgi", "both"], default="both")
+        parser.add_argument("--wsgi-url", help="Base URL server WSGI (mặc định: chạy trong process)")
+        parser.add_argument("--asgi-url", help="Base URL server ASGI (mặc định: chạy trong process)")
+        parser.add_argument("--keep", action="store_true", help="Giữ lại user / phiên benchmark")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        subject = (
+            Subject.objects.filter(id=opts["subject_id"]).first()
+            if opts["subject_id"] else Subject.objects.first()
+        )
+        if subject is None:
+            raise CommandError("Không có môn học nào để chạy benchmark.")
+        self.subject_id = subject.id
+        self.opts = opts
+
+        students = [
+            User.objects.get_or_create(email=BENCH_EMAIL.format(i), defaults={"full_name": f"Bench {i}"})[0]
+            for i in range(opts["sessions"])
+        ]
+        student_ids = [s.id for s in students]
+        try:
+            if opts["mode"] in ("wsgi", "both"):
+                self._report("WSGI (CATViewSet)", *self._run_wsgi(student_ids))
+            if opts["mode"] in ("asgi", "both"):
+                self._report("ASGI (async views)", *asyncio.run(self._run_asgi(student_ids)))
+        finally:
+            if not opts["keep"]:
+                User.objects.filter(id__in=student_ids).delete()
+
+    # -------- 1) WSGI: mỗi phiên 1 thread, request chặn thread suốt các round trip DB --------
+    def _run_wsgi(self, student_ids):
+        from django.db import close_old_connections
+        from my_app.wsgi import application
+
+        if self.opts["wsgi_url"]:
+            make_client = lambda: httpx.Client(base_url=self.opts["wsgi_url"])
+        else:
+            transport = httpx.WSGITransport(app=application)
+            make_client = lambda: httpx.Client(transport=transport, base_url="http://localhost")
+
+        latencies, statuses = [], Counter()
+        rng = random.Random(self.opts["seed"])
+
+        def run_session(student_id):
+            try:
+                with make_client() as client:
+                    def post(path, body):
+                        t0 = time.perf_counter()
+                        r = client.post(path, json=body)
+                        latencies.append(time.perf_counter() - t0)
+                        statuses[r.status_code] += 1
+                        return r
+
+                    self._session_flow(post, student_id, "/api/cat/start/", "/api/cat/answer/", rng)
+            finally:
+                close_old_connections()
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.opts["concurrency"]) as pool:
+            list(pool.map(run_session, student_ids))
+        return time.perf_counter() - t0, latencies, statuses
+
+    # -------- 2) ASGI: các phiên là coroutine trên 1 event loop --------
+    async def _run_asgi(self, student_ids):
+        from my_app.asgi import application
+
+        if self.opts["asgi_url"]:
+            client = httpx.AsyncClient(base_url=self.opts["asgi_url"])
+        else:
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=application), base_url="http://localhost")
+
+        latencies, statuses = [], Counter()
+        rng = random.Random(self.opts["seed"])
+        sem = asyncio.Semaphore(self.opts["concurrency"])
+
+        async def post(path, body):
+            t0 = time.perf_counter()
+            r = await client.post(path, json=body)
+            latencies.append(time.perf_counter() - t0)
+            statuses[r.status_code] += 1
+            return r
+
+        async def run_session(student_id):
+            async with sem:
+                r = await post("/api/cat/async/start/", self._start_body(student_id))
+                if r.status_code != 201:
+                    return
+                sid, q = r.json()["session_id"], r.json()["next_question"]
+                while q:
+                    r = await post("/api/cat/async/answer/", self._answer_body(sid, q, rng))
+                    q = r.json().get("next_question") if r.status_code == 200 else None
+
+        t0 = time.perf_counter()
+        async with client:
+            await asyncio.gather(*(run_session(sid) for sid in student_ids))
+        return time.perf_counter() - t0, latencies, statuses
+
+    # -------- 3) Tiện ích chung --------
+    def _start_body(self, student_id):
+        return {"student_id": student_id, "subject_id": self.subject_id, "target_items": self.opts["target_items"]}
+
+    @staticmethod
+    def _answer_body(session_id, question, rng):
+        return {
+            "session_id": session_id,
+            "question_id": question["id"],
+            "option_id": rng.choice(question["options"])["id"],
+        }
+
+    def _session_flow(self, post, student_id, start_path, answer_path, rng):
+        r = post(start_path, self._start_body(student_id))
+        if r.status_code != 201:
+            return
+        sid, q = r.json()["session_id"], r.json()["next_question"]
+        while q:
+            r = post(answer_path, self._answer_body(sid, q, rng))
+            q = r.json().get("next_question") if r.status_code == 200 else None
+
+    def _report(self, label, wall, latencies, statuses):
+        lat = np.array(latencies) * 1000
+        self.stdout.write(
+            f"[{label}] {self.opts['sessions']} phiên, {len(lat)} request trong {wall:.2f}s "
+            f"({self.opts['sessions'] / wall:.1f} phiên/s, {len(lat) / wall:.1f} req/s)"
+        )
+        if len(lat):
+            self.stdout.write(
+                f"  latency ms: p50={np.percentile(lat, 50):.1f} p95={np.percentile(lat, 95):.1f} "
+                f"p99={np.percentile(lat, 99):.1f} max={lat.max():.1f}"
+            )
+        self.stdout.write(f"  status: {dict(sorted(statuses.items()))}")
@@ -0,0 +1,107 @@
+# assessment/management/commands/bench_cat_concurrency.py
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from rest_framework.test import APIClient
+
+from assessment.models import Subject, TestSession
+
+User = get_user_model()
+
+BENCH_EMAIL = "bench-cat-{}@example.com"
+
+
+class Command(BaseCommand):
+    help = (
+        "Đo latency /api/cat/answer/ khi nhiều phiên chạy song song và client gửi trùng "
+        "(double-submit). --pessimistic giả lập cách cũ: giữ select_for_update suốt request. "
+        "Chạy trên PostgreSQL (SQLite không có khoá dòng, ghi song song bị 'database is locked')."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subject-id", type=int, help="Môn dùng để chạy (mặc định: môn đầu tiên)")
+        parser.add_argument("--sessions", type=int, default=40, help="Tổng số phiên CAT")
+        parser.add_argument("--threads", type=int, default=16, help="Số phiên chạy song song")
+        parser.add_argument("--target-items", type=int, default=10)
+        parser.add_argument("--duplicate-rate", type=float, default=0.3, help="Tỉ lệ câu bị gửi trùng 2 request cùng lúc")
+        parser.add_argument("--pessimistic", action="store_true", help="Khoá TestSession (select_for_update) suốt mỗi request")
+        parser.add_argument("--keep", action="store_true", help="Giữ lại user / phiên benchmark")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        subject = (
+            Subject.objects.filter(id=opts["subject_id"]).first()
+            if opts["subject_id"] else Subject.objects.first()
+        )
+        if subject is None:
+            raise CommandError("Không có môn học nào để chạy benchmark.")
+
+        students = [
+            User.objects.get_or_create(email=BENCH_EMAIL.format(i), defaults={"full_name": f"Bench {i}"})[0]
+            for i in range(opts["sessions"])
+        ]
+        rng = random.Random(opts["seed"])
+        latencies = []
+        statuses = Counter()
+        lock = threading.Lock()
+
+        def post(path, body, session_id=None):
+            client = APIClient()
+            t0 = time.perf_counter()
+            try:
+                if opts["pessimistic"] and session_id is not None:
+                    with transaction.atomic():
+                        TestSession.objects.select_for_update().get(id=session_id)
+                        r = client.post(path, body, format="json")
+                else:
+                    r = client.post(path, body, format="json")
+            finally:
+                connection.close()
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+                statuses[r.status_code] += 1
+            return r
+
+        def run_session(student):
+            r = post("/api/cat/start/", {
+                "student_id": student.id, "subject_id": subject.id, "target_items": opts["target_items"],
+            })
+            if r.status_code != 201:
+                return
+            sid = r.json()["session_id"]
+            q = r.json()["next_question"]
+            with ThreadPoolExecutor(max_workers=2) as twin:
+                while q:
+                    body = {"session_id": sid, "question_id": q["id"], "option_id": rng.choice(q["options"])["id"]}
+                    if rng.random() < opts["duplicate_rate"]:
+                        futures = [twin.submit(post, "/api/cat/answer/", body, sid) for _ in range(2)]
+                        results = [f.result() for f in futures]
+                    else:
+                        results = [post("/api/cat/answer/", body, sid)]
+                    ok = [res for res in results if res.status_code == 200]
+                    q = ok[0].json().get("next_question") if ok else None
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=opts["threads"]) as pool:
+            list(pool.map(run_session, students))
+        wall = time.perf_counter() - t0
+
+        lat = np.array(latencies) * 1000
+        mode = "pessimistic (select_for_update)" if opts["pessimistic"] else "optimistic (CAS)"
+        self.stdout.write(f"[{mode}] {len(lat)} request trong {wall:.2f}s ({len(lat) / wall:.1f} req/s)")
+        if len(lat):
+            self.stdout.write(
+                f"  latency ms: p50={np.percentile(lat, 50):.1f} p95={np.percentile(lat, 95):.1f} "
+                f"p99={np.percentile(lat, 99):.1f} max={lat.max():.1f}"
+            )
+        self.stdout.write(f"  status: {dict(sorted(statuses.items()))}")
+
+        if not opts["keep"]:
+            User.objects.filter(id__in=[s.id for s in students]).delete()
@@ -0,0 +1,99 @@
+# assessment/management/commands/bench_cat_selection.py
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from assessment.services.item_bank import SHORTLIST_MIN_POOL, ItemBankIndex
+from assessment.services.rules import select_position
+from assessment.services.topic_index import QuestionTopicCSR
+
+
+def _synthetic_bank(n_items: int, topic_size: int, n_topics: int, rng) -> ItemBankIndex:
+    """Item bank giả lập: topic đầu có đúng topic_size câu, phần còn lại chia đều các topic khác."""
+    cols = np.empty(n_items, dtype=np.int32)
+    cols[:topic_size] = 0
+    cols[topic_size:] = rng.integers(1, n_topics, n_items - topic_size)
+    rng.shuffle(cols)
+    topics = QuestionTopicCSR(
+        question_ids=np.arange(1, n_items + 1, dtype=np.int64),
+        topic_ids=np.arange(1, n_topics + 1, dtype=np.int64),
+        offsets=np.arange(n_items + 1, dtype=np.int64),
+        cols=cols,
+    )
+    return ItemBankIndex(
+        subject_id=0,
+        version=None,
+        question_ids=topics.question_ids,
+        a=rng.uniform(0.5, 2.0, n_items),
+        b=rng.normal(0.0, 1.2, n_items),
+        c=rng.uniform(0.0, 0.3, n_items),
+        topics=topics,
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Đo thời gian chọn câu CAT theo kích thước môn / topic (dữ liệu giả lập, không đụng DB): "
+        "phiên khoá 1 topic và phiên cả môn (topic = all)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subject-sizes", type=int, nargs="+", default=[5000, 20000, 80000], help="Số câu của môn")
+        parser.add_argument("--topic-sizes", type=int, nargs="+", default=[100, 1000], help="Số câu của topic bị khoá")
+        parser.add_argument("--topics", type=int, default=50, help="Số topic của môn")
+        parser.add_argument("--used", type=int, default=20, help="Số câu đã làm trong phiên (loại trừ)")
+        parser.add_argument("--repeat", type=int, default=200, help="Số lần chọn câu mỗi cấu hình")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        rng = np.random.default_rng(opts["seed"])
+        # shortlist: ép đường shortlist; pool: ép quét pool; auto: đường select_position
+        # tự chọn theo SHORTLIST_MIN_POOL; mask: cách cũ (mask trên toàn môn) để so sánh
+        self.stdout.write(
+            f"{'môn':>8} {'topic':>7} {'shortlist ms':>13} {'pool ms':>9} {'auto':>10} {'mask ms':>9}"
+        )
+
+        for n_items in opts["subject_sizes"]:
+            bank = None
+            for topic_size in [*opts["topic_sizes"], None]:
+                if topic_size is not None and topic_size > n_items:
+                    continue
+                if bank is None or topic_size is not None:
+                    bank = _synthetic_bank(n_items, topic_size or 100, opts["topics"], rng)
+                if topic_size is None:
+                    # Phiên cả môn: θ khác nhau trên từng topic
+                    topic_ids = None
+                    pool = np.arange(len(bank))
+                    ability = {int(t): float(rng.normal()) for t in bank.topic_ids}
+                else:
+                    topic_ids = {int(bank.topic_ids[0])}
+                    pool = bank.topic_positions(topic_ids)
+                    ability = {int(bank.topic_ids[0]): 0.3}
+                excluded = set(bank.question_ids[rng.permutation(pool)[: opts["used"]]].tolist())
+
+                timings = []
+                for use_shortlist in (True, False):
+                    # Lượt đầu để build shortlist / CSC (cache trong process)
+                    select_position(bank, ability, 0.0, excluded=excluded, topic_ids=topic_ids, use_shortlist=use_shortlist)
+                    t0 = time.perf_counter()
+                    for _ in range(opts["repeat"]):
+                        select_position(
+                            bank, ability, 0.0,
+                            excluded=excluded, topic_ids=topic_ids, use_shortlist=use_shortlist,
+                        )
+                    timings.append((time.perf_counter() - t0) / opts["repeat"] * 1000)
+
+                t0 = time.perf_counter()
+                for _ in range(opts["repeat"]):
+                    mask = bank.exclude_mask(excluded) & bank.calibrated
+                    if topic_ids is not None:
+                        mask &= bank.topic_mask(topic_ids)
+                    np.flatnonzero(mask)
+                timings.append((time.perf_counter() - t0) / opts["repeat"] * 1000)
+
+                auto = "shortlist" if len(pool) >= SHORTLIST_MIN_POOL else "pool"
+                self.stdout.write(
+                    f"{n_items:>8} {topic_size or 'all':>7} {timings[0]:>13.3f} {timings[1]:>9.3f} "
+                    f"{auto:>10} {timings[2]:>9.3f}"
+                )
@@ -0,0 +1,106 @@
+# assessment/management/commands/calibrate_irt.py
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from assessment.models import Subject, QuestionIRT
+from assessment.services.calibration import (
+    calibrate,
+    initial_params,
+    load_response_matrix,
+)
+from assessment.services.item_bank import ITEM_BANK_VERSION
+from assessment.services.versioning import bump_version
+
+
+class Command(BaseCommand):
+    help = "Ước lượng lại tham số 3PL (a, b, c) từ TestResponse bằng MML-EM."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subject-id", type=int, action="append", help="Chỉ calibrate môn này (lặp lại được). Mặc định: tất cả môn")
+        parser.add_argument("--max-iter", type=int, default=50, help="Số vòng EM tối đa")
+        parser.add_argument("--tol", type=float, default=1e-3, help="Dừng khi thay đổi tham số lớn nhất < tol")
+        parser.add_argument("--chunk-persons", type=int, default=2000, help="Số thí sinh mỗi chunk trong E-step (giới hạn bộ nhớ)")
+        parser.add_argument("--workers", type=int, default=1, help="Số process cho E-step (1 = không dùng pool)")
+        parser.add_argument("--min-responses", type=int, default=30, help="Chỉ ghi lại câu có ít nhất chừng này phản hồi")
+        parser.add_argument("--fix-c", action="store_true", help="Giữ nguyên c (chỉ ước lượng a, b)")
+        parser.add_argument("--dry-run", action="store_true", help="Chỉ tính, không ghi DB")
+
+    def handle(self, *args, **opts):
+        subjects = Subject.objects.all()
+        if opts["subject_id"]:
+            subjects = subjects.filter(id__in=opts["subject_id"])
+            if not subjects.exists():
+                raise CommandError("Không tìm thấy môn học nào với --subject-id đã cho.")
+
+        for subject in subjects:
+            self._calibrate_subject(subject, opts)
+
+    def _calibrate_subject(self, subject, opts):
+        t0 = time.perf_counter()
+        rm = load_response_matrix(subject.id)
+        self.stdout.write(
+            f"[{subject.name}] {rm.n_responses} phản hồi, {rm.n_persons} thí sinh, "
+            f"{rm.n_items} câu (load {time.perf_counter() - t0:.2f}s)"
+        )
+        if rm.n_responses == 0:
+            return
+
+        existing = {
+            qid: (a, b, c)
+            for qid, a, b, c in QuestionIRT.objects
+            .filter(question_id__in=rm.question_ids.tolist())
+            .values_list("question_id", "a", "b", "c")
+        }
+        params = initial_params(rm, existing)
+
+        def log(stats):
+            self.stdout.write(
+                f"  iter {stats['iter']:3d}: loglik={stats['loglik']:.2f} "
+                f"Δmax={stats['delta']:.5f} E={stats['e_sec']:.3f}s M={stats['m_sec']:.3f}s"
+            )
+
+        params, n_iter = calibrate(
+            rm,
+            params,
+            max_iter=opts["max_iter"],
+            tol=opts["tol"],
+            chunk_persons=opts["chunk_persons"],
+            workers=opts["workers"],
+            fix_c=opts["fix_c"],
+            log=log,
+        )
+
+        counts = np.bincount(rm.item_idx, minlength=rm.n_items)
+        keep = counts >= opts["min_responses"]
+        self.stdout.write(
+            f"[{subject.name}] xong sau {n_iter} vòng; "
+            f"{int(keep.sum())}/{rm.n_items} câu đủ {opts['min_responses']} phản hồi"
+        )
+        if opts["dry_run"] or not keep.any():
+            return
+
+        self._write_params(rm.question_ids[keep], params[keep])
+        # bulk_update không bắn signal -> tự invalidate item bank của môn
+        bump_version(ITEM_BANK_VERSION, subject.id)
+
+    @transaction.atomic
+    def _write_params(self, question_ids, params):
+        new_vals = {int(qid): p for qid, p in zip(question_ids, params)}
+
+        to_update = list(QuestionIRT.objects.filter(question_id__in=new_vals.keys()))
+        for irt in to_update:
+            irt.a, irt.b, irt.c = (float(v) for v in new_vals.pop(irt.question_id))
+        QuestionIRT.objects.bulk_update(to_update, ["a", "b", "c"], batch_size=1000)
+
+        # Câu chưa có bản ghi IRT
+        QuestionIRT.objects.bulk_create(
+            [
+                QuestionIRT(question_id=qid, a=float(p[0]), b=float(p[1]), c=float(p[2]))
+                for qid, p in new_vals.items()
+            ],
+            batch_size=1000,
+        )
+        self.stdout.write(f"  đã ghi {len(to_update)} cập nhật, {len(new_vals)} bản ghi mới")
@@ -7,6 +7,8 @@ User = settings.AUTH_USER_MODEL
 # === 1) Phân cấp tri thức ===
 class Subject(models.Model):
     name = models.CharField(max_length=120, unique=True)
+    # Luật dừng CAT mặc định của môn (xem services/stopping.py)
+    stopping_policy = models.JSONField(default=dict, blank=True)
 
     def __str__(self): return self.name
 
@@ -79,6 +81,11 @@ class StudentAbilityProfile(models.Model):
     
     # Sai số chuẩn của ước tính (Standard Error)
     se = models.FloatField(default=1.0) 
+
+    # Trạng thái EAP: log-posterior trên lưới irt.THETA_GRID.
+    # Cập nhật dồn mỗi phản hồi -> theta/se đúng cho toàn bộ lịch sử mà không cần replay.
+    log_posterior = models.JSONField(null=True, blank=True)
+    n_responses = models.PositiveIntegerField(default=0)
     
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -88,6 +95,26 @@ class StudentAbilityProfile(models.Model):
     def __str__(self):
         return f"{self.student.username} | {self.topic.name} | T={self.theta:.2f} (SE={self.se:.2f})"
 
+
+class TopicMastery(models.Model):
+    """Tỉ lệ đúng theo topic, dạng bộ đếm suy giảm mũ (xem services/mastery.py)."""
+
+    student = models.ForeignKey(User, on_delete=models.CASCADE, related_name="topic_masteries")
+    topic = models.ForeignKey(Topic, on_delete=models.CASCADE)
+
+    correct_weight = models.FloatField(default=0.0)
+    total_weight = models.FloatField(default=0.0)
+    n_responses = models.PositiveIntegerField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("student", "topic")
+
+    @property
+    def mastery(self):
+        return self.correct_weight / self.total_weight if self.total_weight > 0 else None
+
 # === 5) Phiên kiểm tra (CAT & Fixed) ===
 class TestSession(models.Model):
     MODE_CHOICES = (("CAT", "CAT"), ("FIXED", "FIXED"))
@@ -107,6 +134,11 @@ class TestSession(models.Model):
         related_name="test_sessions",
         help_text="Nếu không null, phiên CAT này chỉ sinh câu hỏi trong topic này."
     )
+    # Tăng 1 mỗi bước trả lời; ghi bước bằng compare-and-swap trên cột này
+    # (optimistic concurrency thay cho select_for_update suốt request)
+    version = models.PositiveIntegerField(default=0)
+    # Luật dừng của phiên: của môn + tuỳ chỉnh lúc start, chốt khi tạo phiên
+    stopping_policy = models.JSONField(default=dict, blank=True)
 
 
 class TestItem(models.Model):
@@ -132,6 +164,10 @@ class Rule(models.Model):
     condition_json = models.JSONField(default=dict)  # {"type":"topic_mastery_below","topic_id":10,"threshold":0.4}
     action_json = models.JSONField(default=dict)     # {"type":"boost_topic_probability","topic_id":10,"weight":1.5}
     is_active = models.BooleanField(default=True)
+    # Phạm vi áp dụng (tuỳ chọn): để trống cả 2 -> suy ra từ topic_id trong condition,
+    # không có nữa thì áp cho mọi môn
+    subject = models.ForeignKey(Subject, null=True, blank=True, on_delete=models.CASCADE, related_name="rules")
+    topic = models.ForeignKey(Topic, null=True, blank=True, on_delete=models.CASCADE, related_name="rules")
 
 
 class CandidateQuestion(models.Model):
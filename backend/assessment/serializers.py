@@ -1,6 +1,8 @@
 # assessment/serializers.py
 from rest_framework import serializers
 from django.db import transaction
+
+from assessment.services.stopping import session_policy, validate_policy
 from .models import (
     Subject,
     Question,
@@ -46,10 +48,20 @@ class StudentAbilityProfileSerializer(serializers.ModelSerializer):
         fields = ["topic", "topic_name", "theta", "se", "updated_at"]
 
 
+def _validate_stopping_policy(value):
+    try:
+        return validate_policy(value)
+    except ValueError as e:
+        raise serializers.ValidationError(str(e))
+
+
 class SubjectSerializer(serializers.ModelSerializer):
     class Meta:
         model = Subject
-        fields = ["id", "name"]
+        fields = ["id", "name", "stopping_policy"]
+
+    def validate_stopping_policy(self, value):
+        return _validate_stopping_policy(value)
 
 
 class TopicSerializer(serializers.ModelSerializer):
@@ -126,6 +138,11 @@ class StartCatSerializer(serializers.Serializer):
     subject_id = serializers.IntegerField()
     target_items = serializers.IntegerField(default=10, min_value=3)
     topic_id = serializers.IntegerField(required=False, allow_null=True)
+    # Tuỳ chỉnh luật dừng cho phiên này (đè lên Subject.stopping_policy)
+    stopping_policy = serializers.DictField(required=False, default=dict)
+
+    def validate_stopping_policy(self, value):
+        return _validate_stopping_policy(value)
 
     def validate(self, attrs):
         subject_id = attrs.get("subject_id")
@@ -138,6 +155,12 @@ class StartCatSerializer(serializers.Serializer):
                 raise serializers.ValidationError(
                     "Chủ đề (topic) không thuộc môn học đã chọn."
                 )
+
+        # Luật dừng của phiên = của môn + tuỳ chỉnh, kiểm tra lại sau khi gộp
+        try:
+            attrs["stopping_policy"] = session_policy(subject_id, attrs.get("stopping_policy"))
+        except ValueError as e:
+            raise serializers.ValidationError({"stopping_policy": str(e)})
         return attrs
 
 
@@ -150,6 +173,58 @@ class AnswerCatSerializer(serializers.Serializer):
     option_id = serializers.IntegerField()
     latency_ms = serializers.IntegerField(required=False)
     topic_id = serializers.IntegerField(required=False, allow_null=True)
+    # Khoá idempotency do client sinh (thay cho header Idempotency-Key)
+    request_id = serializers.CharField(required=False, max_length=64)
+
+
+class BatchAnswerItemSerializer(serializers.Serializer):
+    question_id = serializers.IntegerField()
+    option_id = serializers.IntegerField()
+    latency_ms = serializers.IntegerField(required=False)
+
+
+class AnswerCatBatchSerializer(serializers.Serializer):
+    """
+    Input khi NỘP CẢ LÔ đáp án (client mất mạng, kết nối lại rồi gửi dồn).
+    answers theo thứ tự làm bài, chỉ gồm các câu đã được phát trong phiên.
+    """
+    session_id = serializers.UUIDField()
+    answers = BatchAnswerItemSerializer(many=True, allow_empty=False)
+    request_id = serializers.CharField(required=False, max_length=64)
+
+
+class DraftRuleSerializer(serializers.Serializer):
+    """Rule nháp (chưa lưu) dùng để xem trước tác động."""
+    name = serializers.CharField(required=False, default="draft")
+    condition_json = serializers.DictField()
+    action_json = serializers.DictField()
+    topic_id = serializers.IntegerField(required=False, allow_null=True)
+
+    def validate(self, attrs):
+        from assessment.services.rules import RULE_COMPILERS
+
+        key = (attrs["condition_json"].get("type"), attrs["action_json"].get("type"))
+        if key not in RULE_COMPILERS:
+            raise serializers.ValidationError(
+                f"Không hỗ trợ cặp condition/action: {key[0]} / {key[1]}."
+            )
+        return attrs
+
+
+class RulePreviewSerializer(serializers.Serializer):
+    """
+    Input khi XEM TRƯỚC luật cho cả lớp.
+
+    - rules: luật nháp thêm vào (mới nhất)
+    - include_active = False -> chỉ xét luật nháp
+    """
+    subject_id = serializers.IntegerField()
+    student_ids = serializers.ListField(
+        child=serializers.IntegerField(), min_length=1, max_length=5000
+    )
+    rules = DraftRuleSerializer(many=True, required=False, default=list)
+    include_active = serializers.BooleanField(default=True)
+    include_contexts = serializers.BooleanField(default=True)
 
 
 class GenerateFixedTestSerializer(serializers.Serializer):
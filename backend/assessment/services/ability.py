@@ -0,0 +1,191 @@
+# assessment/services/ability.py
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from assessment.services.irt import (
+    THETA_GRID,
+    eap_estimate,
+    eap_log_prior,
+    eap_update,
+    eap_widen,
+)
+
+# SD trôi năng lực giữa 2 phiên (nới posterior ở câu trả lời đầu mỗi phiên, xem widen_profiles)
+DEFAULT_DRIFT_SD = 0.3
+
+
+def profile_log_posterior(profile) -> np.ndarray:
+    """
+    Lấy log-posterior đang lưu của StudentAbilityProfile.
+
+    Profile cũ (chưa có trạng thái, hoặc lưới đã đổi kích thước) được khởi tạo
+    bằng prior N(theta, se^2) từ giá trị đã lưu, nên không mất ước lượng trước đó.
+    """
+    lp = profile.log_posterior
+    if lp and len(lp) == len(THETA_GRID):
+        return np.asarray(lp, dtype=float)
+    return eap_log_prior(profile.theta, profile.se)
+
+
+def apply_response(
+    profile,
+    a: Optional[float],
+    b: Optional[float],
+    c: Optional[float],
+    y: int,
+) -> bool:
+    """
+    Cộng 1 phản hồi vào trạng thái posterior của profile (O(lưới), không replay).
+
+    Cập nhật profile.log_posterior, theta, se, n_responses (chưa save).
+    Trả về False nếu câu chưa có tham số IRT (profile giữ nguyên).
+    """
+    if a is None or b is None or c is None:
+        return False
+
+    lp = eap_update(profile_log_posterior(profile), a, b, c, y)
+    profile.theta, profile.se = eap_estimate(lp)
+    profile.log_posterior = np.round(lp, 6).tolist()
+    profile.n_responses = (profile.n_responses or 0) + 1
+    return True
+
+
+def apply_responses(profile, responses: List[Tuple[float, float, float, int]]) -> int:
+    """
+    Cộng nhiều phản hồi (a, b, c, y) vào posterior trong 1 lần eap_update + 1 lần
+    eap_estimate (kết quả như gọi apply_response lần lượt). Trả về số phản hồi đã cộng.
+    """
+    responses = [r for r in responses if None not in r[:3]]
+    if not responses:
+        return 0
+
+    a, b, c, y = (np.asarray(col, dtype=float) for col in zip(*responses))
+    lp = eap_update(profile_log_posterior(profile), a, b, c, y)
+    profile.theta, profile.se = eap_estimate(lp)
+    profile.log_posterior = np.round(lp, 6).tolist()
+    profile.n_responses = (profile.n_responses or 0) + len(responses)
+    return len(responses)
+
+
+def drift_sd() -> float:
+    return float(getattr(settings, "CAT_ABILITY_DRIFT_SD", DEFAULT_DRIFT_SD))
+
+
+def widen_profiles(profiles: Dict[int, object], sd: Optional[float] = None) -> List[object]:
+    """
+    Câu trả lời đầu tiên của phiên: nới posterior đã lưu của từng topic thêm
+    phương sai trôi (eap_widen), để phiên sau vẫn phải thu thêm thông tin trước
+    khi SE đủ nhỏ và θ còn theo kịp việc học. Chỉ nới khi phiên có phản hồi
+    (không phải lúc /cat/start), nên mở phiên rồi bỏ không làm SE phình ra.
+    Sửa `profiles` tại chỗ; trả về các profile đã đổi.
+    """
+    sd = drift_sd() if sd is None else sd
+    if sd <= 0:
+        return []
+    changed = []
+    for profile in profiles.values():
+        if not profile.n_responses:
+            continue  # chưa có phản hồi -> vẫn là prior
+        lp = eap_widen(profile_log_posterior(profile), sd)
+        profile.theta, profile.se = eap_estimate(lp)
+        profile.log_posterior = np.round(lp, 6).tolist()
+        changed.append(profile)
+    return changed
+
+
+# -------- Đọc / ghi profile theo lô --------
+PROFILE_UPDATE_FIELDS = ["theta", "se", "log_posterior", "n_responses", "updated_at"]
+
+
+def load_profiles(student_id: int, subject_id: int) -> Dict[int, object]:
+    """Toàn bộ StudentAbilityProfile của học sinh trong môn: {topic_id: profile} (1 query)."""
+    from assessment.models import StudentAbilityProfile
+
+    return {
+        p.topic_id: p
+        for p in StudentAbilityProfile.objects.filter(
+            student_id=student_id, topic__subject_id=subject_id,
+        )
+    }
+
+
+async def aload_profiles(student_id: int, subject_id: int) -> Dict[int, object]:
+    """Bản async của load_profiles (async ORM)."""
+    from assessment.models import StudentAbilityProfile
+
+    return {
+        p.topic_id: p
+        async for p in StudentAbilityProfile.objects.filter(
+            student_id=student_id, topic__subject_id=subject_id,
+        )
+    }
+
+
+def apply_response_to_topics(
+    profiles: Dict[int, object],
+    student_id: int,
+    topic_ids: Iterable[int],
+    irt: Optional[Tuple[float, float, float]],
+    y: int,
+) -> List[object]:
+    """
+    Cộng phản hồi vào profile của từng topic (tạo mới trong bộ nhớ nếu chưa có).
+    Sửa `profiles` tại chỗ; trả về các profile cần ghi (đã đổi hoặc mới tạo).
+    """
+    return apply_responses_to_topics(profiles, student_id, [(topic_ids, irt, y)])
+
+
+def apply_responses_to_topics(
+    profiles: Dict[int, object],
+    student_id: int,
+    items: Iterable[Tuple[Iterable[int], Optional[Tuple[float, float, float]], int]],
+) -> List[object]:
+    """
+    Như apply_response_to_topics cho nhiều phản hồi (topic_ids, irt, y): gom theo
+    topic rồi cập nhật mỗi profile 1 lần (apply_responses).
+    """
+    from assessment.models import StudentAbilityProfile
+
+    by_topic: Dict[int, list] = {}
+    for topic_ids, irt, y in items:
+        for tid in topic_ids:
+            rows = by_topic.setdefault(tid, [])
+            if irt is not None:
+                rows.append((*irt, y))
+
+    changed = []
+    for tid, rows in by_topic.items():
+        profile = profiles.get(tid)
+        is_new = profile is None
+        if is_new:
+            profile = profiles[tid] = StudentAbilityProfile(
+                student_id=student_id, topic_id=tid, theta=0.0, se=1.0,
+            )
+        if apply_responses(profile, rows) or is_new:
+            changed.append(profile)
+    return changed
+
+
+def save_profiles(profiles: Iterable[object]) -> None:
+    """Ghi các profile bằng 1 câu upsert (INSERT ... ON CONFLICT (student, topic) DO UPDATE)."""
+    from assessment.models import StudentAbilityProfile
+
+    # Bản sao không mang pk: xung đột chỉ xét trên (student, topic)
+    rows = [
+        StudentAbilityProfile(
+            student_id=p.student_id, topic_id=p.topic_id, theta=p.theta, se=p.se,
+            log_posterior=p.log_posterior, n_responses=p.n_responses,
+        )
+        for p in profiles
+    ]
+    if not rows:
+        return
+    StudentAbilityProfile.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=["student", "topic"],
+        update_fields=PROFILE_UPDATE_FIELDS,
+    )
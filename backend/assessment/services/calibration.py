@@ -0,0 +1,408 @@
+# assessment/services/calibration.py
+from __future__ import annotations
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, Optional
+import atexit
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest, Least
+
+from assessment.services.irt import THETA_GRID, p_3pl_batch
+from assessment.services.item_bank import ITEM_BANK_VERSION
+from assessment.services.versioning import bump_version
+
+
+# Lưới quadrature cho MML-EM (thưa hơn lưới EAP cho E-step nhẹ hơn)
+QUAD_POINTS = THETA_GRID[::2]
+_LOG_QUAD_WEIGHTS = -0.5 * QUAD_POINTS ** 2
+_LOG_QUAD_WEIGHTS = _LOG_QUAD_WEIGHTS - np.logaddexp.reduce(_LOG_QUAD_WEIGHTS)
+
+# Prior (Bayes modal) cho M-step: giữ a/b/c trong vùng hợp lý khi ít dữ liệu
+PRIOR_MEAN = np.array([1.0, 0.0, 0.2])
+PRIOR_SD = np.array([0.5, 2.0, 0.05])
+PARAM_MIN = np.array([0.2, -4.0, 0.0])
+PARAM_MAX = np.array([4.0, 4.0, 0.5])
+
+
+@dataclass
+class ResponseMatrix:
+    """
+    Ma trận thưa người × câu (dạng CSR theo người).
+
+    - item_idx, y: phản hồi đã sắp theo người
+    - person_offsets: phản hồi của người p nằm trong [offsets[p], offsets[p+1])
+    - question_ids / student_ids: index -> id gốc trong DB
+    """
+    item_idx: np.ndarray
+    y: np.ndarray
+    person_offsets: np.ndarray
+    question_ids: np.ndarray
+    student_ids: np.ndarray
+
+    @property
+    def n_items(self) -> int:
+        return len(self.question_ids)
+
+    @property
+    def n_persons(self) -> int:
+        return len(self.student_ids)
+
+    @property
+    def n_responses(self) -> int:
+        return len(self.y)
+
+
+def load_response_matrix(subject_id: int, chunk_size: int = 20000) -> ResponseMatrix:
+    """
+    Stream TestResponse của 1 môn vào ma trận thưa.
+
+    Chỉ giữ 3 cột số nguyên (không tạo model instance), nên bộ nhớ ~ 9 byte/phản hồi.
+    """
+    from assessment.models import TestResponse
+
+    students = array("q")
+    questions = array("q")
+    ys = array("b")
+
+    rows = (
+        TestResponse.objects
+        .filter(session__subject_id=subject_id)
+        .order_by()
+        .values_list("session__student_id", "question_id", "is_correct")
+        .iterator(chunk_size=chunk_size)
+    )
+    for sid, qid, ok in rows:
+        students.append(sid)
+        questions.append(qid)
+        ys.append(1 if ok else 0)
+
+    student_ids, person_idx = np.unique(np.frombuffer(students, dtype=np.int64), return_inverse=True)
+    question_ids, item_idx = np.unique(np.frombuffer(questions, dtype=np.int64), return_inverse=True)
+    y = np.frombuffer(ys, dtype=np.int8)
+
+    order = np.argsort(person_idx, kind="stable")
+    counts = np.bincount(person_idx, minlength=len(student_ids))
+    offsets = np.zeros(len(student_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return ResponseMatrix(
+        item_idx=item_idx[order].astype(np.int32),
+        y=y[order],
+        person_offsets=offsets,
+        question_ids=question_ids,
+        student_ids=student_ids,
+    )
+
+
+def _e_step_chunk(args) -> tuple[np.ndarray, np.ndarray, float]:
+    """
+    E-step cho một nhóm người (chạy được trong process pool).
+
+    Trả về (n_iq, r_iq, loglik):
+      - n_iq: số người kỳ vọng tại điểm quadrature q đã làm câu i
+      - r_iq: số người kỳ vọng tại q trả lời đúng câu i
+    """
+    item_idx, y, local_offsets, log_tab, n_items = args
+    n_quad = log_tab.shape[1]
+
+    # log-likelihood từng phản hồi trên lưới: (n_resp, Q)
+    # log_tab[2i] = log(1 - P_i), log_tab[2i + 1] = log P_i -> chỉ 1 lần gather
+    ll = log_tab[item_idx.astype(np.int64) * 2 + y]
+
+    # Cộng theo người: (n_person, Q)
+    person_ll = np.add.reduceat(ll, local_offsets[:-1], axis=0) + _LOG_QUAD_WEIGHTS
+    m = person_ll.max(axis=1)
+    norm = m + np.log(np.exp(person_ll - m[:, None]).sum(axis=1))
+    post = np.exp(person_ll - norm[:, None])
+
+    # Posterior của người tương ứng với từng phản hồi
+    counts = np.diff(local_offsets)
+    post_r = np.repeat(post, counts, axis=0)
+
+    n_iq = np.empty((n_items, n_quad))
+    r_iq = np.empty((n_items, n_quad))
+    yf = y.astype(float)
+    for q in range(n_quad):
+        w = post_r[:, q]
+        n_iq[:, q] = np.bincount(item_idx, weights=w, minlength=n_items)
+        r_iq[:, q] = np.bincount(item_idx, weights=w * yf, minlength=n_items)
+
+    return n_iq, r_iq, float(norm.sum())
+
+
+def _iter_chunks(rm: ResponseMatrix, log_tab, chunk_persons: int) -> Iterator[tuple]:
+    """Chia người thành từng nhóm chunk_persons để E-step có bộ nhớ giới hạn."""
+    offs = rm.person_offsets
+    for p0 in range(0, rm.n_persons, chunk_persons):
+        p1 = min(p0 + chunk_persons, rm.n_persons)
+        r0, r1 = offs[p0], offs[p1]
+        yield (
+            rm.item_idx[r0:r1],
+            rm.y[r0:r1],
+            offs[p0:p1 + 1] - r0,
+            log_tab,
+            rm.n_items,
+        )
+
+
+def e_step(
+    rm: ResponseMatrix,
+    params: np.ndarray,
+    chunk_persons: int = 2000,
+    pool: Optional[ProcessPoolExecutor] = None,
+) -> tuple[np.ndarray, np.ndarray, float]:
+    """E-step trên toàn bộ người, gộp kết quả các chunk."""
+    p = p_3pl_batch(QUAD_POINTS[None, :], params[:, 0:1], params[:, 1:2], params[:, 2:3])
+    p = np.clip(p, 1e-9, 1.0 - 1e-9)
+    log_tab = np.stack([np.log1p(-p), np.log(p)], axis=1).reshape(2 * rm.n_items, -1)
+
+    chunks = _iter_chunks(rm, log_tab, chunk_persons)
+    results = pool.map(_e_step_chunk, chunks) if pool is not None else map(_e_step_chunk, chunks)
+
+    n_iq = np.zeros((rm.n_items, len(QUAD_POINTS)))
+    r_iq = np.zeros_like(n_iq)
+    loglik = 0.0
+    for n_c, r_c, ll_c in results:
+        n_iq += n_c
+        r_iq += r_c
+        loglik += ll_c
+    return n_iq, r_iq, loglik
+
+
+def m_step(
+    params: np.ndarray,
+    n_iq: np.ndarray,
+    r_iq: np.ndarray,
+    *,
+    fix_c: bool = False,
+    n_newton: int = 5,
+) -> np.ndarray:
+    """
+    M-step: Fisher scoring cho (a, b, c) của tất cả câu cùng lúc.
+
+    Mỗi câu có ma trận thông tin 3x3 riêng; giải theo lô bằng np.linalg.solve.
+    """
+    x = params.copy()
+    theta = QUAD_POINTS[None, :]
+    prior_prec = 1.0 / PRIOR_SD ** 2
+
+    for _ in range(n_newton):
+        a, b, c = x[:, 0:1], x[:, 1:2], x[:, 2:3]
+        L = 1.0 / (1.0 + np.exp(-np.clip(a * (theta - b), -20.0, 20.0)))
+        P = np.clip(c + (1.0 - c) * L, 1e-9, 1.0 - 1e-9)
+        PQ = P * (1.0 - P)
+
+        # dP/d(a, b, c): (I, Q, 3)
+        dL = (1.0 - c) * L * (1.0 - L)
+        dP = np.stack([dL * (theta - b), -dL * a, 1.0 - L], axis=-1)
+
+        resid = (r_iq - n_iq * P) / PQ
+        grad = np.einsum("iq,iqk->ik", resid, dP)
+        info = np.einsum("iq,iqk,iql->ikl", n_iq / PQ, dP, dP)
+
+        grad -= (x - PRIOR_MEAN) * prior_prec
+        info += np.diag(prior_prec)
+
+        if fix_c:
+            grad[:, 2] = 0.0
+            info[:, 2, :] = 0.0
+            info[:, :, 2] = 0.0
+            info[:, 2, 2] = 1.0
+
+        step = np.linalg.solve(info, grad[:, :, None])[:, :, 0]
+        x = np.clip(x + np.clip(step, -0.5, 0.5), PARAM_MIN, PARAM_MAX)
+
+    return x
+
+
+def initial_params(rm: ResponseMatrix, existing: dict) -> np.ndarray:
+    """
+    Giá trị khởi tạo: dùng QuestionIRT hiện có, nếu thiếu thì
+    a=1, c=0.2, b suy từ tỉ lệ đúng thô.
+    """
+    n = np.bincount(rm.item_idx, minlength=rm.n_items)
+    k = np.bincount(rm.item_idx, weights=rm.y.astype(float), minlength=rm.n_items)
+    p = np.clip((k + 0.5) / (n + 1.0), 0.05, 0.95)
+    b0 = -np.log(p / (1.0 - p))
+
+    params = np.column_stack([np.ones(rm.n_items), b0, np.full(rm.n_items, 0.2)])
+    for i, qid in enumerate(rm.question_ids):
+        a, b, c = existing.get(int(qid), (None, None, None))
+        if a is not None and b is not None and c is not None:
+            params[i] = (a, b, c)
+    return np.clip(params, PARAM_MIN, PARAM_MAX)
+
+
+def calibrate(
+    rm: ResponseMatrix,
+    params: np.ndarray,
+    *,
+    max_iter: int = 50,
+    tol: float = 1e-3,
+    chunk_persons: int = 2000,
+    workers: int = 1,
+    fix_c: bool = False,
+    log=None,
+) -> tuple[np.ndarray, int]:
+    """
+    MML-EM cho 3PL. Trả về (params, số vòng đã chạy).
+
+    log: callable(dict) nhận thống kê từng vòng (loglik, delta, thời gian E/M).
+    """
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        it = 0
+        for it in range(1, max_iter + 1):
+            t0 = time.perf_counter()
+            n_iq, r_iq, loglik = e_step(rm, params, chunk_persons, pool)
+            t1 = time.perf_counter()
+            new_params = m_step(params, n_iq, r_iq, fix_c=fix_c)
+            t2 = time.perf_counter()
+
+            delta = float(np.abs(new_params - params).max()) if len(params) else 0.0
+            params = new_params
+            if log is not None:
+                log({"iter": it, "loglik": loglik, "delta": delta,
+                     "e_sec": t1 - t0, "m_sec": t2 - t1})
+            if delta < tol:
+                break
+        return params, it
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+# === Calibration online: trôi dần tham số theo phản hồi mới ===
+ONLINE_CALIBRATION_DEFAULTS = {
+    "enabled": False,
+    "lr_b": 0.02,          # bước SGD cho b
+    "lr_a": 0.0,           # bước SGD cho a (0 = không cập nhật a)
+    "max_step": 0.1,       # kẹp |Δ| của một phản hồi
+    "flush_every": 500,    # flush khi buffer đủ chừng này phản hồi
+    "flush_seconds": 300,  # ... hoặc quá chừng này giây từ lần flush trước
+}
+
+
+class OnlineCalibrator:
+    """
+    Cập nhật SGD cho b (và tuỳ chọn a) của QuestionIRT theo từng phản hồi.
+
+    - Gradient tính tại θ hiện tại của người làm, với tham số "đang trôi"
+      (giá trị DB lúc ghi nhận + delta chưa flush).
+    - Delta gom trong bộ nhớ (mỗi process một buffer). Khi flush, mỗi câu 1
+      câu UPDATE cộng delta ngay trong DB (b = clamp(b + Δb)) -> nhiều process
+      flush cùng câu không ghi đè lẫn nhau; chi phí tỉ lệ với số câu có delta.
+    """
+
+    def __init__(self, lr_b=0.02, lr_a=0.0, max_step=0.1, flush_every=500, flush_seconds=300):
+        self.lr_b = lr_b
+        self.lr_a = lr_a
+        self.max_step = max_step
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+
+        self._lock = threading.Lock()
+        self._pending: dict[int, list] = {}  # {question_id: [Δa, Δb]}
+        self._n_pending = 0
+        self._last_flush = time.monotonic()
+
+    def record(self, question_id: int, a, b, c, theta: float, y: int) -> None:
+        """Ghi nhận 1 phản hồi; tự flush khi buffer đầy hoặc quá hạn."""
+        if a is None or b is None or c is None:
+            return
+
+        with self._lock:
+            delta = self._pending.setdefault(question_id, [0.0, 0.0])
+            a_cur, b_cur = a + delta[0], b + delta[1]
+
+            L = 1.0 / (1.0 + np.exp(-np.clip(a_cur * (theta - b_cur), -20.0, 20.0)))
+            P = float(np.clip(c + (1.0 - c) * L, 1e-6, 1.0 - 1e-6))
+            # dℓ/dP * dP/dz, với z = a(θ - b)
+            g = (y - P) / (P * (1.0 - P)) * (1.0 - c) * L * (1.0 - L)
+
+            step_b = float(np.clip(-self.lr_b * g * a_cur, -self.max_step, self.max_step))
+            step_a = float(np.clip(self.lr_a * g * (theta - b_cur), -self.max_step, self.max_step))
+            delta[0] += step_a
+            delta[1] += step_b
+            self._n_pending += 1
+
+            due = (
+                self._n_pending >= self.flush_every
+                or time.monotonic() - self._last_flush >= self.flush_seconds
+            )
+
+        if due:
+            self.flush()
+
+    def flush(self) -> int:
+        """Cộng delta đang chờ vào QuestionIRT (UPDATE theo F()). Trả về số câu đã ghi."""
+        from assessment.models import Question, QuestionIRT
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._n_pending = 0
+            self._last_flush = time.monotonic()
+
+        if not pending:
+            return 0
+
+        # Cộng delta ngay trong DB (b = clamp(b + Δb)) thay vì đọc - cộng - ghi đè:
+        # các process flush cùng câu không làm mất delta của nhau
+        written = 0
+        with transaction.atomic():
+            for question_id, (d_a, d_b) in pending.items():
+                n = 0
+                if d_b:
+                    n = QuestionIRT.objects.filter(question_id=question_id, b__isnull=False).update(
+                        b=_clamped(F("b") + d_b, 1),
+                    )
+                if d_a:
+                    n = QuestionIRT.objects.filter(question_id=question_id, a__isnull=False).update(
+                        a=_clamped(F("a") + d_a, 0),
+                    ) or n
+                written += bool(n)
+
+        # update() không bắn signal -> tự invalidate item bank các môn liên quan
+        subject_ids = (
+            Question.objects
+            .filter(id__in=pending.keys())
+            .values_list("subject_id", flat=True)
+            .distinct()
+        )
+        for subject_id in subject_ids:
+            bump_version(ITEM_BANK_VERSION, subject_id)
+        return written
+
+
+def _clamped(expr, k: int):
+    """Biểu thức SQL kẹp expr vào [PARAM_MIN[k], PARAM_MAX[k]]."""
+    return Greatest(Least(expr, Value(float(PARAM_MAX[k]))), Value(float(PARAM_MIN[k])))
+
+
+_online_calibrator: Optional[OnlineCalibrator] = None
+_online_lock = threading.Lock()
+
+
+def get_online_calibrator() -> Optional[OnlineCalibrator]:
+    """
+    Calibrator dùng chung trong process, cấu hình qua settings.IRT_ONLINE_CALIBRATION.
+    Trả về None nếu chế độ online đang tắt.
+    """
+    global _online_calibrator
+    conf = {**ONLINE_CALIBRATION_DEFAULTS, **getattr(settings, "IRT_ONLINE_CALIBRATION", {})}
+    if not conf.pop("enabled"):
+        return None
+
+    with _online_lock:
+        if _online_calibrator is None:
+            _online_calibrator = OnlineCalibrator(**conf)
+            # Không bỏ mất delta khi worker tắt
+            atexit.register(_online_calibrator.flush)
+    return _online_calibrator
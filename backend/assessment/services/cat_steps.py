@@ -0,0 +1,423 @@
+# assessment/services/cat_steps.py
+from __future__ import annotations
+from dataclasses import replace
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404
+from django.utils import timezone
+
+from assessment.services.ability import (
+    aload_profiles, apply_response_to_topics, apply_responses_to_topics, load_profiles,
+    save_profiles, widen_profiles,
+)
+from assessment.services.calibration import get_online_calibrator
+from assessment.services.exposure import invalidate_exposures
+from assessment.services.item_bank import get_item_bank
+from assessment.services.mastery import record_mastery
+from assessment.services.question_cache import get_question_payload
+from assessment.services.rules import evaluate_rules, select_next_item_id
+from assessment.services.session_state import (
+    CatSessionState, abuild_state, aload_state, build_state, drop_state, load_state, save_state,
+)
+from assessment.services.speculation import schedule_prefetch, take_prefetched
+from assessment.services.stopping import evaluate_stop, resolve_policy
+
+
+# Các bước của phiên CAT, dùng chung cho view DRF (WSGI) và view async (ASGI):
+#   - load_*:    đọc DB / cache (bản async dùng async ORM / cache, vẫn tuần tự)
+#   - compute_*: cập nhật năng lực trong bộ nhớ, luật, chọn câu, payload câu
+#   - commit_*:  ghi bước trong transaction ngắn (CAS trên TestSession.version)
+
+
+def answer_retries() -> int:
+    return int(getattr(settings, "CAT_ANSWER_RETRIES", 3))
+
+
+# -------- 1) Bắt đầu phiên --------
+def pick_first_item(session, state: CatSessionState) -> Tuple[Optional[int], Optional[dict]]:
+    """Chọn câu đầu tiên: (id câu, payload) hoặc (None, None) nếu môn không có câu phù hợp."""
+    # Chỉ mục câu đã gặp gần đây (luật exposure_cooldown) nạp lại cho phiên mới
+    invalidate_exposures(session.student_id, session.subject_id)
+    # Context rule chung (mastery, cooldown, …)
+    rule_ctx = evaluate_rules(
+        student_id=session.student_id,
+        subject_id=session.subject_id,
+        ability_vector=state.abilities,
+        mastery=state.mastery_ratios(),
+    )
+    next_qid = select_next_item_id(
+        ability_vector=state.abilities,
+        avg_theta=state.avg_theta,
+        subject_id=session.subject_id,
+        used_q_ids=set(),
+        rule_ctx=rule_ctx,
+        position_in_session=1,
+        topic_ids=state.topic_ids(),  # lock theo topic nếu có
+    )
+    # Payload câu lấy từ cache đã serialize (không query Question + options)
+    next_q_data = get_question_payload(next_qid) if next_qid is not None else None
+    if next_q_data is None:
+        return None, None
+    return next_qid, next_q_data
+
+
+def commit_first_item(session, state: CatSessionState, next_qid: int) -> None:
+    from assessment.models import TestItem
+
+    TestItem.objects.create(session_id=session.id, question_id=next_qid, position=1)
+    state.used_ids.append(next_qid)
+    save_state(state)
+    schedule_prefetch(session.id, next_qid)
+
+
+# -------- 2) Đọc đầu vào của 1 bước trả lời --------
+def _option_query(d):
+    from assessment.models import QuestionOption
+
+    return (
+        QuestionOption.objects
+        .filter(id=d["option_id"], question_id=d["question_id"])
+        .values_list("id", "is_correct")
+    )
+
+
+def load_answer_inputs(session, d):
+    """(state, option, profiles) cho 1 bước: profile cả môn, trạng thái phiên, đáp án chọn."""
+    # Toàn bộ profile năng lực của môn: 1 query, cập nhật trong bộ nhớ,
+    # ghi lại bằng 1 câu upsert lúc commit
+    profiles = load_profiles(session.student_id, session.subject_id)
+
+    # Trạng thái phiên từ cache; thiếu hoặc cũ hơn version trong DB -> dựng lại
+    state = load_state(session.id)
+    if state is None or state.version != session.version:
+        state = build_state(session, profiles=profiles)
+    return state, _option_query(d).first(), profiles
+
+
+async def aload_answer_inputs(session, d):
+    """
+    Như load_answer_inputs. Async ORM / cache của Django chạy qua sync_to_async
+    thread-sensitive (chung 1 thread) nên các lookup vẫn lần lượt: chỉ không
+    chặn event loop, không nhanh hơn bản sync.
+    """
+    profiles = await aload_profiles(session.student_id, session.subject_id)
+    state = await aload_state(session.id)
+    opt = await _option_query(d).afirst()
+    if state is None or state.version != session.version:
+        state = await abuild_state(session, profiles=profiles)
+    return state, opt, profiles
+
+
+# -------- 3) Tính bước trả lời (không giữ transaction / lock) --------
+def compute_answer_step(
+    session,
+    d,
+    state: CatSessionState,
+    opt,
+    profiles: Dict[int, object],
+) -> Optional[dict]:
+    """
+    Phần nặng của 1 bước: cập nhật năng lực trong bộ nhớ, luật, chọn câu,
+    payload câu. Trả về None nếu câu không phải câu đang chờ trả lời (đã được
+    trả lời bởi request trước, hoặc chưa từng được phát trong phiên).
+    """
+    qid = d["question_id"]
+    if state.current_question_id != qid:
+        return None
+    if opt is None:
+        raise Http404("Không tìm thấy đáp án cho câu hỏi này.")
+    is_correct = bool(opt[1])
+    y = 1 if is_correct else 0
+
+    # Tham số IRT + topic của câu lấy từ item bank trong bộ nhớ (không query)
+    bank = get_item_bank(session.subject_id)
+    irt = bank.irt_of(qid)
+    question_topic_ids = bank.topics.topics_of(qid)
+
+    # Câu đầu tiên của phiên: nới posterior đã lưu thêm phương sai trôi giữa 2 phiên
+    widened = widen_profiles(profiles) if state.position == 1 else []
+
+    # Cập nhật IRT cho từng topic: cộng phản hồi vào posterior đã lưu
+    # (ước lượng trên toàn bộ lịch sử, chi phí cố định mỗi câu).
+    # Câu chưa calibrate không cập nhật posterior -> không có θ trước (không tính Δθ)
+    prior_thetas = (
+        [profiles[tid].theta if tid in profiles else 0.0 for tid in question_topic_ids]
+        if irt is not None else []
+    )
+    changed = _merge_profiles(
+        widened, apply_response_to_topics(profiles, session.student_id, question_topic_ids, irt, y),
+    )
+    mastery_existing = state.add_mastery(question_topic_ids, y)
+
+    response = {
+        "question_id": qid,
+        "option_id": opt[0],
+        "is_correct": is_correct,
+        "y": y,
+        "latency_ms": d.get("latency_ms"),
+        "irt": irt,
+        "topic_ids": question_topic_ids,
+        "prior_thetas": prior_thetas,
+        "mastery_existing": mastery_existing,
+    }
+    step = _finish_step(session, state, profiles, changed, [response])
+    step["payload"] = {"is_correct": is_correct, **step["payload"]}
+    return step
+
+
+def _merge_profiles(widened, changed) -> list:
+    """Các profile cần ghi của bước: đã nới (câu đầu phiên) + đã cập nhật, mỗi topic 1 lần."""
+    return list({p.topic_id: p for p in (*widened, *changed)}.values())
+
+
+def _finish_step(session, state: CatSessionState, profiles, changed, responses) -> dict:
+    """
+    Phần chung của bước trả lời (1 câu hay cả lô): quyết định dừng theo luật
+    dừng của phiên, chọn câu kế tiếp, dựng payload.
+    """
+    last = responses[-1]
+    qid, y = last["question_id"], last["y"]
+
+    state.abilities.update({tid: p.theta for tid, p in profiles.items()})
+    # Vector năng lực sau khi update: lấy từ trạng thái trong bộ nhớ
+    full_ability_vector = dict(state.abilities)
+    avg_theta = state.avg_theta
+
+    # Luật dừng (services/stopping.py), tính từ profile trong bộ nhớ + bộ đếm của state
+    prior = {}
+    for r in responses:
+        # prior_thetas rỗng = câu không cập nhật posterior (chưa calibrate)
+        for tid, th in zip(r["topic_ids"], r["prior_thetas"]):
+            prior.setdefault(tid, th)  # θ trước cả bước
+    item_count = state.position
+    decision = evaluate_stop(
+        resolve_policy(session.stopping_policy),
+        n_items=item_count,
+        target_items=session.target_items,
+        thetas=full_ability_vector,
+        ses={tid: p.se for tid, p in profiles.items()},
+        prior_thetas=prior,
+        answered_topic_ids=last["topic_ids"],
+        session_topic_id=session.topic_id,
+        stable_steps=state.stable_steps,
+    )
+    state.stable_steps = decision.stable_steps
+    stop = decision.stop
+
+    next_qid = None
+    next_q_data = None
+    if not stop:
+        used_ids = set(state.used_ids)
+
+        # Câu đã tính trước cho nhánh này (nếu bật speculative và trạng thái không đổi)
+        spec_qid = take_prefetched(
+            session.id, qid, y,
+            subject_id=session.subject_id,
+            ability_vector=full_ability_vector,
+            position=item_count,
+        )
+        if spec_qid is not None and spec_qid not in used_ids:
+            next_qid = spec_qid
+
+        if next_qid is None:
+            rule_ctx = evaluate_rules(
+                student_id=session.student_id,
+                subject_id=session.subject_id,
+                ability_vector=full_ability_vector,
+                mastery=state.mastery_ratios(),
+            )
+
+            next_qid = select_next_item_id(
+                ability_vector=full_ability_vector,
+                avg_theta=avg_theta,
+                subject_id=session.subject_id,
+                used_q_ids=used_ids,
+                rule_ctx=rule_ctx,
+                position_in_session=item_count + 1,
+                topic_ids=state.topic_ids(),  # giữ topic cố định của phiên (nếu có)
+            )
+
+        # Payload câu từ cache đã serialize; câu vừa bị xoá -> coi như hết câu
+        if next_qid is not None:
+            next_q_data = get_question_payload(next_qid)
+        if next_q_data is None:
+            next_qid = None
+            stop = True
+            decision = replace(decision, stop=True, reason="no_items")
+
+    return {
+        "responses": responses,
+        "profiles": changed,
+        "state": state,
+        "next_qid": next_qid,
+        "stop": stop,
+        "payload": {
+            "ability_vector": full_ability_vector,
+            "next_question": next_q_data,
+            "stop": stop,
+            "current_position": item_count,
+            "target_items": session.target_items,
+            "stop_reason": decision.reason,
+            "classification": decision.classification,
+        },
+    }
+
+
+# -------- 4) Nộp cả lô đáp án (client mất mạng rồi kết nối lại) --------
+def load_batch_inputs(session, answers):
+    """
+    (state, options, profiles, answered) cho 1 lô: như load_answer_inputs, thêm
+    {option_id: (question_id, is_correct)} và tập câu đã có TestResponse.
+    """
+    from assessment.models import QuestionOption, TestResponse
+
+    profiles = load_profiles(session.student_id, session.subject_id)
+    state = load_state(session.id)
+    if state is None or state.version != session.version:
+        state = build_state(session, profiles=profiles)
+    options = {
+        oid: (qid, is_correct)
+        for oid, qid, is_correct in QuestionOption.objects
+        .filter(id__in=[a["option_id"] for a in answers])
+        .values_list("id", "question_id", "is_correct")
+    }
+    answered = set(
+        TestResponse.objects.filter(session_id=session.id).values_list("question_id", flat=True)
+    )
+    return state, options, profiles, answered
+
+
+def compute_batch_step(session, answers, state: CatSessionState, options, profiles, answered):
+    """
+    Áp 1 lô đáp án theo thứ tự cho các câu đã phát của phiên.
+
+    Câu đã có phản hồi (request trước đó thực ra đã tới server) được bỏ qua để
+    client gửi lại an toàn. Vì CAT chỉ phát câu kế tiếp sau khi có đáp án, các
+    câu còn lại chỉ có thể là câu đang chờ (tối đa 1); nó được cộng vào năng lực
+    rồi chọn câu kế tiếp như bước đơn, payload có "current_position" cùng nghĩa.
+    Trả về None nếu không còn câu nào cần ghi (caller trả lại trạng thái hiện tại).
+    """
+    from rest_framework.exceptions import ValidationError
+
+    served = set(state.used_ids)
+    qids = [a["question_id"] for a in answers]
+    if len(set(qids)) != len(qids):
+        raise ValidationError({"answers": "Mỗi câu chỉ được trả lời 1 lần trong lô."})
+    not_served = [qid for qid in qids if qid not in served]
+    if not_served:
+        raise ValidationError({"answers": f"Các câu chưa được phát trong phiên: {not_served}"})
+    for a in answers:
+        if options.get(a["option_id"], (None,))[0] != a["question_id"]:
+            raise Http404(f"Không tìm thấy đáp án cho câu hỏi {a['question_id']}.")
+
+    pending = [a for a in answers if a["question_id"] not in answered]
+    if not pending:
+        return None
+
+    bank = get_item_bank(session.subject_id)
+    # Lô chứa câu đầu tiên của phiên: nới posterior như compute_answer_step
+    widened = widen_profiles(profiles) if not answered else []
+    prior = {tid: p.theta for tid, p in profiles.items()}
+    responses, items = [], []
+    for a in pending:
+        qid = a["question_id"]
+        is_correct = bool(options[a["option_id"]][1])
+        y = 1 if is_correct else 0
+        irt = bank.irt_of(qid)
+        topic_ids = bank.topics.topics_of(qid)
+        items.append((topic_ids, irt, y))
+        responses.append({
+            "question_id": qid,
+            "option_id": a["option_id"],
+            "is_correct": is_correct,
+            "y": y,
+            "latency_ms": a.get("latency_ms"),
+            "irt": irt,
+            "topic_ids": topic_ids,
+            # θ trước cả lô (Δθ của luật dừng, calibration online); câu chưa calibrate: không có
+            "prior_thetas": [prior.get(tid, 0.0) for tid in topic_ids] if irt is not None else [],
+            # Mastery suy giảm phụ thuộc thứ tự -> cộng lần lượt
+            "mastery_existing": state.add_mastery(topic_ids, y),
+        })
+
+    # 1 lượt cập nhật năng lực cho cả lô
+    changed = _merge_profiles(widened, apply_responses_to_topics(profiles, session.student_id, items))
+
+    step = _finish_step(session, state, profiles, changed, responses)
+    step["payload"] = {
+        "results": [{"question_id": r["question_id"], "is_correct": r["is_correct"]} for r in responses],
+        "skipped_question_ids": [a["question_id"] for a in answers if a["question_id"] in answered],
+        **step["payload"],
+    }
+    return step
+
+
+# -------- 5) Ghi bước trả lời --------
+def commit_answer_step(session, step) -> bool:
+    """
+    Ghi 1 bước trong transaction ngắn. CAS trên version: False nếu phiên đã
+    bị request khác ghi trước (không ghi gì, caller tính lại).
+    """
+    from assessment.models import TestItem, TestResponse, TestSession
+
+    state = step["state"]
+    next_qid, stop = step["next_qid"], step["stop"]
+
+    with transaction.atomic():
+        fields = {"version": F("version") + 1}
+        if stop:
+            fields.update(status="FINISHED", finished_at=timezone.now())
+        updated = (
+            TestSession.objects
+            .filter(id=session.id, version=session.version, status="ONGOING")
+            .update(**fields)
+        )
+        if not updated:
+            return False
+
+        save_profiles(step["profiles"])
+
+        for r in step["responses"]:
+            # Mastery theo topic (bộ đếm suy giảm, rule topic_mastery_below đọc lại)
+            record_mastery(session.student_id, r["topic_ids"], r["y"], existing=r["mastery_existing"])
+
+        TestResponse.objects.bulk_create([
+            TestResponse(
+                session_id=session.id,
+                question_id=r["question_id"],
+                option_id=r["option_id"],
+                is_correct=r["is_correct"],
+                latency_ms=r["latency_ms"],
+            )
+            for r in step["responses"]
+        ])
+
+        state.version = session.version + 1
+        if next_qid is not None:
+            TestItem.objects.create(
+                session_id=session.id,
+                question_id=next_qid,
+                position=state.position + 1,
+            )
+            state.used_ids.append(next_qid)
+            save_state(state)
+            schedule_prefetch(session.id, next_qid)
+        if stop:
+            drop_state(session.id)
+
+        # Calibration online (nếu bật): cho b/a của câu trôi theo θ của người làm
+        # trước khi cập nhật; chỉ ghi nhận khi transaction commit thành công.
+        calibrator = get_online_calibrator()
+        if calibrator is not None:
+            for r in step["responses"]:
+                if r["irt"] is None or not r["prior_thetas"]:
+                    continue
+                theta_resp = sum(r["prior_thetas"]) / len(r["prior_thetas"])
+                transaction.on_commit(
+                    lambda qid=r["question_id"], irt=r["irt"], theta_resp=theta_resp, y=r["y"]:
+                    calibrator.record(qid, *irt, theta_resp, y)
+                )
+    return True
@@ -0,0 +1,96 @@
+# assessment/services/exposure.py
+from __future__ import annotations
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Set
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+
+# Chỉ mục "câu đã gặp gần đây" theo (học sinh, môn) cho luật exposure_cooldown.
+# Mỗi ngày 1 bucket trong cache (set question_id), tự hết hạn sau cửa sổ tối đa.
+# Marker "warm" đánh dấu các bucket đã được nạp từ SQL; thiếu marker (chưa từng
+# nạp / cache bị xoá / invalidate_exposures) -> backfill 1 query rồi dùng tiếp từ cache.
+# Bucket chỉ được ghi bởi backfill (không get-sửa-set theo từng phản hồi, vốn mất
+# câu khi 2 request ghi cùng lúc): đầu mỗi phiên xoá marker; trong phiên, câu đã
+# làm đã bị loại qua used_ids nên chỉ mục không cần cập nhật theo từng câu.
+DEFAULT_EXPOSURE_WINDOW_DAYS = 30
+WARM_TTL = 24 * 60 * 60
+
+
+def exposure_window_days() -> int:
+    return int(getattr(settings, "EXPOSURE_WINDOW_DAYS", DEFAULT_EXPOSURE_WINDOW_DAYS))
+
+
+def _bucket_key(student_id, subject_id, day: date) -> str:
+    return f"cat:exp:{student_id}:{subject_id}:{day.isoformat()}"
+
+
+def _warm_key(student_id, subject_id) -> str:
+    return f"cat:exp:{student_id}:{subject_id}:warm"
+
+
+def _bucket_ttl(day: date, today: date) -> int:
+    """Bucket sống tới hết cửa sổ tối đa tính từ ngày của nó."""
+    days_left = exposure_window_days() - (today - day).days + 1
+    return max(days_left, 1) * 24 * 60 * 60
+
+
+def _backfill(student_id, subject_id, today: date) -> None:
+    from assessment.models import TestResponse
+
+    window = exposure_window_days()
+    since = today - timedelta(days=window)
+    buckets = defaultdict(set)
+    for qid, answered_at in (
+        TestResponse.objects
+        .filter(
+            session__student_id=student_id,
+            session__subject_id=subject_id,
+            answered_at__date__gte=since,
+        )
+        .values_list("question_id", "answered_at")
+    ):
+        buckets[timezone.localdate(answered_at)].add(qid)
+
+    for day, qids in buckets.items():
+        cache.set(_bucket_key(student_id, subject_id, day), qids, _bucket_ttl(day, today))
+    cache.set(_warm_key(student_id, subject_id), True, WARM_TTL)
+
+
+def recent_exposures(student_id: int, subject_id: int, days: int) -> Set[int]:
+    """
+    Các câu học sinh đã trả lời trong môn trong `days` ngày gần nhất
+    (tính theo ngày: gồm cả hôm nay và ngày thứ `days` trước đó).
+    """
+    from assessment.models import TestResponse
+
+    today = timezone.localdate()
+    if days > exposure_window_days():
+        # Ngoài cửa sổ cache -> query trực tiếp
+        since = timezone.now() - timedelta(days=days)
+        return set(
+            TestResponse.objects
+            .filter(
+                answered_at__gte=since,
+                session__subject_id=subject_id,
+                session__student_id=student_id,
+            )
+            .values_list("question_id", flat=True)
+        )
+
+    if not cache.get(_warm_key(student_id, subject_id)):
+        _backfill(student_id, subject_id, today)
+
+    keys = [_bucket_key(student_id, subject_id, today - timedelta(days=d)) for d in range(days + 1)]
+    out: Set[int] = set()
+    for qids in cache.get_many(keys).values():
+        out |= qids
+    return out
+
+
+def invalidate_exposures(student_id: int, subject_id: int) -> None:
+    """Đầu phiên mới: lần đọc tới backfill lại từ SQL (gồm mọi phản hồi của các phiên trước)."""
+    cache.delete(_warm_key(student_id, subject_id))
@@ -0,0 +1,86 @@
+# assessment/services/idempotency.py
+from __future__ import annotations
+from typing import Any, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Chống request trùng cho bước trả lời CAT (double-click, client retry).
+# Mỗi bước có 1 khoá: request_id client gửi (header Idempotency-Key hoặc field
+# request_id), không có thì suy ra từ (session, question) vì mỗi câu chỉ được
+# trả lời 1 lần. Trong cache:
+#   - marker "pending" (cache.add, nguyên tử) khi bước đang chạy -> request trùng
+#     nhận 409 ngay, không xếp hàng sau CAS / không chạy lại cập nhật năng lực
+#   - kết quả bước khi xong (TTL ngắn) -> request lặp lại nhận đúng kết quả cũ,
+#     không chạm DB
+DEFAULT_RESULT_TTL = 10 * 60
+DEFAULT_PENDING_TTL = 30
+
+NEW = "new"
+REPLAY = "replay"
+IN_FLIGHT = "in_flight"
+MISMATCH = "mismatch"
+
+
+def _result_ttl() -> int:
+    return int(getattr(settings, "CAT_IDEMPOTENCY_TTL", DEFAULT_RESULT_TTL))
+
+
+def _pending_ttl() -> int:
+    return int(getattr(settings, "CAT_IDEMPOTENCY_PENDING_TTL", DEFAULT_PENDING_TTL))
+
+
+def step_key(session_id, request_id: Optional[str] = None, question_id: Optional[int] = None) -> str:
+    """Khoá cache của 1 bước: theo request_id nếu có, không thì theo câu."""
+    scope = f"r:{request_id}" if request_id else f"q:{question_id}"
+    return f"cat:idem:{session_id}:{scope}"
+
+
+def _outcome(entry, fingerprint) -> Tuple[str, Any]:
+    if entry.get("fingerprint") != fingerprint:
+        return MISMATCH, None
+    if entry["status"] == "done":
+        return REPLAY, entry["result"]
+    return IN_FLIGHT, None
+
+
+def begin_step(key: str, fingerprint) -> Tuple[str, Any]:
+    """
+    Đánh dấu bước bắt đầu. Trả về (NEW, None) nếu được chạy; (REPLAY, kết quả cũ);
+    (IN_FLIGHT, None) nếu request giống hệt đang chạy; (MISMATCH, None) nếu khoá
+    đã dùng cho nội dung khác (vd: cùng câu nhưng đáp án khác).
+    """
+    pending = {"status": "pending", "fingerprint": fingerprint}
+    if cache.add(key, pending, _pending_ttl()):
+        return NEW, None
+    entry = cache.get(key)
+    if entry is None:
+        # Vừa hết hạn / bị xoá giữa add và get -> thử giành lại 1 lần
+        return (NEW, None) if cache.add(key, pending, _pending_ttl()) else (IN_FLIGHT, None)
+    return _outcome(entry, fingerprint)
+
+
+def finish_step(key: str, fingerprint, result: Optional[Any]) -> None:
+    """Lưu kết quả bước (result=None: bước không thành công -> bỏ marker để client thử lại)."""
+    if result is None:
+        cache.delete(key)
+    else:
+        cache.set(key, {"status": "done", "fingerprint": fingerprint, "result": result}, _result_ttl())
+
+
+async def abegin_step(key: str, fingerprint) -> Tuple[str, Any]:
+    pending = {"status": "pending", "fingerprint": fingerprint}
+    if await cache.aadd(key, pending, _pending_ttl()):
+        return NEW, None
+    entry = await cache.aget(key)
+    if entry is None:
+        return (NEW, None) if await cache.aadd(key, pending, _pending_ttl()) else (IN_FLIGHT, None)
+    return _outcome(entry, fingerprint)
+
+
+async def afinish_step(key: str, fingerprint, result: Optional[Any]) -> None:
+    if result is None:
+        await cache.adelete(key)
+    else:
+        await cache.aset(key, {"status": "done", "fingerprint": fingerprint, "result": result}, _result_ttl())
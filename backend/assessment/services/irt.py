@@ -1,5 +1,7 @@
 import math
 
+import numpy as np
+
 
 def p_3pl(theta: float, a: float, b: float, c: float) -> float:
     """
@@ -45,6 +47,62 @@ def fisher_info(theta: float, a: float, b: float, c: float) -> float:
     return (dp * dp) / (p * q)
 
 
+def _as_float_array(x) -> np.ndarray:
+    """Ép về mảng float; None -> NaN (coi như chưa calibrate)."""
+    if isinstance(x, np.ndarray) and x.dtype.kind == "f":
+        return x
+    return np.asarray(np.where(np.equal(x, None), np.nan, x), dtype=float)
+
+
+def p_3pl_batch(theta, a, b, c) -> np.ndarray:
+    """
+    Phiên bản vector hoá của p_3pl cho cả ngân hàng câu.
+
+    theta: scalar hoặc mảng (mỗi câu một theta), broadcast với a, b, c.
+    Câu thiếu a/b/c (None/NaN) -> 0.5 như bản scalar.
+    """
+    theta = _as_float_array(theta)
+    a = _as_float_array(a)
+    b = _as_float_array(b)
+    c = _as_float_array(c)
+
+    missing = np.isnan(a) | np.isnan(b) | np.isnan(c)
+
+    # Cùng ngưỡng kẹp |z| > 20 như p_3pl
+    with np.errstate(invalid="ignore", over="ignore"):
+        z = a * (theta - b)
+        L = 1.0 / (1.0 + np.exp(-np.clip(z, -20.0, 20.0)))
+        L = np.where(z > 20, 1.0, np.where(z < -20, 0.0, L))
+        p = c + (1.0 - c) * L
+
+    return np.where(missing, 0.5, p)
+
+
+def fisher_info_batch(theta, a, b, c) -> np.ndarray:
+    """
+    Phiên bản vector hoá của fisher_info.
+
+    Giữ nguyên các ngưỡng của bản scalar: thiếu tham số, p/q <= 1e-6
+    hoặc (1 - c) <= 1e-6 -> 0.0.
+    """
+    a = _as_float_array(a)
+    b = _as_float_array(b)
+    c = _as_float_array(c)
+
+    p = p_3pl_batch(theta, a, b, c)
+    q = 1.0 - p
+
+    missing = np.isnan(a) | np.isnan(b) | np.isnan(c)
+    invalid = missing | (p <= 1e-6) | (q <= 1e-6) | ((1.0 - c) <= 1e-6)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        d = (p - c) / (1.0 - c)
+        dp = (1.0 - c) * a * d * (1.0 - d)
+        info = (dp * dp) / (p * q)
+
+    return np.where(invalid, 0.0, info)
+
+
 def update_theta_newton(
     theta0: float,
     responses: list,
@@ -139,3 +197,100 @@ def update_theta_newton(
 
     se = (1.0 / math.sqrt(info)) if info > 1e-8 else 1.0
     return theta, se
+
+
+# === EAP: posterior trên lưới θ cố định ===
+# Lưới quadrature dùng chung; posterior lưu ở dạng log để cộng dồn ổn định.
+THETA_GRID = np.linspace(-4.0, 4.0, 81)
+
+
+def eap_log_prior(mean: float = 0.0, sd: float = 1.0) -> np.ndarray:
+    """Log prior N(mean, sd^2) trên THETA_GRID (chưa chuẩn hoá)."""
+    sd = sd if sd and sd > 1e-6 else 1.0
+    z = (THETA_GRID - mean) / sd
+    return -0.5 * z * z
+
+
+def eap_update(log_post, a, b, c, y) -> np.ndarray:
+    """
+    Cập nhật log-posterior với một (hoặc nhiều) phản hồi mới.
+
+    Mỗi phản hồi chỉ là một phép cộng log-likelihood trên lưới (tương đương
+    nhân likelihood vào posterior), không lặp Newton.
+    a, b, c, y: scalar hoặc mảng cùng độ dài; câu thiếu tham số bị bỏ qua.
+    """
+    log_post = np.asarray(log_post, dtype=float)
+    a = np.atleast_1d(_as_float_array(a))
+    b = np.atleast_1d(_as_float_array(b))
+    c = np.atleast_1d(_as_float_array(c))
+    y = np.atleast_1d(np.asarray(y, dtype=float))
+
+    ok = ~(np.isnan(a) | np.isnan(b) | np.isnan(c))
+    if not ok.any():
+        return log_post
+
+    # P[k, j] = P(đúng câu k | θ_j)
+    p = p_3pl_batch(THETA_GRID[None, :], a[ok, None], b[ok, None], c[ok, None])
+    p = np.clip(p, 1e-9, 1.0 - 1e-9)
+    yk = y[ok, None]
+    loglik = (yk * np.log(p) + (1.0 - yk) * np.log1p(-p)).sum(axis=0)
+
+    out = log_post + loglik
+    # Trừ max để giá trị không trôi dần về -inf sau nhiều câu
+    return out - out.max()
+
+
+def eap_widen(log_post, drift_sd: float) -> np.ndarray:
+    """
+    Nới posterior thêm phương sai trôi drift_sd^2 (năng lực có thể đã đổi giữa 2 phiên).
+
+    Nhân log-posterior với k = σ²/(σ² + drift²): với posterior gần chuẩn, SD mới
+    là sqrt(σ² + drift²), θ_EAP giữ nguyên. drift_sd <= 0 -> không đổi.
+    """
+    log_post = np.asarray(log_post, dtype=float)
+    if not drift_sd or drift_sd <= 0:
+        return log_post
+    _, se = eap_estimate(log_post)
+    var = se * se
+    if var <= 1e-12:
+        return log_post
+    out = log_post * (var / (var + drift_sd * drift_sd))
+    return out - out.max()
+
+
+def eap_estimate(log_post) -> tuple[float, float]:
+    """
+    Trả về (θ_EAP, posterior SD) từ log-posterior trên THETA_GRID.
+
+    Luôn xác định kể cả khi toàn đúng / toàn sai (posterior vẫn hữu hạn nhờ prior).
+    """
+    log_post = np.asarray(log_post, dtype=float)
+    w = np.exp(log_post - log_post.max())
+    w /= w.sum()
+    theta = float(np.dot(w, THETA_GRID))
+    var = float(np.dot(w, (THETA_GRID - theta) ** 2))
+    return theta, math.sqrt(max(var, 0.0))
+
+
+def estimate_theta_eap(
+    responses: list,
+    prior_mean: float = 0.0,
+    prior_sd: float = 1.0,
+) -> tuple[float, float]:
+    """
+    EAP cho cả danh sách phản hồi (cùng định dạng với update_theta_newton).
+
+    Trả về:
+      - theta: kỳ vọng posterior
+      - se: độ lệch chuẩn posterior
+    """
+    log_post = eap_log_prior(prior_mean, prior_sd)
+    if responses:
+        log_post = eap_update(
+            log_post,
+            [r["a"] for r in responses],
+            [r["b"] for r in responses],
+            [r["c"] for r in responses],
+            [r["y"] for r in responses],
+        )
+    return eap_estimate(log_post)
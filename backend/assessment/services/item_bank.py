@@ -0,0 +1,298 @@
+# assessment/services/item_bank.py
+from __future__ import annotations
+from typing import Dict, Iterable, Optional
+import threading
+
+import numpy as np
+
+from assessment.services.topic_index import (
+    QUESTION_TOPICS_VERSION,
+    QuestionTopicCSR,
+    build_question_topics,
+    get_question_topics,
+)
+from assessment.services.versioning import get_version, local_version
+
+
+ITEM_BANK_VERSION = "item_bank"
+
+# Lưới θ cho bảng thông tin dựng sẵn (bước 0.25) và độ dài shortlist mỗi ô
+INFO_GRID = np.linspace(-4.0, 4.0, 33)
+SHORTLIST_SIZE = 20
+UNTAGGED = -1  # scope shortlist cho câu không gắn topic
+# Pool ứng viên nhỏ hơn ngưỡng này thì quét pool nhanh hơn gộp shortlist
+# (bench_cat_selection: hoà vốn giữa 5000 và 20000 câu)
+SHORTLIST_MIN_POOL = 10000
+
+
+class ItemBankIndex:
+    """
+    Ngân hàng câu của 1 môn ở dạng mảng liên tục, dùng cho chọn câu CAT.
+
+    - question_ids: id câu (tăng dần) -> vị trí i trong mọi mảng khác
+    - a, b, c: tham số IRT (NaN nếu chưa calibrate)
+    - topics: quan hệ câu ↔ topic dạng CSR, cùng thứ tự hàng với question_ids
+      (cache riêng, chỉ build lại khi QuestionTag đổi)
+    """
+
+    def __init__(self, subject_id, version, question_ids, a, b, c, topics: QuestionTopicCSR):
+        self.subject_id = subject_id
+        self.version = version
+        self.question_ids = question_ids
+        self.a = a
+        self.b = b
+        self.c = c
+        self.topics = topics
+        self.calibrated = ~(np.isnan(a) | np.isnan(b) | np.isnan(c))
+        # {scope: (len(INFO_GRID), SHORTLIST_SIZE) vị trí câu, -1 = trống}; build lười
+        self._shortlists: Dict[int, np.ndarray] = {}
+
+    def with_topics(self, topics: QuestionTopicCSR) -> "ItemBankIndex":
+        """Cùng tham số IRT, chỉ thay quan hệ topic (shortlist tính lại lười)."""
+        return ItemBankIndex(
+            self.subject_id, self.version, self.question_ids, self.a, self.b, self.c, topics,
+        )
+
+    @property
+    def topic_ids(self) -> np.ndarray:
+        """Các topic có câu trong môn (tăng dần)."""
+        return self.topics.topic_ids
+
+    def __len__(self) -> int:
+        return len(self.question_ids)
+
+    def positions_of(self, question_ids: Iterable[int]) -> np.ndarray:
+        """Vị trí trong index của các id (id không có trong môn bị bỏ qua)."""
+        ids = np.fromiter(question_ids, dtype=np.int64)
+        if not len(ids) or not len(self.question_ids):
+            return np.empty(0, dtype=np.int64)
+        pos = np.searchsorted(self.question_ids, ids)
+        pos = np.minimum(pos, len(self.question_ids) - 1)
+        return pos[self.question_ids[pos] == ids]
+
+    def irt_of(self, question_id: int) -> Optional[tuple]:
+        """(a, b, c) của câu, None nếu câu không thuộc môn hoặc chưa calibrate."""
+        pos = self.positions_of([question_id])
+        if not len(pos) or not self.calibrated[pos[0]]:
+            return None
+        i = int(pos[0])
+        return float(self.a[i]), float(self.b[i]), float(self.c[i])
+
+    def exclude_mask(self, question_ids: Iterable[int]) -> np.ndarray:
+        """Mask True cho các câu KHÔNG nằm trong question_ids."""
+        mask = np.ones(len(self), dtype=bool)
+        mask[self.positions_of(question_ids)] = False
+        return mask
+
+    def topic_columns(self, topic_ids: Iterable[int]) -> np.ndarray:
+        """Cột topic trong CSR ứng với các topic_ids (topic ngoài môn bị bỏ qua)."""
+        return self.topics.columns_of(topic_ids)
+
+    def topic_mask(self, topic_ids: Iterable[int]) -> np.ndarray:
+        """Mask True cho câu thuộc ít nhất 1 topic trong topic_ids."""
+        return self.topics.rows_with_any(self.topic_columns(topic_ids))
+
+    def topic_positions(self, topic_ids: Iterable[int]) -> np.ndarray:
+        """Vị trí các câu thuộc ít nhất 1 topic trong topic_ids (pool theo topic, đã cache)."""
+        return self.topics.columns_rows(self.topic_columns(topic_ids))
+
+    def b_range_mask(self, b_min: Optional[float], b_max: Optional[float]) -> np.ndarray:
+        """Mask lọc độ khó như filter irt__b__gte / irt__b__lte (b thiếu -> loại)."""
+        mask = np.ones(len(self), dtype=bool)
+        with np.errstate(invalid="ignore"):
+            if b_min is not None:
+                mask &= self.b >= float(b_min)
+            if b_max is not None:
+                mask &= self.b <= float(b_max)
+        return mask
+
+    def filter_positions(
+        self,
+        idx: np.ndarray,
+        exclude_ids: Iterable[int] = (),
+        topic_ids: Optional[Iterable[int]] = None,
+        b_range: Optional[tuple] = None,
+        exclude_topic_ids: Optional[Iterable[int]] = None,
+    ) -> np.ndarray:
+        """
+        Lọc một tập vị trí nhỏ (vd: shortlist) theo cùng điều kiện với các mask
+        toàn cục, nhưng chi phí chỉ tỉ lệ với len(idx).
+        exclude_topic_ids: loại câu gắn bất kỳ topic nào trong đó.
+        """
+        if not len(idx):
+            return idx
+        exclude = np.fromiter(exclude_ids, dtype=np.int64)
+        keep = np.ones(len(idx), dtype=bool)
+        if len(exclude):
+            keep &= ~np.isin(self.question_ids[idx], exclude)
+        if topic_ids is not None:
+            keep &= self.topics.rows_with_any(self.topic_columns(topic_ids), idx)
+        if exclude_topic_ids:
+            keep &= ~self.topics.rows_with_any(self.topic_columns(exclude_topic_ids), idx)
+        if b_range is not None:
+            b_min, b_max = b_range
+            with np.errstate(invalid="ignore"):
+                if b_min is not None:
+                    keep &= self.b[idx] >= float(b_min)
+                if b_max is not None:
+                    keep &= self.b[idx] <= float(b_max)
+        return idx[keep]
+
+    def item_thetas(self, ability_vector: Dict[int, float], avg_theta: float, idx=None) -> np.ndarray:
+        """
+        Theta cho từng câu = trung bình theta các topic của câu (topic có theta).
+        Câu không có topic / không topic nào có theta -> avg_theta.
+        idx: chỉ tính cho các vị trí này (mặc định: toàn bộ).
+        """
+        theta_vec, has = self.topics.column_vector(ability_vector or {}, 0.0)
+        return self.topics.row_mean(theta_vec, has, avg_theta, idx)
+
+    def item_boosts(self, topic_boost: Dict[int, float], idx=None) -> np.ndarray:
+        """Tích boost của tất cả topic của câu (topic không có boost -> 1.0)."""
+        if not topic_boost:
+            return np.ones(len(self) if idx is None else len(idx))
+        boost_vec, _ = self.topics.column_vector(topic_boost, 1.0)
+        return self.topics.row_product(boost_vec, idx)
+
+    # -------- Bảng thông tin dựng sẵn + shortlist theo ô θ --------
+    def shortlist(self, scope: int) -> np.ndarray:
+        """
+        Top-K câu (đã calibrate) có Fisher info cao nhất tại mỗi điểm INFO_GRID.
+
+        scope: cột topic trong CSR, hoặc UNTAGGED cho câu không có topic.
+        Trả về mảng (len(INFO_GRID), SHORTLIST_SIZE) vị trí câu, xếp giảm dần; -1 = trống.
+        """
+        table = self._shortlists.get(scope)
+        if table is not None:
+            return table
+
+        from assessment.services.irt import fisher_info_batch
+
+        items = self.scope_positions(scope)
+
+        table = np.full((len(INFO_GRID), SHORTLIST_SIZE), -1, dtype=np.int64)
+        if len(items):
+            info = fisher_info_batch(
+                INFO_GRID[:, None], self.a[items], self.b[items], self.c[items]
+            )
+            k = min(SHORTLIST_SIZE, len(items))
+            top = np.argpartition(-info, k - 1, axis=1)[:, :k]
+            # Sắp lại top-k theo info giảm dần trong từng ô
+            order = np.argsort(-np.take_along_axis(info, top, axis=1), axis=1)
+            table[:, :k] = items[np.take_along_axis(top, order, axis=1)]
+
+        self._shortlists[scope] = table
+        return table
+
+    def scope_positions(self, scope: int) -> np.ndarray:
+        """Vị trí các câu đã calibrate của 1 scope shortlist (cột topic / UNTAGGED)."""
+        rows = self.topics.untagged_rows() if scope == UNTAGGED else self.topics.column_rows(scope)
+        return rows[self.calibrated[rows]]
+
+    def shortlist_parts(
+        self,
+        ability_vector: Dict[int, float],
+        avg_theta: float,
+        topic_ids: Optional[Iterable[int]] = None,
+    ) -> list:
+        """
+        Shortlist của từng topic liên quan tại ô θ của học sinh trên topic đó:
+        [(scope, vị trí)], để caller xử lý riêng scope nào đã cạn.
+
+        topic_ids None -> mọi topic của môn + nhóm câu không có topic.
+        """
+        ability_vector = ability_vector or {}
+        if topic_ids is None:
+            scopes = [(k, ability_vector.get(tid, avg_theta)) for k, tid in enumerate(self.topic_ids.tolist())]
+            scopes.append((UNTAGGED, avg_theta))
+        else:
+            scopes = [
+                (k, ability_vector.get(int(self.topic_ids[k]), avg_theta))
+                for k in self.topic_columns(topic_ids).tolist()
+            ]
+
+        parts = []
+        for scope, theta in scopes:
+            row = self.shortlist(scope)[theta_bin(theta)]
+            parts.append((scope, row[row >= 0]))
+        return parts
+
+
+def theta_bin(theta: float) -> int:
+    """Ô gần nhất của theta trên INFO_GRID."""
+    step = INFO_GRID[1] - INFO_GRID[0]
+    k = int(round((float(theta) - INFO_GRID[0]) / step))
+    return min(max(k, 0), len(INFO_GRID) - 1)
+
+
+def bank_version(subject_id: int) -> tuple:
+    """Version gộp (tham số câu, quan hệ topic) của môn; đổi khi index phải đổi."""
+    return (
+        get_version(ITEM_BANK_VERSION, subject_id),
+        get_version(QUESTION_TOPICS_VERSION, subject_id),
+    )
+
+
+def build_item_bank(subject_id: int, version=None, topics: Optional[QuestionTopicCSR] = None) -> ItemBankIndex:
+    """Build index từ DB (1 query câu + IRT; quan hệ topic lấy từ CSR cache)."""
+    from assessment.models import Question
+
+    rows = list(
+        Question.objects
+        .filter(subject_id=subject_id)
+        .order_by("id")
+        .values_list("id", "irt__a", "irt__b", "irt__c")
+    )
+    n = len(rows)
+    question_ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+    params = np.array(
+        [[np.nan if v is None else v for v in r[1:]] for r in rows], dtype=float
+    ).reshape(n, 3)
+
+    if topics is None:
+        topics = get_question_topics(subject_id)
+    if not np.array_equal(topics.question_ids, question_ids):
+        # Tập câu vừa đổi giữa 2 lần đọc: build lại CSR cho khớp hàng
+        topics = build_question_topics(subject_id, topics.version)
+
+    return ItemBankIndex(
+        subject_id=subject_id,
+        version=version,
+        question_ids=question_ids,
+        a=params[:, 0].copy(),
+        b=params[:, 1].copy(),
+        c=params[:, 2].copy(),
+        topics=topics,
+    )
+
+
+_banks: Dict[int, ItemBankIndex] = {}
+_banks_lock = threading.Lock()
+
+
+def get_item_bank(subject_id: int) -> ItemBankIndex:
+    """
+    Index dùng chung trong process cho 1 môn.
+
+    Steady state: 2 lần đọc version từ cache, không query ORM.
+    Build lại mảng IRT khi Question / QuestionIRT của môn thay đổi (signals hoặc
+    bump_version thủ công sau bulk_update); QuestionTag đổi chỉ thay CSR topic.
+    """
+    version = local_version(ITEM_BANK_VERSION, subject_id)
+    topics = get_question_topics(subject_id)
+    bank = _banks.get(subject_id)
+    if bank is not None and bank.version == version and bank.topics.version == topics.version:
+        return bank
+
+    with _banks_lock:
+        bank = _banks.get(subject_id)
+        if bank is None or bank.version != version:
+            bank = build_item_bank(subject_id, version, topics)
+        elif bank.topics.version != topics.version:
+            bank = (
+                bank.with_topics(topics)
+                if np.array_equal(topics.question_ids, bank.question_ids)
+                else build_item_bank(subject_id, version, topics)
+            )
+        _banks[subject_id] = bank
+    return bank
@@ -0,0 +1,103 @@
+# assessment/services/mastery.py
+from __future__ import annotations
+from typing import Dict, Iterable, Optional
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+
+# Mastery theo (học sinh, topic) = bộ đếm đúng / tổng có suy giảm mũ:
+#   correct <- correct * decay + y,  total <- total * decay + 1
+# decay = 0.98 ~ cửa sổ hiệu dụng 50 câu gần nhất của topic.
+# Cập nhật dồn mỗi phản hồi -> đọc mastery chỉ cần 1 lookup, không replay lịch sử.
+DEFAULT_MASTERY_DECAY = 0.98
+
+
+def mastery_decay() -> float:
+    return float(getattr(settings, "TOPIC_MASTERY_DECAY", DEFAULT_MASTERY_DECAY))
+
+
+def decayed(correct: float, total: float, y: int, decay: float) -> tuple[float, float]:
+    """Bộ đếm sau khi cộng thêm 1 phản hồi y."""
+    return correct * decay + y, total * decay + 1.0
+
+
+def record_mastery(
+    student_id: int,
+    topic_ids: Iterable[int],
+    y: int,
+    existing: Optional[Iterable[int]] = None,
+) -> None:
+    """
+    Cộng 1 phản hồi (y = 0/1) vào bộ đếm của học sinh trên các topic của câu.
+
+    Topic chưa có bản ghi được tạo với bộ đếm 0 (ignore_conflicts: request khác
+    tạo trước cũng không sao), rồi mọi topic được UPDATE bằng biểu thức F (không
+    đọc trước). Cộng từ 0 cho đúng giá trị của bản ghi mới (y, 1, 1) nên không
+    mất phản hồi nào khi 2 request cùng tạo 1 topic.
+    existing: các topic đã có bản ghi nếu đã biết (vd: từ trạng thái phiên) -> bỏ query kiểm tra.
+    """
+    from assessment.models import TopicMastery
+
+    topic_ids = set(topic_ids)
+    if not topic_ids:
+        return
+    rows = TopicMastery.objects.filter(student_id=student_id, topic_id__in=topic_ids)
+    if existing is None:
+        existing = set(rows.values_list("topic_id", flat=True))
+    _create_empty(student_id, topic_ids - set(existing))
+
+    updated = _add_response(rows, y)
+    if updated < len(topic_ids):
+        # `existing` cũ hơn DB (bản ghi đã bị xoá): tạo lại các topic còn thiếu rồi cộng
+        missing = topic_ids - set(rows.values_list("topic_id", flat=True))
+        _create_empty(student_id, missing)
+        _add_response(rows.filter(topic_id__in=missing), y)
+
+
+def _create_empty(student_id: int, topic_ids: Iterable[int]) -> None:
+    from assessment.models import TopicMastery
+
+    TopicMastery.objects.bulk_create([
+        TopicMastery(student_id=student_id, topic_id=tid, correct_weight=0.0, total_weight=0.0, n_responses=0)
+        for tid in topic_ids
+    ], ignore_conflicts=True)
+
+
+def _add_response(rows, y: int) -> int:
+    decay = mastery_decay()
+    return rows.update(
+        correct_weight=F("correct_weight") * decay + y,
+        total_weight=F("total_weight") * decay + 1.0,
+        n_responses=F("n_responses") + 1,
+        updated_at=timezone.now(),
+    )
+
+
+def topic_mastery(
+    student_id: int,
+    topic_ids: Iterable[int],
+    pending: Optional[tuple[Iterable[int], int]] = None,
+) -> Dict[int, float]:
+    """
+    {topic_id: mastery} của học sinh cho các topic (1 query); topic chưa có dữ liệu bị bỏ qua.
+
+    pending: (topic_ids của câu, y) phản hồi giả định chưa ghi, được cộng vào trong bộ nhớ.
+    """
+    from assessment.models import TopicMastery
+
+    counters = {
+        tid: (cw, tw)
+        for tid, cw, tw in TopicMastery.objects
+        .filter(student_id=student_id, topic_id__in=list(topic_ids))
+        .values_list("topic_id", "correct_weight", "total_weight")
+    }
+    if pending is not None:
+        pending_topics, y = pending
+        decay = mastery_decay()
+        for tid in pending_topics:
+            cw, tw = counters.get(tid, (0.0, 0.0))
+            counters[tid] = decayed(cw, tw, y, decay)
+
+    return {tid: cw / tw for tid, (cw, tw) in counters.items() if tw > 0}
@@ -0,0 +1,63 @@
+# assessment/services/question_cache.py
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from assessment.services.versioning import bump_version, get_versions
+
+
+# Payload đã serialize (QuestionDetailSerializer) của từng câu, key theo
+# (id câu, version nội dung). Nội dung câu gần như không đổi nên câu "nóng"
+# được phát cho CAT / đề cố định mà không cần query Question + options hay
+# chạy serializer. Sửa câu / options -> bump version của câu đó (signals.py).
+QUESTION_CONTENT_VERSION = "question_content"
+DEFAULT_PAYLOAD_TTL = 24 * 60 * 60
+
+
+def _key(question_id: int, version) -> str:
+    return f"q:payload:{question_id}:{version}"
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "QUESTION_PAYLOAD_TTL", DEFAULT_PAYLOAD_TTL))
+
+
+def get_question_payloads(question_ids: Iterable[int]) -> List[dict]:
+    """
+    Payload của các câu theo đúng thứ tự ids (bỏ qua id không còn tồn tại).
+    Cache hit: 2 lần get_many (version + payload); miss: 1 query + prefetch options.
+    """
+    from assessment.models import Question
+    from assessment.serializers import QuestionDetailSerializer
+
+    ids = [int(qid) for qid in question_ids]
+    if not ids:
+        return []
+    versions = get_versions(QUESTION_CONTENT_VERSION, ids)
+    keys = {qid: _key(qid, versions[qid]) for qid in ids}
+    found = cache.get_many(list(keys.values()))
+    payloads: Dict[int, dict] = {
+        qid: found[key] for qid, key in keys.items() if key in found
+    }
+
+    missing = [qid for qid in ids if qid not in payloads]
+    if missing:
+        qs = Question.objects.filter(id__in=missing).prefetch_related("options")
+        fresh = {q.id: QuestionDetailSerializer(q).data for q in qs}
+        cache.set_many({keys[qid]: data for qid, data in fresh.items()}, _ttl())
+        payloads.update(fresh)
+
+    return [payloads[qid] for qid in ids if qid in payloads]
+
+
+def get_question_payload(question_id: int) -> Optional[dict]:
+    found = get_question_payloads([question_id])
+    return found[0] if found else None
+
+
+def invalidate_question_payload(question_id: int) -> None:
+    """Bump version nội dung của câu sau khi commit (payload cũ tự hết hạn theo TTL)."""
+    transaction.on_commit(lambda: bump_version(QUESTION_CONTENT_VERSION, question_id))
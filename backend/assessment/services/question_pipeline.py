@@ -13,6 +13,7 @@ from ..models import (
 )
 
 
+from ..services.sampling import sample_questions
 from ..services.llm_generation import generate_candidates_from_llm
 from ..services.llm_evaluation import (
     build_deepseek_eval_prompt,
@@ -65,17 +66,13 @@ def get_seed_questions(subject_id: int, topic_id: Optional[int], k: int = 5) ->
       ...
     ]
     """
-    qs = Question.objects.filter(subject_id=subject_id)
-
-    # 🔧 QUAN TRỌNG: dùng related_name="tags" trên QuestionTag
-    # KHÔNG dùng 'tag__topic_id' hay 'questiontag__topic_id'
-    if topic_id is not None:
-        qs = qs.filter(tags__topic_id=topic_id)
-
-    # Prefetch để tránh N+1 query
-    qs = (
-        qs.prefetch_related("options", "irt", "stats", "tags")
-          .order_by("?")[:k]
+    # Bốc ngẫu nhiên k id từ pool cache sẵn (subject, topic) thay vì order_by("?"),
+    # prefetch để tránh N+1 query
+    qs = sample_questions(
+        subject_id,
+        k,
+        topic_id=topic_id,
+        queryset=Question.objects.prefetch_related("options", "irt", "stats", "tags"),
     )
 
     items: List[Dict[str, Any]] = []
@@ -1,27 +1,244 @@
 # assessment/services/rules.py
 from __future__ import annotations
-from collections import defaultdict
+from dataclasses import dataclass, field
 from datetime import timedelta
-from typing import Dict, Any, Set, Iterable, Optional
+from typing import Dict, Any, FrozenSet, Set, Iterable, Optional, Tuple
+import logging
 import random
+import threading
 
-from django.db.models import Q
-from django.utils import timezone
+import numpy as np
+
+from assessment.services.exposure import recent_exposures
+from assessment.services.mastery import topic_mastery
+from assessment.services.topic_index import get_question_topics
+from assessment.services.versioning import local_version
+
+logger = logging.getLogger(__name__)
+
+# Version của tập Rule (bump qua signals khi Rule đổi)
+RULES_VERSION = "rules"
+
+
+# -------- Tập luật đã biên dịch (cache theo RULES_VERSION) --------
+@dataclass(frozen=True)
+class CompiledRules:
+    """
+    Các Rule đang bật đã đọc + kiểm tra tham số 1 lần, nhóm theo loại luật.
+
+    - mastery_boosts / theta_boosts: {topic_id: [(threshold, weight), ...]}
+    - difficulty_range: {"b_min","b_max","lte_position"} của luật session_stage cuối cùng
+    - cooldown_days: số ngày lớn nhất trong các luật exposure_cooldown (None = không có)
+    - block_topic_ids: các topic bị block
+    """
+
+    version: Any = None
+    mastery_boosts: Dict[int, Tuple[Tuple[float, float], ...]] = field(default_factory=dict)
+    theta_boosts: Dict[int, Tuple[Tuple[float, float], ...]] = field(default_factory=dict)
+    difficulty_range: Optional[Dict[str, Any]] = None
+    cooldown_days: Optional[int] = None
+    block_topic_ids: FrozenSet[int] = frozenset()
+
+
+def _opt_float(v):
+    return None if v is None else float(v)
+
+
+# Mỗi hàm nhận (cond, act, acc) và ghi vào acc; sai tham số -> raise (luật bị bỏ qua)
+def _compile_mastery_boost(cond, act, acc):
+    # {"type": "topic_mastery_below", "topic_id": 1, "threshold": 0.6} + {"type": "boost_topic_probability", "weight": 1.5}
+    acc["mastery_boosts"].setdefault(int(cond["topic_id"]), []).append(
+        (float(cond.get("threshold", 0.5)), float(act.get("weight", 1.2)))
+    )
+
+
+def _compile_theta_boost(cond, act, acc):
+    # {"type": "topic_theta_below", "topic_id": 1, "threshold": 0.0} + {"type": "boost_topic_probability", "weight": 1.5}
+    acc["theta_boosts"].setdefault(int(cond["topic_id"]), []).append(
+        (float(cond.get("threshold", 0.0)), float(act.get("weight", 1.5)))
+    )
+
+
+def _compile_session_stage(cond, act, acc):
+    # {"type": "session_stage", "lte_position": 5} + {"type": "set_difficulty_range", "b_min": -2.0, "b_max": 0.0}
+    lte = cond.get("lte_position", 5)
+    acc["difficulty_range"] = {
+        "b_min": _opt_float(act.get("b_min")),
+        "b_max": _opt_float(act.get("b_max")),
+        "lte_position": None if lte is None else int(lte),
+    }
+
+
+def _compile_exposure_cooldown(cond, act, acc):
+    # {"type": "exposure_cooldown", "days": 7} + {"type": "block_items"}
+    days = int(cond.get("days", 7))
+    acc["cooldown_days"] = max(days, acc["cooldown_days"] or 0)
+
+
+def _compile_block_topic(cond, act, acc):
+    # {"type": "block_topic", "topic_id": 1} + {"type": "block_items"}
+    acc["block_topic_ids"].add(int(cond["topic_id"]))
+
+
+RULE_COMPILERS = {
+    ("topic_mastery_below", "boost_topic_probability"): _compile_mastery_boost,
+    ("topic_theta_below", "boost_topic_probability"): _compile_theta_boost,
+    ("session_stage", "set_difficulty_range"): _compile_session_stage,
+    ("exposure_cooldown", "block_items"): _compile_exposure_cooldown,
+    ("block_topic", "block_items"): _compile_block_topic,
+}
+
+
+def compile_rules(rules: Iterable, version=None) -> CompiledRules:
+    """Biên dịch các Rule (theo thứ tự id) thành CompiledRules; luật không hợp lệ bị bỏ qua."""
+    acc = {
+        "mastery_boosts": {},
+        "theta_boosts": {},
+        "difficulty_range": None,
+        "cooldown_days": None,
+        "block_topic_ids": set(),
+    }
+    for r in rules:
+        cond: Dict[str, Any] = r.condition_json or {}
+        act: Dict[str, Any] = r.action_json or {}
+        # Rule gắn topic: condition không ghi topic_id thì dùng topic của Rule
+        if getattr(r, "topic_id", None) is not None and "topic_id" not in cond:
+            cond = {**cond, "topic_id": r.topic_id}
+        compiler = RULE_COMPILERS.get((cond.get("type"), act.get("type")))
+        if compiler is None:
+            continue
+        try:
+            compiler(cond, act, acc)
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Bỏ qua Rule %s (%s): tham số không hợp lệ", r.pk, r.name)
+
+    return CompiledRules(
+        version=version,
+        mastery_boosts={t: tuple(v) for t, v in acc["mastery_boosts"].items()},
+        theta_boosts={t: tuple(v) for t, v in acc["theta_boosts"].items()},
+        difficulty_range=acc["difficulty_range"],
+        cooldown_days=acc["cooldown_days"],
+        block_topic_ids=frozenset(acc["block_topic_ids"]),
+    )
+
+
+class RuleIndex:
+    """
+    Rule đang bật nhóm theo môn áp dụng; biên dịch lười cho từng môn.
+
+    Môn của 1 Rule: Rule.subject, nếu không có thì môn của Rule.topic, rồi môn
+    của topic_id trong condition; không xác định được -> luật chung mọi môn.
+    Mỗi môn chỉ biên dịch luật chung + luật của môn đó, nên chi phí không tăng
+    khi môn khác thêm luật.
+    """
+
+    def __init__(self, version, global_rules: list, rules_by_subject: Dict[int, list]):
+        self.version = version
+        self.global_rules = global_rules
+        self.rules_by_subject = rules_by_subject
+        self._compiled: Dict[int, CompiledRules] = {}
+
+    def for_subject(self, subject_id: int) -> CompiledRules:
+        compiled = self._compiled.get(subject_id)
+        if compiled is None:
+            rules = sorted(
+                self.global_rules + self.rules_by_subject.get(subject_id, []),
+                key=lambda r: r.pk,
+            )
+            compiled = compile_rules(rules, self.version)
+            self._compiled[subject_id] = compiled
+        return compiled
+
+
+def _condition_topic_id(rule) -> Optional[int]:
+    try:
+        return int((rule.condition_json or {})["topic_id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def build_rule_index(version=None) -> RuleIndex:
+    """Đọc Rule đang bật (1 query + 1 query môn của topic trong condition) và nhóm theo môn."""
+    from django.db.models import F
+    from assessment.models import Rule, Topic
+
+    rules = list(
+        Rule.objects
+        .filter(is_active=True)
+        .annotate(topic_subject_id=F("topic__subject_id"))
+        .order_by("id")
+    )
+
+    cond_topics = {
+        _condition_topic_id(r) for r in rules
+        if r.subject_id is None and r.topic_subject_id is None
+    } - {None}
+    topic_subject = dict(
+        Topic.objects.filter(id__in=cond_topics).values_list("id", "subject_id")
+    ) if cond_topics else {}
+
+    global_rules: list = []
+    rules_by_subject: Dict[int, list] = {}
+    for r in rules:
+        subject_id = r.subject_id or r.topic_subject_id or topic_subject.get(_condition_topic_id(r))
+        if subject_id is None:
+            global_rules.append(r)
+        else:
+            rules_by_subject.setdefault(subject_id, []).append(r)
+    return RuleIndex(version, global_rules, rules_by_subject)
+
+
+_rule_index: Optional[RuleIndex] = None
+_rule_index_lock = threading.Lock()
+
+
+def get_compiled_rules(subject_id: int) -> CompiledRules:
+    """
+    Tập luật đã biên dịch của 1 môn, dùng chung trong process.
+    Steady state: 1 lần đọc version từ cache, không query Rule.
+    """
+    global _rule_index
+
+    version = local_version(RULES_VERSION)
+    index = _rule_index
+    if index is None or index.version != version:
+        with _rule_index_lock:
+            if _rule_index is None or _rule_index.version != version:
+                _rule_index = build_rule_index(version)
+            index = _rule_index
+    return index.for_subject(subject_id)
+
+
+def _apply_boosts(ctx_boost: Dict[int, float], boosts, value_of) -> None:
+    """Boost topic khi giá trị (mastery / theta) thiếu hoặc dưới ngưỡng; giữ weight lớn nhất."""
+    for topic_id, entries in boosts.items():
+        value = value_of(topic_id)
+        for threshold, weight in entries:
+            # Nếu chưa có dữ liệu, xem là dưới ngưỡng để ưu tiên luyện
+            if value is None or value < threshold:
+                ctx_boost[topic_id] = max(weight, ctx_boost.get(topic_id, 1.0))
 
 
 def evaluate_rules(
     student_id: int,
     subject_id: int,
     ability_vector: Optional[Dict[int, float]] = None,
+    pending_response: Optional[tuple] = None,
+    mastery: Optional[Dict[int, float]] = None,
 ) -> dict:
     """
     Gom các luật đang bật -> context cho selector.
 
+    pending_response: (question_id, y) của phản hồi giả định chưa ghi DB
+    (dùng khi tính trước câu kế tiếp), được coi là phản hồi mới nhất.
+    mastery: {topic_id: mastery} đã có sẵn (vd: trạng thái phiên) -> không đọc DB.
+
     Output:
       {
         "topic_boost": {topic_id: weight, ...},
         "difficulty_range": {"b_min": float|None, "b_max": float|None, "lte_position": int|None},
-        "block_question_ids": [int, ...]
+        "block_question_ids": [int, ...],
+        "block_topic_ids": [int, ...]   # loại mọi câu gắn các topic này
       }
 
     Mục tiêu:
@@ -29,168 +246,180 @@ def evaluate_rules(
     - Dùng mastery (tỉ lệ đúng) + theta (IRT) để điều chỉnh phân phối câu hỏi.
     - Giảm lặp lại câu (exposure cooldown).
     """
-    from assessment.models import Rule, TestResponse, QuestionTag
-
+    compiled = get_compiled_rules(subject_id)
     ctx = {
         "topic_boost": {},        # {topic_id: weight}
-        "difficulty_range": None, # {"b_min","b_max","lte_position"}
+        "difficulty_range": dict(compiled.difficulty_range) if compiled.difficulty_range else None,
         "block_question_ids": set(),
+        # Block theo topic giữ ở mức topic (không bung ra danh sách câu),
+        # selector áp thành mask trên item bank
+        "block_topic_ids": sorted(compiled.block_topic_ids),
     }
 
-    # -------- 1) Tính mastery theo topic (tỉ lệ đúng các câu gần đây) --------
-    latest = (
-        TestResponse.objects
-        .filter(session__student_id=student_id, session__subject_id=subject_id)
-        .select_related("question")
-        .order_by("-answered_at")[:200]
-    )
-
-    # Map question_id -> correctness (lần trả lời gần nhất trong 200 câu)
-    q_correct = {r.question_id: (1 if r.is_correct else 0) for r in latest}
-
-    # Map topic_id -> list[y]
-    topic_history: Dict[int, list[int]] = defaultdict(list)
-    if q_correct:
-        rel = (
-            QuestionTag.objects
-            .filter(question_id__in=q_correct.keys())
-            .values_list("question_id", "topic_id")
+    # -------- 1) Mastery theo topic (bộ đếm suy giảm đã duy trì sẵn) --------
+    # Chỉ đọc khi có luật topic_mastery_below: 1 query cho các topic của luật
+    if compiled.mastery_boosts and mastery is not None:
+        _apply_boosts(ctx["topic_boost"], compiled.mastery_boosts, mastery.get)
+    elif compiled.mastery_boosts:
+        pending = None
+        if pending_response is not None:
+            qid, y = pending_response
+            pending = (get_question_topics(subject_id).topics_of(qid), y)
+        mastery = topic_mastery(student_id, compiled.mastery_boosts.keys(), pending)
+        _apply_boosts(ctx["topic_boost"], compiled.mastery_boosts, mastery.get)
+
+    # -------- 2) Theta thấp theo topic -> boost topic (dùng IRT) --------
+    if compiled.theta_boosts:
+        ability_vector = ability_vector or {}
+        _apply_boosts(ctx["topic_boost"], compiled.theta_boosts, ability_vector.get)
+
+    # -------- 3) Cooldown phơi nhiễm (theo student + subject) --------
+    # Đọc từ bucket theo ngày trong cache (services/exposure.py), không query mỗi bước
+    if compiled.cooldown_days is not None:
+        ctx["block_question_ids"].update(
+            recent_exposures(student_id, subject_id, compiled.cooldown_days)
         )
-        for qid, tid in rel:
-            topic_history[tid].append(q_correct[qid])
-
-    topic_mastery: Dict[int, float] = {}
-    for tid, arr in topic_history.items():
-        # Có thể cắt về 20 gần nhất nếu muốn:
-        # arr = arr[:20]
-        if arr:
-            topic_mastery[tid] = sum(arr) / float(len(arr))
-
-    ability_vector = ability_vector or {}
-
-    # -------- 2) Duyệt Rule (hiện tại là global, không filter theo subject) --------
-    rules = Rule.objects.filter(is_active=True)
-
-    for r in rules:
-        cond: Dict[str, Any] = r.condition_json or {}
-        act: Dict[str, Any]  = r.action_json or {}
-        ctype = cond.get("type")
-        atype = act.get("type")
-
-        # == Rule 1: mastery thấp -> boost topic ==
-        # {
-        #   "condition_json": {"type": "topic_mastery_below", "topic_id": 1, "threshold": 0.6},
-        #   "action_json":    {"type": "boost_topic_probability", "weight": 1.5}
-        # }
-        if ctype == "topic_mastery_below" and atype == "boost_topic_probability":
-            topic_id = cond.get("topic_id")
-            if topic_id is None:
-                continue
-            threshold = float(cond.get("threshold", 0.5))
-            weight = float(act.get("weight", 1.2))
-            mastered = topic_mastery.get(topic_id, None)
-            # Nếu chưa có dữ liệu, có thể xem là dưới ngưỡng để ưu tiên luyện
-            if mastered is None or mastered < threshold:
-                prev = ctx["topic_boost"].get(topic_id, 1.0)
-                ctx["topic_boost"][topic_id] = max(weight, prev)
-
-        # == Rule 2: theta thấp theo topic -> boost topic (dùng IRT) ==
-        # {
-        #   "condition_json": {"type": "topic_theta_below", "topic_id": 1, "threshold": 0.0},
-        #   "action_json":    {"type": "boost_topic_probability", "weight": 1.5}
-        # }
-        if ctype == "topic_theta_below" and atype == "boost_topic_probability":
-            topic_id = cond.get("topic_id")
-            if topic_id is None:
-                continue
-            threshold = float(cond.get("threshold", 0.0))
-            weight = float(act.get("weight", 1.5))
-            theta = ability_vector.get(topic_id, None)
-            # Nếu chưa có theta hoặc theta < threshold -> coi là yếu ở topic đó
-            if theta is None or theta < threshold:
-                prev = ctx["topic_boost"].get(topic_id, 1.0)
-                ctx["topic_boost"][topic_id] = max(weight, prev)
-
-        # == Rule 3: giới hạn độ khó b trong giai đoạn đầu phiên ==
-        # {
-        #   "condition_json": {"type": "session_stage", "lte_position": 5},
-        #   "action_json":    {"type": "set_difficulty_range", "b_min": -2.0, "b_max": 0.0}
-        # }
-        if ctype == "session_stage" and atype == "set_difficulty_range":
-            ctx["difficulty_range"] = {
-                "b_min": act.get("b_min"),
-                "b_max": act.get("b_max"),
-                "lte_position": cond.get("lte_position", 5),
-            }
-
-        # == Rule 4: cooldown phơi nhiễm (theo student + subject) ==
-        # {
-        #   "condition_json": {"type": "exposure_cooldown", "days": 7},
-        #   "action_json":    {"type": "block_items"}
-        # }
-        if ctype == "exposure_cooldown" and atype == "block_items":
-            days = int(cond.get("days", 7))
-            since = timezone.now() - timedelta(days=days)
-            recent_qids = (
-                TestResponse.objects
-                .filter(
-                    answered_at__gte=since,
-                    session__subject_id=subject_id,
-                    session__student_id=student_id,
-                )
-                .values_list("question_id", flat=True)
-            )
-            ctx["block_question_ids"].update(recent_qids)
-
-        # == Rule 5: block theo một topic cụ thể ==
-        # {
-        #   "condition_json": {"type": "block_topic", "topic_id": 1},
-        #   "action_json":    {"type": "block_items"}
-        # }
-        if ctype == "block_topic" and atype == "block_items":
-            topic_id = cond.get("topic_id")
-            if topic_id is None:
-                continue
-            qids = (
-                QuestionTag.objects
-                .filter(topic_id=topic_id)
-                .values_list("question_id", flat=True)
-            )
-            ctx["block_question_ids"].update(qids)
 
     ctx["block_question_ids"] = list(ctx["block_question_ids"])
     return ctx
 
 
-def _build_question_topics_map(question_ids: Iterable[int]) -> Dict[int, Set[int]]:
-    """Trả về mapping {question_id: {topic_id,...}}."""
-    from assessment.models import QuestionTag
-    mapping: Dict[int, Set[int]] = defaultdict(set)
-    rel = (
-        QuestionTag.objects
-        .filter(question_id__in=question_ids)
-        .values_list("question_id", "topic_id")
-    )
-    for qid, tid in rel:
-        mapping[qid].add(tid)
-    return mapping
+def compile_preview_rules(subject_id: int, draft_rules: Iterable = (), include_active: bool = True) -> CompiledRules:
+    """
+    Tập luật để xem trước: luật đang áp dụng cho môn (nếu include_active) + các
+    Rule nháp chưa lưu, coi như mới nhất (đứng sau cùng theo thứ tự).
+    """
+    index = None
+    if include_active:
+        get_compiled_rules(subject_id)  # đảm bảo index đúng version
+        index = _rule_index
+    rules = []
+    if index is not None:
+        rules = sorted(
+            index.global_rules + index.rules_by_subject.get(subject_id, []),
+            key=lambda r: r.pk,
+        )
+    return compile_rules(rules + list(draft_rules))
 
 
-def _theta_for_question(
-    qid: int,
-    q_topics: Dict[int, Set[int]],
-    ability_vector: Dict[int, float],
-    avg_theta: float,
-) -> float:
+def evaluate_rules_batch(
+    student_ids: Iterable[int],
+    subject_id: int,
+    compiled: Optional[CompiledRules] = None,
+) -> dict:
     """
-    Lấy theta cho câu hỏi = trung bình theta trên các topic của câu.
-    Nếu không có topic hoặc không có theta nào -> fallback avg_theta.
+    evaluate_rules cho cả nhóm học sinh trong 1 lượt (xem trước tác động của luật).
+
+    Số query không phụ thuộc số học sinh: mastery, theta, phơi nhiễm gần đây
+    mỗi loại 1 query; điều kiện ngưỡng tính trên ma trận (học sinh x topic).
+
+    Output:
+      {
+        "contexts": {student_id: <ctx như evaluate_rules>},
+        "stats": {
+          "n_students", "difficulty_range", "block_topic_ids",
+          "topic_boost": {topic_id: {"students", "share", "mean_weight"}},
+          "blocked_items": {"mean", "max"},
+        }
+      }
     """
-    tids = q_topics.get(qid, None)
-    if not tids:
-        return avg_theta
-    vals = [ability_vector[tid] for tid in tids if tid in ability_vector]
-    return sum(vals) / len(vals) if vals else avg_theta
+    from django.utils import timezone
+    from assessment.models import StudentAbilityProfile, TestResponse, TopicMastery
+
+    student_ids = list(dict.fromkeys(int(sid) for sid in student_ids))
+    if compiled is None:
+        compiled = get_compiled_rules(subject_id)
+    n = len(student_ids)
+    row_of = {sid: i for i, sid in enumerate(student_ids)}
+
+    # Ma trận giá trị (NaN = chưa có dữ liệu) cho các topic xuất hiện trong luật
+    def _matrix(topics, rows):
+        cols = {tid: k for k, tid in enumerate(topics)}
+        m = np.full((n, len(cols)), np.nan)
+        for sid, tid, v in rows:
+            m[row_of[sid], cols[tid]] = v
+        return m
+
+    # Boost = max weight trên các luật có giá trị thiếu hoặc dưới ngưỡng
+    boost = {}
+
+    def _boost_matrix(boosts, values):
+        for k, (tid, entries) in enumerate(boosts.items()):
+            col = values[:, k]
+            b = boost.setdefault(tid, np.ones(n))
+            for threshold, weight in entries:
+                hit = np.isnan(col) | (col < threshold)
+                b[hit] = np.maximum(b[hit], weight)
+
+    # -------- 1) Mastery (1 query) --------
+    if compiled.mastery_boosts:
+        topics = list(compiled.mastery_boosts)
+        rows = (
+            (sid, tid, cw / tw)
+            for sid, tid, cw, tw in TopicMastery.objects
+            .filter(student_id__in=student_ids, topic_id__in=topics, total_weight__gt=0)
+            .values_list("student_id", "topic_id", "correct_weight", "total_weight")
+        )
+        _boost_matrix(compiled.mastery_boosts, _matrix(topics, rows))
+
+    # -------- 2) Theta (1 query) --------
+    if compiled.theta_boosts:
+        topics = list(compiled.theta_boosts)
+        rows = (
+            StudentAbilityProfile.objects
+            .filter(student_id__in=student_ids, topic_id__in=topics)
+            .values_list("student_id", "topic_id", "theta")
+        )
+        _boost_matrix(compiled.theta_boosts, _matrix(topics, rows))
+
+    # -------- 3) Cooldown phơi nhiễm (1 query, không qua cache từng học sinh) --------
+    # Cùng cách tính theo ngày với services/exposure.recent_exposures
+    blocked = {sid: set() for sid in student_ids}
+    if compiled.cooldown_days is not None:
+        since = timezone.localdate() - timedelta(days=compiled.cooldown_days)
+        for sid, qid in (
+            TestResponse.objects
+            .filter(
+                answered_at__date__gte=since,
+                session__subject_id=subject_id,
+                session__student_id__in=student_ids,
+            )
+            .values_list("session__student_id", "question_id")
+            .distinct()
+        ):
+            blocked[sid].add(qid)
+
+    # -------- 4) Context từng học sinh + thống kê gộp --------
+    contexts = {}
+    for sid, i in row_of.items():
+        contexts[sid] = {
+            "topic_boost": {tid: float(b[i]) for tid, b in boost.items() if b[i] != 1.0},
+            "difficulty_range": dict(compiled.difficulty_range) if compiled.difficulty_range else None,
+            "block_question_ids": sorted(blocked[sid]),
+            "block_topic_ids": sorted(compiled.block_topic_ids),
+        }
+
+    boost_stats = {}
+    for tid, b in boost.items():
+        hit = b != 1.0
+        if hit.any():
+            boost_stats[tid] = {
+                "students": int(hit.sum()),
+                "share": float(hit.mean()),
+                "mean_weight": float(b[hit].mean()),
+            }
+    n_blocked = np.array([len(v) for v in blocked.values()], dtype=float)
+    stats = {
+        "n_students": n,
+        "difficulty_range": compiled.difficulty_range,
+        "block_topic_ids": sorted(compiled.block_topic_ids),
+        "topic_boost": boost_stats,
+        "blocked_items": {
+            "mean": float(n_blocked.mean()) if n else 0.0,
+            "max": int(n_blocked.max()) if n else 0,
+        },
+    }
+    return {"contexts": contexts, "stats": stats}
 
 
 def select_next_item(
@@ -203,9 +432,29 @@ def select_next_item(
     position_in_session: Optional[int] = None,
     topic_ids: Optional[Iterable[int]] = None,   # 👈 THÊM THAM SỐ NÀY
 ):
+    """Như select_next_item_id nhưng trả về Question (1 query theo pk)."""
+    from assessment.models import Question
+
+    qid = select_next_item_id(
+        ability_vector, avg_theta, subject_id, used_q_ids, rule_ctx,
+        position_in_session=position_in_session, topic_ids=topic_ids,
+    )
+    return Question.objects.filter(id=qid).first() if qid is not None else None
+
+
+def select_next_item_id(
+    ability_vector: Dict[int, float],
+    avg_theta: float,
+    subject_id: int,
+    used_q_ids: Set[int],
+    rule_ctx: dict,
+    *,
+    position_in_session: Optional[int] = None,
+    topic_ids: Optional[Iterable[int]] = None,
+) -> Optional[int]:
     """
     Chọn câu tối đa Fisher info + áp ràng buộc:
-      - block_question_ids
+      - block_question_ids, block_topic_ids
       - difficulty_range (b_min, b_max, lte_position)
       - topic_boost
       - topic_ids: nếu không None -> chỉ chọn câu thuộc các topic này
@@ -218,12 +467,14 @@ def select_next_item(
     - Tập trung vào topic yếu (mastery thấp / theta thấp).
     - Giữ độ khó phù hợp giai đoạn làm bài.
     - Tránh lặp câu quá nhiều / kẹt không có câu.
+
+    Trả về id câu (None nếu hết câu); chạy hoàn toàn trên item bank, không query ORM.
     """
-    from assessment.models import Question
-    from assessment.services.irt import fisher_info
+    from assessment.services.item_bank import get_item_bank
 
     ability_vector = ability_vector or {}
     block_ids = set(rule_ctx.get("block_question_ids", []))
+    block_topic_ids = set(rule_ctx.get("block_topic_ids", [])) or None
     topic_boost = rule_ctx.get("topic_boost", {})
     dr = rule_ctx.get("difficulty_range")  # {"b_min","b_max","lte_position"}
 
@@ -244,103 +495,119 @@ def select_next_item(
         b_min = dr.get("b_min")
         b_max = dr.get("b_max")
 
-    # -------- 2) Lấy candidate từ DB (thô) --------
-    qs = (
-        Question.objects
-        .filter(subject_id=subject_id)
-        .exclude(id__in=used_q_ids)
-        .exclude(id__in=block_ids)
-        .select_related("irt")
+    bank = get_item_bank(subject_id)
+    pos, fallback = select_position(
+        bank,
+        ability_vector,
+        avg_theta,
+        excluded=set(used_q_ids) | block_ids,
+        excluded_topic_ids=block_topic_ids,
+        topic_ids=topic_ids_set,
+        b_range=(b_min, b_max) if apply_b_range else None,
+        topic_boost=topic_boost,
     )
+    if pos is not None:
+        return int(bank.question_ids[pos])
+    # -------- 5) Fallback khi không có câu IRT hợp lệ --------
+    return _pick_random(bank, fallback)
+
+
+def select_position(
+    bank,
+    ability_vector: Dict[int, float],
+    avg_theta: float,
+    *,
+    excluded: Set[int],
+    excluded_topic_ids: Optional[Set[int]] = None,
+    topic_ids: Optional[Set[int]] = None,
+    b_range: Optional[tuple] = None,
+    topic_boost: Optional[Dict[int, float]] = None,
+    use_shortlist: Optional[bool] = None,
+):
+    """
+    Phần tính toán của select_next_item_id trên item bank (không query ORM).
+
+    use_shortlist: None -> tự chọn theo kích thước pool (SHORTLIST_MIN_POOL);
+    True / False -> ép dùng / không dùng shortlist (benchmark).
+    Trả về (vị trí câu tốt nhất, None) hoặc (None, các vị trí để chọn random).
+    """
+    from assessment.services.item_bank import SHORTLIST_MIN_POOL
+
+    topic_boost = topic_boost or {}
+
+    # Phiên khoá topic: pool = các câu của topic (CSC đã cache), chi phí ~ kích
+    # thước topic thay vì kích thước môn. Không khoá: cả item bank.
+    if topic_ids is not None:
+        pool = bank.topic_positions(topic_ids)
+    else:
+        pool = np.arange(len(bank))
+
+    # -------- 2) Đường nhanh: shortlist top-K tại ô θ hiện tại --------
+    # Chi phí ~ số topic * K thay vì kích thước pool; chỉ đáng khi pool lớn.
+    if use_shortlist is None:
+        use_shortlist = len(pool) >= SHORTLIST_MIN_POOL
+    if use_shortlist:
+        parts = bank.shortlist_parts(ability_vector, avg_theta, topic_ids)
+        pos = np.concatenate([p for _, p in parts]) if parts else np.empty(0, dtype=np.int64)
+        short = bank.filter_positions(np.unique(pos), excluded, topic_ids, b_range, excluded_topic_ids)
+        # Scope có shortlist cạn (đã làm / bị lọc hết) -> xét cả scope đó,
+        # không bỏ rơi topic trong khi các topic khác còn shortlist.
+        # (shortlist rỗng từ đầu = scope không có câu đã calibrate -> bỏ qua)
+        sizes = [len(p) for _, p in parts]
+        labels = np.repeat(np.arange(len(parts)), sizes)
+        kept = np.bincount(labels[np.isin(pos, short)], minlength=len(parts))
+        refill = [
+            bank.filter_positions(bank.scope_positions(scope), excluded, topic_ids, b_range, excluded_topic_ids)
+            for (scope, _), size, n in zip(parts, sizes, kept) if size and not n
+        ]
+        if refill:
+            short = np.unique(np.concatenate([short, *refill]))
+        best = _best_items(bank, short, ability_vector, avg_theta, topic_boost)
+        if best:
+            # Ngẫu nhiên nhẹ giữa các câu có score tốt nhất
+            return random.choice(best), None
+
+    # -------- 3) Pool nhỏ / không còn câu IRT hợp lệ -> lọc trên pool ứng viên --------
+    # Câu còn dùng được: chưa làm, không bị block (theo câu hoặc theo topic)
+    available = bank.filter_positions(pool, excluded, exclude_topic_ids=excluded_topic_ids)
 
     # Lọc theo độ khó (IRT b) nếu cần
-    if apply_b_range:
-        diff_filter = Q()
-        if b_min is not None:
-            diff_filter &= Q(irt__b__gte=b_min)
-        if b_max is not None:
-            diff_filter &= Q(irt__b__lte=b_max)
-        if diff_filter:
-            qs = qs.filter(diff_filter)
-
-    qids = list(qs.values_list("id", flat=True))
-    if not qids:
-        # Không còn câu nào sau khi filter -> fallback random (áp topic_ids nếu có)
-        fallback_qs = (
-            Question.objects
-            .filter(subject_id=subject_id)
-            .exclude(id__in=used_q_ids)
-            .exclude(id__in=block_ids)
-        )
-        if topic_ids_set is not None:
-            fallback_qs = fallback_qs.filter(questiontag__topic_id__in=topic_ids_set).distinct()
-        return fallback_qs.order_by("?").first()
-
-    # Chuẩn bị topic map để không N+1
-    q_topics = _build_question_topics_map(qids)
-
-    # -------- 3) Chấm điểm Fisher info * topic_boost (kèm lọc topic_ids nếu có) --------
-    best: list = []
-    best_score = -1.0
-
-    for q in qs:
-        # Nếu có filter theo topic_ids thì bỏ những câu không thuộc các topic đó
-        if topic_ids_set is not None:
-            tids_of_q = q_topics.get(q.id, set())
-            if not (tids_of_q & topic_ids_set):
-                continue
-
-        irt = getattr(q, "irt", None)
-        a = getattr(irt, "a", None)
-        b = getattr(irt, "b", None)
-        c = getattr(irt, "c", None)
-
-        # Chỉ xét những câu có đủ tham số IRT
-        if a is None or b is None or c is None:
-            continue
+    cand = bank.filter_positions(available, (), None, b_range) if b_range is not None else available
+    if not len(cand):
+        # Không còn câu nào sau khi filter -> fallback random trong pool còn lại
+        return None, available
+
+    # -------- 4) Chấm điểm Fisher info * topic_boost --------
+    # Chỉ xét những câu có đủ tham số IRT
+    best = _best_items(bank, cand[bank.calibrated[cand]], ability_vector, avg_theta, topic_boost)
+    if not best:
+        return None, cand
 
-        # Lấy theta "phù hợp" với câu dựa trên topic của câu
-        theta_q = _theta_for_question(q.id, q_topics, ability_vector, avg_theta)
+    # -------- 6) Ngẫu nhiên nhẹ giữa các câu có score tốt nhất --------
+    return random.choice(best), None
 
-        # Thông tin Fisher (IRT)
-        info = fisher_info(theta_q, a, b, c)
-        if info <= 0.0:
-            continue
 
-        # Boost theo topic (nhân tất cả boost của các topic câu)
-        boost = 1.0
-        for tid in q_topics.get(q.id, []):
-            boost *= topic_boost.get(tid, 1.0)
+def _best_items(bank, idx, ability_vector, avg_theta, topic_boost) -> list:
+    """Vị trí các câu có score = Fisher info * boost cao nhất trong idx (tie trong 1e-9)."""
+    from assessment.services.irt import fisher_info_batch
 
-        score = info * boost
+    if not len(idx):
+        return []
+    # Lấy theta "phù hợp" với câu dựa trên topic của câu
+    thetas = bank.item_thetas(ability_vector, avg_theta, idx)
+    # Thông tin Fisher (IRT) cho toàn bộ ứng viên trong 1 lần gọi
+    info = fisher_info_batch(thetas, bank.a[idx], bank.b[idx], bank.c[idx])
+    # Boost theo topic (nhân tất cả boost của các topic câu)
+    score = np.where(info > 0.0, info * bank.item_boosts(topic_boost, idx), -1.0)
+    best_score = float(score.max())
+    if best_score <= 0.0:
+        return []
+    return idx[score >= best_score - 1e-9].tolist()
 
-        if score > best_score + 1e-9:
-            best_score = score
-            best = [q]
-        elif abs(score - best_score) <= 1e-9:  # tie
-            best.append(q)
 
-    # -------- 4) Fallback khi không có câu IRT hợp lệ --------
-    if not best:
-        fallback_qs = (
-            Question.objects
-            .filter(subject_id=subject_id)
-            .exclude(id__in=used_q_ids)
-            .exclude(id__in=block_ids)
-        )
-        if apply_b_range:
-            diff_filter = Q()
-            if b_min is not None:
-                diff_filter &= Q(irt__b__gte=b_min)
-            if b_max is not None:
-                diff_filter &= Q(irt__b__lte=b_max)
-            if diff_filter:
-                fallback_qs = fallback_qs.filter(diff_filter)
-
-        if topic_ids_set is not None:
-            fallback_qs = fallback_qs.filter(questiontag__topic_id__in=topic_ids_set).distinct()
-
-        return fallback_qs.order_by("?").first()
-
-    # -------- 5) Ngẫu nhiên nhẹ giữa các câu có score tốt nhất --------
-    return random.choice(best)
+def _pick_random(bank, positions) -> Optional[int]:
+    """Chọn ngẫu nhiên 1 id câu trong các vị trí của item bank (None nếu rỗng)."""
+    from assessment.services.sampling import sample_ids
+
+    picked = sample_ids(bank.question_ids[positions], 1)
+    return picked[0] if picked else None
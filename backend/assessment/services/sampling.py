@@ -0,0 +1,117 @@
+# assessment/services/sampling.py
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional, Tuple
+import threading
+
+import numpy as np
+
+from assessment.services.item_bank import ITEM_BANK_VERSION
+from assessment.services.topic_index import QUESTION_TOPICS_VERSION
+from assessment.services.versioning import local_version
+
+
+# Thay cho order_by("?"): ORDER BY RANDOM() phải sort cả bảng đã filter.
+# Ở đây giữ sẵn mảng id theo bộ lọc (subject, topic, difficulty_tag), bốc k id
+# ngẫu nhiên trong bộ nhớ rồi chỉ fetch đúng k dòng đó.
+
+_rng = np.random.default_rng()
+
+_pools: Dict[Tuple[int, Optional[int], Optional[str]], Tuple[tuple, np.ndarray]] = {}
+_pools_lock = threading.Lock()
+
+
+def question_id_pool(
+    subject_id: int,
+    topic_id: Optional[int] = None,
+    difficulty_tag: Optional[str] = None,
+) -> np.ndarray:
+    """
+    Mảng id câu hỏi (tăng dần) cho 1 bộ lọc, cache trong process.
+
+    Invalidate cùng version với item bank của môn (Question đổi); pool lọc theo
+    topic còn theo version CSR câu-topic (QuestionTag đổi).
+    """
+    key = (subject_id, topic_id, difficulty_tag)
+    version = (
+        local_version(ITEM_BANK_VERSION, subject_id),
+        local_version(QUESTION_TOPICS_VERSION, subject_id) if topic_id is not None else None,
+    )
+    cached = _pools.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    from assessment.models import Question
+
+    qs = Question.objects.filter(subject_id=subject_id)
+    if topic_id is not None:
+        qs = qs.filter(tags__topic_id=topic_id)
+    if difficulty_tag is not None:
+        qs = qs.filter(difficulty_tag=difficulty_tag)
+    ids = np.unique(np.fromiter(qs.values_list("id", flat=True), dtype=np.int64))
+
+    with _pools_lock:
+        _pools[key] = (version, ids)
+    return ids
+
+
+def sample_ids(pool: np.ndarray, k: int, exclude_ids: Iterable[int] = ()) -> List[int]:
+    """
+    Bốc k id phân biệt, ngẫu nhiên đều, từ pool (bỏ qua exclude_ids).
+
+    Rejection sampling: chi phí ~O(k) khi số id bị loại nhỏ so với pool;
+    nếu bị loại quá nhiều mới lọc cả pool.
+    """
+    n = len(pool)
+    if k <= 0 or n == 0:
+        return []
+    exclude = set(exclude_ids)
+
+    if not exclude:
+        picks = _rng.choice(n, size=min(k, n), replace=False)
+        return pool[picks].tolist()
+
+    chosen: List[int] = []
+    seen: set = set()
+    for _ in range(4 * k + 8):
+        qid = int(pool[_rng.integers(n)])
+        if qid in seen or qid in exclude:
+            continue
+        seen.add(qid)
+        chosen.append(qid)
+        if len(chosen) == k:
+            return chosen
+
+    # Pool gần cạn: lọc hẳn rồi bốc phần còn thiếu
+    rest = pool[~np.isin(pool, np.fromiter(exclude | seen, dtype=np.int64))]
+    if len(rest):
+        more = _rng.choice(len(rest), size=min(k - len(chosen), len(rest)), replace=False)
+        chosen.extend(rest[more].tolist())
+    return chosen
+
+
+def fetch_in_order(ids: List[int], queryset=None) -> list:
+    """Fetch đúng các dòng theo ids, giữ nguyên thứ tự ngẫu nhiên đã bốc."""
+    from assessment.models import Question
+
+    if not ids:
+        return []
+    qs = queryset if queryset is not None else Question.objects.all()
+    by_id = {q.id: q for q in qs.filter(id__in=ids)}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+def sample_questions(
+    subject_id: int,
+    k: int,
+    *,
+    topic_id: Optional[int] = None,
+    difficulty_tag: Optional[str] = None,
+    exclude_ids: Iterable[int] = (),
+    queryset=None,
+) -> list:
+    """
+    k câu ngẫu nhiên (không trùng) theo bộ lọc; queryset dùng để thêm
+    select_related / prefetch_related cho lần fetch duy nhất.
+    """
+    pool = question_id_pool(subject_id, topic_id, difficulty_tag)
+    return fetch_in_order(sample_ids(pool, k, exclude_ids), queryset)
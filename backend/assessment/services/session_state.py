@@ -0,0 +1,176 @@
+# assessment/services/session_state.py
+from __future__ import annotations
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from assessment.services.mastery import decayed, mastery_decay
+
+
+# Trạng thái phiên CAT giữ trong cache suốt phiên: câu đã phát, vector năng lực,
+# bộ đếm mastery. Mỗi bước đọc từ cache thay vì query lại DB; DB vẫn là nguồn
+# gốc (TestItem / TestResponse / profile ghi cuối request) nên mất cache chỉ
+# tốn 1 lần dựng lại.
+DEFAULT_STATE_TTL = 3 * 60 * 60
+
+
+def _key(session_id) -> str:
+    return f"cat:state:{session_id}"
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "CAT_SESSION_STATE_TTL", DEFAULT_STATE_TTL))
+
+
+@dataclass
+class CatSessionState:
+    session_id: str
+    student_id: int
+    subject_id: int
+    topic_id: Optional[int]
+    target_items: int
+    version: int = 0                                           # = TestSession.version lúc ghi
+    used_ids: List[int] = field(default_factory=list)       # theo thứ tự phát (position = index + 1)
+    abilities: Dict[int, float] = field(default_factory=dict)  # {topic_id: theta} của môn
+    mastery: Dict[int, List[float]] = field(default_factory=dict)  # {topic_id: [correct, total]}
+    stable_steps: int = 0                                       # bộ đếm luật dừng min_delta_theta
+
+    @property
+    def position(self) -> int:
+        return len(self.used_ids)
+
+    @property
+    def current_question_id(self) -> Optional[int]:
+        return self.used_ids[-1] if self.used_ids else None
+
+    @property
+    def avg_theta(self) -> float:
+        return sum(self.abilities.values()) / len(self.abilities) if self.abilities else 0.0
+
+    def topic_ids(self) -> Optional[List[int]]:
+        """topic khoá của phiên (None = cả môn), dạng truyền cho select_next_item_id."""
+        return [self.topic_id] if self.topic_id is not None else None
+
+    def mastery_ratios(self) -> Dict[int, float]:
+        return {tid: cw / tw for tid, (cw, tw) in self.mastery.items() if tw > 0}
+
+    def add_mastery(self, topic_ids: Iterable[int], y: int) -> set:
+        """Cộng phản hồi vào bộ đếm mastery; trả về các topic đã có bộ đếm trước đó."""
+        decay = mastery_decay()
+        existing = set()
+        for tid in topic_ids:
+            if tid in self.mastery:
+                existing.add(tid)
+            cw, tw = self.mastery.get(tid, (0.0, 0.0))
+            self.mastery[tid] = list(decayed(cw, tw, y, decay))
+        return existing
+
+
+def build_state(
+    session,
+    used_ids: Optional[List[int]] = None,
+    profiles: Optional[Dict[int, object]] = None,
+) -> CatSessionState:
+    """
+    Dựng trạng thái từ DB (3 query: câu đã phát, năng lực, mastery).
+    used_ids: truyền sẵn (vd: phiên vừa tạo -> []) để bỏ qua query TestItem.
+    profiles: {topic_id: profile} của môn đã đọc sẵn (load_profiles) -> bỏ qua query năng lực.
+    """
+    from assessment.models import StudentAbilityProfile, TopicMastery
+
+    if used_ids is None:
+        used_ids = list(
+            session.items.order_by("position").values_list("question_id", flat=True)
+        )
+    if profiles is not None:
+        abilities = {tid: p.theta for tid, p in profiles.items()}
+    else:
+        abilities = dict(
+            StudentAbilityProfile.objects
+            .filter(student_id=session.student_id, topic__subject_id=session.subject_id)
+            .values_list("topic_id", "theta")
+        )
+    mastery = {
+        tid: [cw, tw]
+        for tid, cw, tw in TopicMastery.objects
+        .filter(student_id=session.student_id, topic__subject_id=session.subject_id)
+        .values_list("topic_id", "correct_weight", "total_weight")
+    }
+    return CatSessionState(
+        session_id=str(session.id),
+        student_id=session.student_id,
+        subject_id=session.subject_id,
+        topic_id=session.topic_id,
+        target_items=session.target_items,
+        version=session.version,
+        used_ids=used_ids,
+        abilities=abilities,
+        mastery=mastery,
+    )
+
+
+async def abuild_state(
+    session,
+    used_ids: Optional[List[int]] = None,
+    profiles: Optional[Dict[int, object]] = None,
+) -> CatSessionState:
+    """Bản async của build_state (async ORM; các query vẫn chạy lần lượt)."""
+    from assessment.models import TopicMastery
+    from assessment.services.ability import aload_profiles
+
+    async def _used_ids():
+        if used_ids is not None:
+            return used_ids
+        return [
+            qid async for qid in
+            session.items.order_by("position").values_list("question_id", flat=True)
+        ]
+
+    async def _profiles():
+        if profiles is not None:
+            return profiles
+        return await aload_profiles(session.student_id, session.subject_id)
+
+    async def _mastery():
+        return {
+            tid: [cw, tw]
+            async for tid, cw, tw in TopicMastery.objects
+            .filter(student_id=session.student_id, topic__subject_id=session.subject_id)
+            .values_list("topic_id", "correct_weight", "total_weight")
+        }
+
+    used, profs, mastery = await _used_ids(), await _profiles(), await _mastery()
+    return CatSessionState(
+        session_id=str(session.id),
+        student_id=session.student_id,
+        subject_id=session.subject_id,
+        topic_id=session.topic_id,
+        target_items=session.target_items,
+        version=session.version,
+        used_ids=used,
+        abilities={tid: p.theta for tid, p in profs.items()},
+        mastery=mastery,
+    )
+
+
+def load_state(session_id) -> Optional[CatSessionState]:
+    data = cache.get(_key(session_id))
+    return CatSessionState(**data) if data is not None else None
+
+
+async def aload_state(session_id) -> Optional[CatSessionState]:
+    data = await cache.aget(_key(session_id))
+    return CatSessionState(**data) if data is not None else None
+
+
+def save_state(state: CatSessionState) -> None:
+    """Ghi trạng thái vào cache sau khi transaction commit (rollback -> giữ bản cũ)."""
+    data = asdict(state)
+    transaction.on_commit(lambda: cache.set(_key(state.session_id), data, _ttl()))
+
+
+def drop_state(session_id) -> None:
+    transaction.on_commit(lambda: cache.delete(_key(session_id)))
@@ -0,0 +1,178 @@
+# assessment/services/speculation.py
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+import copy
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+
+from assessment.services.ability import apply_response
+from assessment.services.item_bank import bank_version
+from assessment.services.rules import RULES_VERSION, evaluate_rules, select_next_item_id
+from assessment.services.versioning import get_version
+
+logger = logging.getLogger(__name__)
+
+# Trong lúc học sinh đọc câu n, tính trước câu n+1 cho cả 2 nhánh đúng/sai.
+# post_answer chỉ cần kiểm tra nhánh + dấu vân tay rồi đọc 1 key cache.
+SPECULATION_TTL = 30 * 60
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def speculation_enabled() -> bool:
+    return bool(getattr(settings, "CAT_SPECULATIVE_PREFETCH", False))
+
+
+def _key(session_id, question_id) -> str:
+    return f"cat:spec:{session_id}:{question_id}"
+
+
+def ability_fingerprint(ability_vector: Dict[int, float]) -> list:
+    """So khớp vector năng lực (làm tròn để bỏ qua sai số float khi đọc lại từ DB)."""
+    return sorted((int(t), round(float(v), 6)) for t, v in ability_vector.items())
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(getattr(settings, "CAT_SPECULATIVE_WORKERS", 2))
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cat-spec")
+    return _executor
+
+
+def schedule_prefetch(session_id, question_id) -> None:
+    """Sau khi commit câu vừa phát, tính trước câu kế tiếp ở thread nền (nếu bật)."""
+    if not speculation_enabled():
+        return
+    transaction.on_commit(
+        lambda: _get_executor().submit(_run_prefetch, session_id, question_id)
+    )
+
+
+def _run_prefetch(session_id, question_id) -> None:
+    close_old_connections()
+    try:
+        prefetch_branches(session_id, question_id)
+    except Exception:
+        logger.exception("Speculative prefetch lỗi (session=%s, question=%s)", session_id, question_id)
+    finally:
+        close_old_connections()
+
+
+def prefetch_branches(session_id, question_id) -> Optional[dict]:
+    """
+    Tính câu kế tiếp cho y=0 và y=1 của câu question_id rồi lưu vào cache.
+
+    Mỗi nhánh: cập nhật năng lực giả định (không ghi DB), evaluate_rules với
+    phản hồi giả định, select_next_item_id như post_answer sẽ làm.
+    """
+    from assessment.models import (
+        Question, QuestionTag, StudentAbilityProfile, TestSession,
+    )
+
+    session = TestSession.objects.filter(id=session_id, status="ONGOING").first()
+    if session is None:
+        return None
+    q = Question.objects.select_related("irt").filter(id=question_id).first()
+    irt = getattr(q, "irt", None) if q is not None else None
+    if irt is None:
+        return None
+
+    used_ids = set(session.items.values_list("question_id", flat=True))
+    item_count = len(used_ids)
+    if item_count >= session.target_items:
+        return None  # chắc chắn dừng, không cần câu tiếp
+
+    profiles = {
+        p.topic_id: p
+        for p in StudentAbilityProfile.objects.filter(
+            student_id=session.student_id,
+            topic__subject_id=session.subject_id,
+        )
+    }
+    q_topic_ids = set(
+        QuestionTag.objects.filter(question_id=q.id).values_list("topic_id", flat=True)
+    )
+    topic_ids = [session.topic_id] if session.topic_id is not None else None
+
+    payload = {
+        "item_bank_version": bank_version(session.subject_id),
+        "rules_version": get_version(RULES_VERSION),
+        "position": item_count,
+        "branches": {},
+    }
+
+    for y in (0, 1):
+        ability_vector = {tid: p.theta for tid, p in profiles.items()}
+        for tid in q_topic_ids:
+            p = copy.copy(profiles.get(tid)) or StudentAbilityProfile(
+                student_id=session.student_id, topic_id=tid, theta=0.0, se=1.0,
+            )
+            apply_response(p, irt.a, irt.b, irt.c, y)
+            ability_vector[tid] = p.theta
+        avg_theta = (sum(ability_vector.values()) / len(ability_vector)) if ability_vector else 0.0
+
+        rule_ctx = evaluate_rules(
+            student_id=session.student_id,
+            subject_id=session.subject_id,
+            ability_vector=ability_vector,
+            pending_response=(q.id, y),
+        )
+        next_qid = select_next_item_id(
+            ability_vector=ability_vector,
+            avg_theta=avg_theta,
+            subject_id=session.subject_id,
+            used_q_ids=used_ids,
+            rule_ctx=rule_ctx,
+            position_in_session=item_count + 1,
+            topic_ids=topic_ids,
+        )
+        payload["branches"][y] = {
+            "question_id": next_qid,
+            "abilities": ability_fingerprint(ability_vector),
+        }
+
+    cache.set(_key(session_id, question_id), payload, SPECULATION_TTL)
+    return payload
+
+
+def take_prefetched(
+    session_id,
+    question_id,
+    y: int,
+    *,
+    subject_id: int,
+    ability_vector: Dict[int, float],
+    position: int,
+) -> Optional[int]:
+    """
+    Lấy câu đã tính trước cho nhánh y (dùng 1 lần).
+
+    Trả về None (-> chọn câu trực tiếp) nếu chưa tính xong, hoặc trạng thái đã
+    đổi kể từ lúc tính: luật, ngân hàng câu, năng lực hay vị trí trong phiên.
+    """
+    if not speculation_enabled():
+        return None
+    key = _key(session_id, question_id)
+    payload = cache.get(key)
+    if payload is None:
+        return None
+    cache.delete(key)
+
+    branch = payload["branches"].get(y)
+    if (
+        branch is None
+        or payload["position"] != position
+        or payload["rules_version"] != get_version(RULES_VERSION)
+        or payload["item_bank_version"] != bank_version(subject_id)
+        or branch["abilities"] != ability_fingerprint(ability_vector)
+    ):
+        return None
+    return branch["question_id"]
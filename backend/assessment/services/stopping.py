@@ -0,0 +1,178 @@
+# assessment/services/stopping.py
+from __future__ import annotations
+from dataclasses import dataclass
+from statistics import NormalDist
+from typing import Dict, Iterable, Optional
+
+
+# Luật dừng CAT cấu hình được theo môn (Subject.stopping_policy) và theo phiên
+# (TestSession.stopping_policy, gộp đè lên của môn lúc bắt đầu phiên).
+# Đánh giá sau mỗi bước từ trạng thái trong request (profile đã cập nhật,
+# bộ đếm trong CatSessionState), không query thêm.
+#
+# Các khoá (thiếu -> mặc định: SE < 0.3 sau ít nhất 5 câu, hoặc đủ target_items):
+#   min_items        : chưa đủ số câu này thì không dừng theo độ chính xác
+#                      (SE tính trên posterior cả lịch sử, được nới ở câu đầu phiên -
+#                      ability.widen_profiles - nên phiên nào cũng phải đo lại vài câu)
+#   max_items        : trần số câu (kẹp thêm bởi target_items của phiên)
+#   se_threshold     : dừng khi SE trung bình trên topic mục tiêu < ngưỡng (None = tắt)
+#   target_topic_ids : topic mục tiêu; mặc định topic khoá của phiên, không có
+#                      thì các topic của câu vừa làm
+#   min_delta_theta  : dừng khi |Δθ| trung bình < ngưỡng ...
+#   delta_window     : ... trong chừng này bước liên tiếp
+#   cut_score        : điểm cắt θ để phân loại đạt / chưa đạt
+#   cut_confidence   : dừng khi P(θ phía trên / dưới cut_score) >= mức này
+DEFAULT_POLICY = {
+    "min_items": 5,
+    "max_items": None,
+    "se_threshold": 0.3,
+    "target_topic_ids": None,
+    "min_delta_theta": None,
+    "delta_window": 2,
+    "cut_score": None,
+    "cut_confidence": 0.95,
+}
+
+
+def validate_policy(policy: Optional[dict]) -> dict:
+    """Kiểm tra policy (chỉ các khoá đã biết, kiểu / miền hợp lệ); sai -> ValueError."""
+    policy = dict(policy or {})
+    unknown = set(policy) - set(DEFAULT_POLICY)
+    if unknown:
+        raise ValueError(f"Khoá không hợp lệ trong stopping_policy: {sorted(unknown)}")
+
+    def _num(key, lo=None, hi=None, integer=False):
+        v = policy.get(key)
+        if v is None:
+            return
+        if isinstance(v, bool) or not isinstance(v, (int, float)) or (integer and not isinstance(v, int)):
+            raise ValueError(f"stopping_policy.{key} phải là số{' nguyên' if integer else ''}")
+        if (lo is not None and v < lo) or (hi is not None and v > hi):
+            raise ValueError(f"stopping_policy.{key} ngoài miền cho phép")
+
+    _num("min_items", lo=1, integer=True)
+    _num("max_items", lo=1, integer=True)
+    _num("se_threshold", lo=0)
+    _num("min_delta_theta", lo=0)
+    _num("delta_window", lo=1, integer=True)
+    _num("cut_score")
+    _num("cut_confidence", lo=0.5, hi=0.9999)
+
+    tids = policy.get("target_topic_ids")
+    if tids is not None and (
+        not isinstance(tids, list) or not all(isinstance(t, int) and not isinstance(t, bool) for t in tids)
+    ):
+        raise ValueError("stopping_policy.target_topic_ids phải là list id topic")
+    if policy.get("min_items") and policy.get("max_items") and policy["min_items"] > policy["max_items"]:
+        raise ValueError("stopping_policy.min_items lớn hơn max_items")
+    return policy
+
+
+def resolve_policy(*layers: Optional[dict]) -> dict:
+    """Gộp mặc định <- môn <- phiên (lớp sau đè lớp trước, bỏ qua giá trị không đặt)."""
+    out = dict(DEFAULT_POLICY)
+    for layer in layers:
+        out.update(layer or {})
+    return out
+
+
+@dataclass(frozen=True)
+class StopDecision:
+    stop: bool
+    reason: Optional[str] = None          # max_items / se / delta_theta / classification
+    classification: Optional[str] = None  # above / below (khi có cut_score và đủ tin cậy)
+    stable_steps: int = 0                  # số bước liên tiếp |Δθ| < min_delta_theta
+
+
+def evaluate_stop(
+    policy: dict,
+    *,
+    n_items: int,
+    target_items: int,
+    thetas: Dict[int, float],
+    ses: Dict[int, float],
+    prior_thetas: Dict[int, float],
+    answered_topic_ids: Iterable[int],
+    session_topic_id: Optional[int] = None,
+    stable_steps: int = 0,
+) -> StopDecision:
+    """
+    Quyết định dừng sau 1 bước.
+
+    thetas / ses: θ, SE hiện tại theo topic (sau cập nhật); prior_thetas: θ các
+    topic vừa được cập nhật trước bước này (rỗng nếu bước không cập nhật IRT);
+    stable_steps: bộ đếm của bước trước.
+    """
+    answered_topic_ids = list(answered_topic_ids)
+
+    # -------- 1) Δθ của bước (topic vừa cập nhật) -> bộ đếm ổn định --------
+    # Bước không cập nhật posterior (câu chưa calibrate: prior_thetas rỗng)
+    # không có Δθ -> giữ nguyên bộ đếm, không tính là "ổn định"
+    min_delta = policy.get("min_delta_theta")
+    if min_delta is None:
+        stable_steps = 0
+    elif prior_thetas:
+        delta = sum(abs(thetas.get(tid, th) - th) for tid, th in prior_thetas.items()) / len(prior_thetas)
+        stable_steps = stable_steps + 1 if delta < min_delta else 0
+
+    # -------- 2) Trần số câu --------
+    targets = _targets(policy, session_topic_id, answered_topic_ids)
+    max_items = min(target_items, policy.get("max_items") or target_items)
+    if n_items >= max_items:
+        return StopDecision(True, "max_items", _classify(policy, thetas, ses, targets), stable_steps)
+    if n_items < (policy.get("min_items") or 1):
+        return StopDecision(False, stable_steps=stable_steps)
+
+    # -------- 3) Độ chính xác: SE trên topic mục tiêu --------
+    se_threshold = policy.get("se_threshold")
+    if se_threshold is not None and targets:
+        avg_se = sum(ses.get(tid, 1.0) for tid in targets) / len(targets)
+        if avg_se < se_threshold:
+            return StopDecision(True, "se", _classify(policy, thetas, ses, targets), stable_steps)
+
+    # -------- 4) Ước lượng không còn thay đổi --------
+    if min_delta is not None and stable_steps >= (policy.get("delta_window") or 1):
+        return StopDecision(True, "delta_theta", _classify(policy, thetas, ses, targets), stable_steps)
+
+    # -------- 5) Phân loại đủ tin cậy so với điểm cắt --------
+    classification = _classify(policy, thetas, ses, targets)
+    if classification is not None:
+        return StopDecision(True, "classification", classification, stable_steps)
+
+    return StopDecision(False, stable_steps=stable_steps)
+
+
+def _targets(policy, session_topic_id, answered_topic_ids) -> list:
+    if policy.get("target_topic_ids"):
+        return list(policy["target_topic_ids"])
+    if session_topic_id is not None:
+        return [session_topic_id]
+    return list(answered_topic_ids)
+
+
+def _classify(policy, thetas, ses, targets) -> Optional[str]:
+    """above / below nếu θ trung bình trên topic mục tiêu tách khỏi cut_score đủ tin cậy."""
+    cut = policy.get("cut_score")
+    if cut is None or not targets:
+        return None
+    theta = sum(thetas.get(tid, 0.0) for tid in targets) / len(targets)
+    se = sum(ses.get(tid, 1.0) for tid in targets) / len(targets)
+    z = NormalDist().inv_cdf(policy.get("cut_confidence") or DEFAULT_POLICY["cut_confidence"])
+    if se <= 0:
+        return "above" if theta >= cut else "below"
+    if (theta - cut) / se >= z:
+        return "above"
+    if (cut - theta) / se >= z:
+        return "below"
+    return None
+
+
+def session_policy(subject_id: int, overrides: Optional[dict] = None) -> dict:
+    """
+    Policy chốt cho phiên mới: của môn + tuỳ chỉnh của phiên (1 query).
+    Kiểm tra lại sau khi gộp (vd: min_items của môn > max_items của phiên) -> ValueError.
+    """
+    from assessment.models import Subject
+
+    base = Subject.objects.filter(id=subject_id).values_list("stopping_policy", flat=True).first()
+    return validate_policy({**(base or {}), **(overrides or {})})
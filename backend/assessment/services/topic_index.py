@@ -0,0 +1,189 @@
+# assessment/services/topic_index.py
+from __future__ import annotations
+from typing import Dict, Iterable, Optional
+import threading
+
+import numpy as np
+
+from assessment.services.versioning import local_version
+
+
+QUESTION_TOPICS_VERSION = "question_topics"
+
+
+class QuestionTopicCSR:
+    """
+    Quan hệ câu ↔ topic của 1 môn ở dạng CSR (thay cho dict {qid: set(topic)}).
+
+    - question_ids: id câu (tăng dần), hàng i của CSR
+    - topic_ids: id topic (tăng dần), cột k của CSR
+    - offsets: topic của câu i là cols[offsets[i]:offsets[i+1]]
+    - cols: chỉ số cột topic của từng phần tử
+    Bộ nhớ ~ O(số QuestionTag) thay vì O(số câu * số topic).
+    """
+
+    def __init__(self, question_ids, topic_ids, offsets, cols, version=None):
+        self.question_ids = question_ids
+        self.topic_ids = topic_ids
+        self.offsets = offsets
+        self.cols = cols
+        self.version = version
+
+        self.lengths = np.diff(offsets)
+        # Hàng của từng phần tử (để cộng dồn theo câu bằng bincount)
+        self.rows = np.repeat(np.arange(len(question_ids)), self.lengths)
+        # Dạng CSC (topic -> câu), build lười ở lần đầu cần pool theo topic
+        self._csc: Optional[tuple[np.ndarray, np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return len(self.question_ids)
+
+    @property
+    def nnz(self) -> int:
+        return len(self.cols)
+
+    def topics_of(self, question_id: int) -> list[int]:
+        """topic_id của 1 câu (câu ngoài môn -> [])."""
+        pos = int(np.searchsorted(self.question_ids, question_id))
+        if pos >= len(self) or self.question_ids[pos] != question_id:
+            return []
+        return self.topic_ids[self.cols[self.offsets[pos]:self.offsets[pos + 1]]].tolist()
+
+    def columns_of(self, topic_ids: Iterable[int]) -> np.ndarray:
+        """Chỉ số cột của các topic_ids (topic ngoài môn bị bỏ qua)."""
+        tids = np.fromiter(topic_ids, dtype=np.int64)
+        return np.flatnonzero(np.isin(self.topic_ids, tids))
+
+    def column_vector(self, values: Dict[int, float], default: float) -> tuple[np.ndarray, np.ndarray]:
+        """dict {topic_id: value} -> (giá trị theo cột, mask cột có giá trị)."""
+        vec = np.full(len(self.topic_ids), default, dtype=float)
+        has = np.zeros(len(self.topic_ids), dtype=bool)
+        if values:
+            for k, tid in enumerate(self.topic_ids.tolist()):
+                v = values.get(tid)
+                if v is not None:
+                    vec[k] = v
+                    has[k] = True
+        return vec, has
+
+    def _entries(self, idx: Optional[np.ndarray]) -> tuple[np.ndarray, np.ndarray, int]:
+        """
+        Các phần tử CSR của những hàng idx.
+        Trả về (chỉ số phần tử, hàng cục bộ 0..len(idx)-1, số hàng).
+        """
+        if idx is None:
+            return np.arange(self.nnz), self.rows, len(self)
+        idx = np.asarray(idx, dtype=np.int64)
+        lens = self.lengths[idx]
+        total = int(lens.sum())
+        local = np.repeat(np.arange(len(idx)), lens)
+        # start của hàng + vị trí trong hàng
+        within = np.arange(total) - np.repeat(np.cumsum(lens) - lens, lens)
+        return np.repeat(self.offsets[idx], lens) + within, local, len(idx)
+
+    def row_mean(self, values: np.ndarray, has: np.ndarray, default: float, idx=None) -> np.ndarray:
+        """
+        Trung bình values[cột] trên các topic (có giá trị) của từng câu;
+        câu không có topic nào có giá trị -> default.
+        """
+        ent, local, n = self._entries(idx)
+        c = self.cols[ent]
+        w = has[c].astype(float)
+        tot = np.bincount(local, weights=values[c] * w, minlength=n)
+        cnt = np.bincount(local, weights=w, minlength=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(cnt > 0, tot / cnt, default)
+
+    def row_product(self, factors: np.ndarray, idx=None) -> np.ndarray:
+        """Tích factors[cột] trên tất cả topic của từng câu (câu không topic -> 1.0)."""
+        ent, local, n = self._entries(idx)
+        logs = np.log(np.maximum(factors, 1e-300))[self.cols[ent]]
+        return np.exp(np.bincount(local, weights=logs, minlength=n))
+
+    def rows_with_any(self, cols: np.ndarray, idx=None) -> np.ndarray:
+        """Mask: câu có ít nhất 1 topic thuộc cols."""
+        ent, local, n = self._entries(idx)
+        if not len(cols):
+            return np.zeros(n, dtype=bool)
+        col_mask = np.zeros(len(self.topic_ids), dtype=bool)
+        col_mask[cols] = True
+        return np.bincount(local, weights=col_mask[self.cols[ent]], minlength=n) > 0
+
+    def _transpose(self) -> tuple[np.ndarray, np.ndarray]:
+        """(col_offsets, col_rows): câu của cột k là col_rows[col_offsets[k]:col_offsets[k+1]]."""
+        if self._csc is None:
+            order = np.argsort(self.cols, kind="stable")  # stable -> hàng tăng dần trong cột
+            counts = np.bincount(self.cols, minlength=len(self.topic_ids))
+            col_offsets = np.zeros(len(self.topic_ids) + 1, dtype=np.int64)
+            np.cumsum(counts, out=col_offsets[1:])
+            self._csc = (col_offsets, self.rows[order])
+        return self._csc
+
+    def column_rows(self, col: int) -> np.ndarray:
+        """Các câu (hàng, tăng dần) gắn topic ở cột col."""
+        col_offsets, col_rows = self._transpose()
+        return col_rows[col_offsets[col]:col_offsets[col + 1]]
+
+    def columns_rows(self, cols: np.ndarray) -> np.ndarray:
+        """Các câu gắn ít nhất 1 topic trong cols; chi phí ~ tổng kích thước các topic."""
+        if len(cols) == 1:
+            return self.column_rows(int(cols[0]))
+        if not len(cols):
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([self.column_rows(int(k)) for k in cols]))
+
+    def untagged_rows(self) -> np.ndarray:
+        """Các câu không gắn topic nào."""
+        return np.flatnonzero(self.lengths == 0)
+
+
+def build_question_topics(subject_id: int, version=None) -> QuestionTopicCSR:
+    """
+    Build CSR từ DB bằng 1 query (Question LEFT JOIN QuestionTag): tập câu và các
+    cặp câu-topic lấy từ cùng 1 snapshot, không lệch nhau khi câu / tag đổi giữa chừng.
+    """
+    from assessment.models import Question
+
+    rel = list(
+        Question.objects
+        .filter(subject_id=subject_id)
+        .values_list("id", "tags__topic_id")
+        .distinct()
+    )
+    question_ids = np.unique(np.fromiter((r[0] for r in rel), dtype=np.int64, count=len(rel)))
+    # Câu không gắn topic: 1 hàng (id, None) -> vẫn có hàng trong CSR, 0 cột
+    rel = [r for r in rel if r[1] is not None]
+    rel_q = np.fromiter((r[0] for r in rel), dtype=np.int64, count=len(rel))
+    rel_t = np.fromiter((r[1] for r in rel), dtype=np.int64, count=len(rel))
+    topic_ids = np.unique(rel_t)
+
+    rows = np.searchsorted(question_ids, rel_q)
+    cols = np.searchsorted(topic_ids, rel_t).astype(np.int32)
+    order = np.lexsort((cols, rows))
+    counts = np.bincount(rows, minlength=len(question_ids))
+    offsets = np.zeros(len(question_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return QuestionTopicCSR(question_ids, topic_ids, offsets, cols[order], version)
+
+
+_csrs: Dict[int, QuestionTopicCSR] = {}
+_csrs_lock = threading.Lock()
+
+
+def get_question_topics(subject_id: int) -> QuestionTopicCSR:
+    """
+    CSR câu ↔ topic dùng chung trong process cho 1 môn.
+    Build lại khi QuestionTag (hoặc tập câu) của môn thay đổi.
+    """
+    version = local_version(QUESTION_TOPICS_VERSION, subject_id)
+    csr = _csrs.get(subject_id)
+    if csr is not None and csr.version == version:
+        return csr
+
+    with _csrs_lock:
+        csr = _csrs.get(subject_id)
+        if csr is None or csr.version != version:
+            csr = build_question_topics(subject_id, version)
+            _csrs[subject_id] = csr
+    return csr
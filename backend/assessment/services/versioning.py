@@ -0,0 +1,64 @@
+# assessment/services/versioning.py
+"""
+Bộ đếm phiên bản (version counter) trong cache framework của Django.
+
+Các cache trong process (item bank, rule set, ...) ghi kèm version lúc build;
+mỗi lần dữ liệu gốc đổi thì bump version -> lần đọc sau tự build lại.
+Chạy nhiều process/worker thì cần cache dùng chung (REDIS_URL trong settings)
+để version được thấy ở mọi process; LocMemCache chỉ có hiệu lực trong 1 process.
+Lưới an toàn: index trong process so theo local_version, tự build lại sau
+CAT_LOCAL_INDEX_TTL giây kể cả khi không thấy version đổi.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+DEFAULT_LOCAL_INDEX_TTL = 5 * 60
+
+
+def _key(name: str, scope=None) -> str:
+    return f"ver:{name}" if scope is None else f"ver:{name}:{scope}"
+
+
+def get_version(name: str, scope=None) -> int:
+    """Version hiện tại; key chưa có (hoặc bị evict) -> khởi tạo giá trị mới."""
+    key = _key(name, scope)
+    ver = cache.get(key)
+    if ver is None:
+        # Dùng time_ns thay vì 1 để key bị evict không quay lại version cũ
+        cache.add(key, time.time_ns(), timeout=None)
+        ver = cache.get(key)
+    return ver
+
+
+def bump_version(name: str, scope=None) -> int:
+    """Tăng version -> mọi cache đang giữ version cũ bị coi là hết hạn."""
+    key = _key(name, scope)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+        return cache.get(key)
+
+
+def get_versions(name: str, scopes) -> dict:
+    """get_version cho nhiều scope cùng lúc: {scope: version} (1 lần get_many)."""
+    keys = {_key(name, scope): scope for scope in scopes}
+    found = cache.get_many(list(keys))
+    out = {keys[k]: v for k, v in found.items()}
+    for key, scope in keys.items():
+        if scope not in out:
+            out[scope] = get_version(name, scope)
+    return out
+
+
+def local_version(name: str, scope=None) -> tuple:
+    """
+    Version cho index giữ trong process: (version, ô thời gian CAT_LOCAL_INDEX_TTL).
+    Ô thời gian theo đồng hồ của process -> index cũ nhất cũng bị build lại sau
+    1 TTL, các worker không build lại cùng lúc.
+    """
+    ttl = int(getattr(settings, "CAT_LOCAL_INDEX_TTL", DEFAULT_LOCAL_INDEX_TTL))
+    epoch = int(time.monotonic() // ttl) if ttl > 0 else 0
+    return get_version(name, scope), epoch
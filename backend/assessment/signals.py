@@ -0,0 +1,63 @@
+# assessment/signals.py
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from assessment.models import Question, QuestionIRT, QuestionOption, QuestionTag, Rule
+from assessment.services.item_bank import ITEM_BANK_VERSION
+from assessment.services.question_cache import invalidate_question_payload
+from assessment.services.rules import RULES_VERSION
+from assessment.services.topic_index import QUESTION_TOPICS_VERSION
+from assessment.services.versioning import bump_version
+
+
+def _bump_on_commit(name, subject_id):
+    # Bump sau commit để process khác không build lại index từ dữ liệu chưa commit
+    transaction.on_commit(lambda: bump_version(name, subject_id))
+
+
+def _subject_of(question_id):
+    return (
+        Question.objects
+        .filter(id=question_id)
+        .values_list("subject_id", flat=True)
+        .first()
+    )
+
+
+@receiver([post_save, post_delete], sender=Question)
+def question_changed(sender, instance, created=False, **kwargs):
+    _bump_on_commit(ITEM_BANK_VERSION, instance.subject_id)
+    # Thêm / xoá câu đổi tập hàng của CSR câu-topic
+    if created or kwargs["signal"] is post_delete:
+        _bump_on_commit(QUESTION_TOPICS_VERSION, instance.subject_id)
+    # Nội dung câu đổi (stem, item_type, ...) -> payload đã serialize hết hạn
+    if not created:
+        invalidate_question_payload(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=QuestionOption)
+def question_option_changed(sender, instance, **kwargs):
+    # QuestionWriteSerializer.update xoá + tạo lại options -> mỗi option 1 signal,
+    # cùng bump 1 version của câu
+    invalidate_question_payload(instance.question_id)
+
+
+@receiver([post_save, post_delete], sender=QuestionIRT)
+def question_irt_changed(sender, instance, **kwargs):
+    subject_id = _subject_of(instance.question_id)
+    # None: đang xoá dây chuyền từ Question, signal của Question đã bump rồi
+    if subject_id is not None:
+        _bump_on_commit(ITEM_BANK_VERSION, subject_id)
+
+
+@receiver([post_save, post_delete], sender=QuestionTag)
+def question_tag_changed(sender, instance, **kwargs):
+    subject_id = _subject_of(instance.question_id)
+    if subject_id is not None:
+        _bump_on_commit(QUESTION_TOPICS_VERSION, subject_id)
+
+
+@receiver([post_save, post_delete], sender=Rule)
+def rule_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: bump_version(RULES_VERSION))
@@ -1,3 +1,433 @@
-from django.test import TestCase
+# assessment/tests.py
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from assessment import views
+from assessment.models import (
+    Question, QuestionIRT, QuestionOption, QuestionTag, StudentAbilityProfile, Subject, TestResponse,
+    TestSession, Topic, TopicMastery,
+)
+from assessment.services.ability import apply_response
+from assessment.services.calibration import PARAM_MAX, OnlineCalibrator
+from assessment.services.exposure import recent_exposures
+from assessment.services.idempotency import begin_step, step_key
+from assessment.services.irt import eap_log_prior
+from assessment.services.mastery import record_mastery
+from assessment.services.stopping import evaluate_stop, resolve_policy
+from assessment.services.topic_index import build_question_topics
+
+User = get_user_model()
+
+
+class CatAnswerTestBase(TestCase):
+    """Phiên CAT nhỏ: 1 môn, 1 topic, 5 câu có IRT; mỗi test bắt đầu 1 phiên mới."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.student = User.objects.create(email="hs@example.com", full_name="Học sinh")
+        cls.subject = Subject.objects.create(name="Môn test")
+        cls.topic = Topic.objects.create(subject=cls.subject, name="Topic test")
+        for i in range(5):
+            q = Question.objects.create(subject=cls.subject, stem=f"Câu {i}")
+            QuestionIRT.objects.create(question=q, a=1.2, b=-1.0 + 0.5 * i, c=0.2)
+            QuestionTag.objects.create(question=q, topic=cls.topic)
+            for label, correct in (("A", True), ("B", False)):
+                QuestionOption.objects.create(question=q, label=label, content=label, is_correct=correct)
+
+    def setUp(self):
+        # Version counter, trạng thái phiên, marker idempotency đều nằm trong cache
+        cache.clear()
+        self.client = APIClient()
+        r = self.client.post(
+            "/api/cat/start/",
+            {"student_id": self.student.id, "subject_id": self.subject.id, "target_items": 5},
+            format="json",
+        )
+        self.assertEqual(r.status_code, 201)
+        self.session_id = r.json()["session_id"]
+        self.question = r.json()["next_question"]
+
+    def answer_body(self, question=None, correct=True):
+        question = question or self.question
+        option = next(o for o in question["options"] if (o["label"] == "A") == correct)
+        return {"session_id": self.session_id, "question_id": question["id"], "option_id": option["id"]}
+
+    def post_answer(self, body, key=None):
+        headers = {"HTTP_IDEMPOTENCY_KEY": key} if key else {}
+        return self.client.post("/api/cat/answer/", body, format="json", **headers)
+
+    def responses(self):
+        return TestResponse.objects.filter(session_id=self.session_id).count()
+
+
+class CatAnswerIdempotencyTests(CatAnswerTestBase):
+    def test_replay_returns_stored_result(self):
+        body = self.answer_body()
+        first = self.post_answer(body, key="k1")
+        self.assertEqual(first.status_code, 200)
+
+        with self.assertNumQueries(0):
+            again = self.post_answer(body, key="k1")
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again["Idempotent-Replayed"], "true")
+        self.assertEqual(again.json(), first.json())
+        self.assertEqual(self.responses(), 1)
+
+    def test_replay_without_key_uses_session_and_question(self):
+        body = self.answer_body()
+        self.assertEqual(self.post_answer(body).status_code, 200)
+        again = self.post_answer(body)
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again["Idempotent-Replayed"], "true")
+        self.assertEqual(self.responses(), 1)
+
+    def test_concurrent_duplicate_gets_409(self):
+        body = self.answer_body()
+        # Request đầu đang chạy: marker "pending" đã được đặt
+        key = step_key(self.session_id, "k1", body["question_id"])
+        begin_step(key, (body["question_id"], body["option_id"]))
+
+        r = self.post_answer(body, key="k1")
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(self.responses(), 0)
+
+    def test_reused_key_with_different_option_gets_409(self):
+        self.assertEqual(self.post_answer(self.answer_body(correct=True), key="k1").status_code, 200)
+
+        r = self.post_answer(self.answer_body(correct=False), key="k1")
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(self.responses(), 1)
+
+    def test_failed_step_drops_marker(self):
+        body = self.answer_body()
+        key = step_key(self.session_id, "k1", body["question_id"])
+
+        with mock.patch.object(views, "commit_answer_step", side_effect=RuntimeError("db down")):
+            with self.assertRaises(RuntimeError):
+                self.post_answer(body, key="k1")
+        self.assertIsNone(cache.get(key))
+
+        # Client thử lại cùng khoá -> chạy lại bình thường
+        r = self.post_answer(body, key="k1")
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn("Idempotent-Replayed", r)
+        self.assertEqual(self.responses(), 1)
+
+    def test_error_response_drops_marker(self):
+        body = {**self.answer_body(), "option_id": 0}
+        self.assertEqual(self.post_answer(body, key="k1").status_code, 404)
+        self.assertIsNone(cache.get(step_key(self.session_id, "k1", body["question_id"])))
+
+
+class CatAnswerConcurrencyTests(CatAnswerTestBase):
+    def test_cas_conflict_is_retried(self):
+        real_commit = views.commit_answer_step
+        calls = []
+
+        def lose_first_cas(session, step):
+            # Lần đầu coi như request khác đã ghi trước (CAS trượt, không ghi gì)
+            calls.append(session.version)
+            return len(calls) > 1 and real_commit(session, step)
+
+        with mock.patch.object(views, "commit_answer_step", side_effect=lose_first_cas) as commit:
+            r = self.post_answer(self.answer_body())
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(commit.call_count, 2)
+        self.assertEqual(self.responses(), 1)
+        self.assertEqual(TestSession.objects.get(id=self.session_id).version, 1)
+
+    def test_cas_conflict_exhausting_retries_gets_409(self):
+        with mock.patch.object(views, "commit_answer_step", return_value=False) as commit:
+            r = self.post_answer(self.answer_body())
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(commit.call_count, views.answer_retries() + 1)
+        self.assertEqual(self.responses(), 0)
+
+    def test_duplicate_committed_first_gets_409(self):
+        """Request trùng (khoá khác, không bị cache chặn) ghi trước trong lúc request đầu đang tính."""
+        body = self.answer_body()
+        real_compute = views.compute_answer_step
+        raced, inner = [], []
+
+        def compute_then_race(*args, **kwargs):
+            if not raced:
+                raced.append(True)
+                inner.append(self.post_answer(body, key="k2"))
+            return real_compute(*args, **kwargs)
+
+        with mock.patch.object(views, "compute_answer_step", side_effect=compute_then_race):
+            outer = self.post_answer(body, key="k1")
+
+        self.assertEqual(inner[0].status_code, 200)
+        self.assertEqual(outer.status_code, 409)
+        self.assertEqual(self.responses(), 1)
+        self.assertEqual(TestSession.objects.get(id=self.session_id).version, 1)
+
+    def test_answered_question_with_new_key_gets_409(self):
+        body = self.answer_body()
+        self.assertEqual(self.post_answer(body, key="k1").status_code, 200)
+
+        r = self.post_answer(body, key="k2")
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(self.responses(), 1)
+
+    def test_unserved_question_gets_409(self):
+        other = Question.objects.filter(subject=self.subject).exclude(id=self.question["id"]).first()
+        body = {
+            "session_id": self.session_id,
+            "question_id": other.id,
+            "option_id": other.options.first().id,
+        }
+        r = self.post_answer(body)
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(self.responses(), 0)
+
+
+class CatAnswerBatchTests(CatAnswerTestBase):
+    def post_batch(self, *bodies):
+        answers = [{"question_id": b["question_id"], "option_id": b["option_id"]} for b in bodies]
+        return self.client.post(
+            "/api/cat/answer-batch/", {"session_id": self.session_id, "answers": answers}, format="json",
+        )
+
+    def test_current_position_matches_between_new_and_replayed_batch(self):
+        first = self.answer_body()
+        applied = self.post_batch(first)
+        self.assertEqual(applied.status_code, 200)
+        self.assertEqual(applied.json()["current_position"], 1)
+
+        # Gửi lại: câu đã ghi bị bỏ qua, trả về cùng vị trí + câu đang chờ
+        replayed = self.post_batch(first)
+        self.assertEqual(replayed.status_code, 200)
+        self.assertEqual(replayed.json()["skipped_question_ids"], [first["question_id"]])
+        self.assertEqual(replayed.json()["current_position"], 1)
+        self.assertEqual(replayed.json()["next_question"], applied.json()["next_question"])
+
+        # Lô gồm câu cũ + câu đang chờ: ghi 1 đáp án, vị trí như /answer/
+        second = self.answer_body(question=applied.json()["next_question"])
+        r = self.post_batch(first, second)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()["current_position"], 2)
+        self.assertEqual(self.responses(), 2)
+
+
+class CatExposureIndexTests(CatAnswerTestBase):
+    def test_new_session_sees_previous_answers(self):
+        self.assertEqual(recent_exposures(self.student.id, self.subject.id, 7), set())  # nạp chỉ mục
+        answered = self.question["id"]
+        self.assertEqual(self.post_answer(self.answer_body()).status_code, 200)
+
+        r = self.client.post("/api/cat/start/", {
+            "student_id": self.student.id, "subject_id": self.subject.id, "target_items": 5,
+        }, format="json")
+        self.assertEqual(r.status_code, 201)
+        # Phiên mới: chỉ mục nạp lại từ SQL 1 lần, các bước sau đọc từ cache
+        self.assertEqual(recent_exposures(self.student.id, self.subject.id, 7), {answered})
+        with self.assertNumQueries(0):
+            self.assertEqual(recent_exposures(self.student.id, self.subject.id, 7), {answered})
+
+
+class CatAbilityDriftTests(CatAnswerTestBase):
+    def setUp(self):
+        super().setUp()
+        # Học sinh cũ: posterior đã hẹp sau nhiều phiên
+        self.profile = StudentAbilityProfile.objects.create(
+            student=self.student, topic=self.topic, theta=0.5, se=0.2,
+            log_posterior=eap_log_prior(0.5, 0.2).tolist(), n_responses=40,
+        )
+
+    def start(self):
+        r = self.client.post("/api/cat/start/", {
+            "student_id": self.student.id, "subject_id": self.subject.id, "target_items": 5,
+        }, format="json")
+        self.assertEqual(r.status_code, 201)
+        self.session_id, self.question = r.json()["session_id"], r.json()["next_question"]
+
+    def test_start_without_answer_keeps_profile(self):
+        for _ in range(3):
+            self.start()
+        self.profile.refresh_from_db()
+        self.assertEqual((self.profile.se, self.profile.n_responses), (0.2, 40))
+
+    def test_first_answer_widens_posterior_once(self):
+        self.start()
+        without_drift = StudentAbilityProfile.objects.get(id=self.profile.id)
+        irt = QuestionIRT.objects.get(question_id=self.question["id"])
+        apply_response(without_drift, irt.a, irt.b, irt.c, 1)
+
+        self.assertEqual(self.post_answer(self.answer_body()).status_code, 200)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.n_responses, 41)
+        self.assertGreater(self.profile.se, without_drift.se + 0.05)
+
+        # Câu thứ 2: không nới thêm, chỉ cộng phản hồi
+        expected = StudentAbilityProfile.objects.get(id=self.profile.id)
+        question = TestSession.objects.get(id=self.session_id).items.order_by("-position").first().question
+        irt = question.irt
+        apply_response(expected, irt.a, irt.b, irt.c, 1)
+        option = question.options.get(label="A")
+        self.assertEqual(self.post_answer({
+            "session_id": self.session_id, "question_id": question.id, "option_id": option.id,
+        }).status_code, 200)
+        self.profile.refresh_from_db()
+        self.assertAlmostEqual(self.profile.se, expected.se, places=4)
+
+
+class QuestionTopicsBuildTests(TestCase):
+    def test_single_query_keeps_untagged_questions(self):
+        subject = Subject.objects.create(name="Môn CSR")
+        t1, t2 = (Topic.objects.create(subject=subject, name=n) for n in ("T1", "T2"))
+        both, untagged = (Question.objects.create(subject=subject, stem=s) for s in ("2 topic", "0 topic"))
+        QuestionTag.objects.create(question=both, topic=t1)
+        QuestionTag.objects.create(question=both, topic=t2)
+
+        with self.assertNumQueries(1):
+            csr = build_question_topics(subject.id)
+        self.assertEqual(csr.question_ids.tolist(), [both.id, untagged.id])
+        self.assertEqual(sorted(csr.topics_of(both.id)), [t1.id, t2.id])
+        self.assertEqual(csr.topics_of(untagged.id), [])
+        self.assertEqual(csr.untagged_rows().tolist(), [1])
+
+
+@override_settings(TOPIC_MASTERY_DECAY=0.5)
+class RecordMasteryTests(TestCase):
+    def setUp(self):
+        self.student = User.objects.create(email="mastery@example.com", full_name="Học sinh")
+        subject = Subject.objects.create(name="Môn mastery")
+        self.topic = Topic.objects.create(subject=subject, name="Topic")
+
+    def counters(self):
+        m = TopicMastery.objects.get(student=self.student, topic=self.topic)
+        return m.correct_weight, m.total_weight, m.n_responses
+
+    def test_stale_existing_does_not_drop_response(self):
+        # Request khác đã tạo bản ghi sau khi trạng thái phiên được đọc
+        record_mastery(self.student.id, [self.topic.id], 1, existing=[])
+        record_mastery(self.student.id, [self.topic.id], 0, existing=[])
+        self.assertEqual(self.counters(), (0.5, 1.5, 2))
+
+    def test_existing_without_row_creates_it(self):
+        record_mastery(self.student.id, [self.topic.id], 1, existing=[self.topic.id])
+        self.assertEqual(self.counters(), (1.0, 1.0, 1))
+
+
+class OnlineCalibratorFlushTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        subject = Subject.objects.create(name="Môn calib")
+        self.q = Question.objects.create(subject=subject, stem="Câu")
+        QuestionIRT.objects.create(question=self.q, a=1.0, b=0.0, c=0.2)
+
+    def test_concurrent_flushes_add_up(self):
+        # 2 process cùng ghi nhận phản hồi trên giá trị cũ rồi flush: không mất delta nào
+        first, second = OnlineCalibrator(lr_a=0.05), OnlineCalibrator(lr_a=0.05)
+        first.record(self.q.id, 1.0, 0.0, 0.2, theta=2.0, y=0)
+        second.record(self.q.id, 1.0, 0.0, 0.2, theta=2.0, y=0)
+        (d_a1, d_b1), (d_a2, d_b2) = first._pending[self.q.id], second._pending[self.q.id]
+        with CaptureQueriesContext(connection) as ctx:
+            first.flush()
+        second.flush()
+
+        # Delta cộng trong câu UPDATE, không đọc QuestionIRT rồi ghi đè giá trị tuyệt đối
+        irt_reads = [q["sql"] for q in ctx.captured_queries
+                     if q["sql"].startswith("SELECT") and "assessment_questionirt" in q["sql"]]
+        self.assertEqual(irt_reads, [])
+
+        irt = QuestionIRT.objects.get(question=self.q)
+        self.assertAlmostEqual(irt.b, d_b1 + d_b2)
+        self.assertAlmostEqual(irt.a, 1.0 + d_a1 + d_a2)
+
+    def test_flush_clamps_and_keeps_missing_params(self):
+        QuestionIRT.objects.filter(question=self.q).update(a=None, b=3.99)
+        calibrator = OnlineCalibrator(lr_a=0.05, max_step=0.5)
+        calibrator._pending = {self.q.id: [0.3, 0.5]}
+        calibrator.flush()
+
+        irt = QuestionIRT.objects.get(question=self.q)
+        self.assertIsNone(irt.a)
+        self.assertAlmostEqual(irt.b, PARAM_MAX[1])
+
+
+@override_settings(CAT_SPECULATIVE_PREFETCH=False)  # on_commit chạy thật: không cho thread prefetch chạy nền
+class CatStoppingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.student = User.objects.create(email="stop@example.com", full_name="Học sinh")
+        self.subject = Subject.objects.create(name="Môn chưa calibrate")
+        topic = Topic.objects.create(subject=self.subject, name="Topic")
+        # Câu chưa có IRT: không cập nhật posterior -> không có Δθ
+        for i in range(5):
+            q = Question.objects.create(subject=self.subject, stem=f"Câu {i}")
+            QuestionTag.objects.create(question=q, topic=topic)
+            QuestionOption.objects.create(question=q, label="A", content="A", is_correct=True)
+
+    def test_uncalibrated_items_do_not_count_as_stable(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            r = self.client.post("/api/cat/start/", {
+                "student_id": self.student.id, "subject_id": self.subject.id, "target_items": 5,
+                "stopping_policy": {"min_items": 1, "se_threshold": None, "min_delta_theta": 0.05},
+            }, format="json")
+        session_id, question = r.json()["session_id"], r.json()["next_question"]
+
+        reasons = []
+        while question:
+            # Trạng thái phiên (bộ đếm stable_steps) ghi vào cache khi transaction commit
+            with self.captureOnCommitCallbacks(execute=True):
+                r = self.client.post("/api/cat/answer/", {
+                    "session_id": session_id,
+                    "question_id": question["id"],
+                    "option_id": question["options"][0]["id"],
+                }, format="json")
+            self.assertEqual(r.status_code, 200)
+            reasons.append(r.json()["stop_reason"])
+            question = r.json()["next_question"]
+
+        self.assertEqual(reasons, [None, None, None, None, "max_items"])
+
+    def test_step_without_update_keeps_stable_counter(self):
+        policy = resolve_policy({"min_items": 1, "se_threshold": None, "min_delta_theta": 0.05, "delta_window": 2})
+        kwargs = dict(n_items=3, target_items=10, thetas={1: 0.5}, ses={1: 0.6}, answered_topic_ids=[1])
+
+        no_update = evaluate_stop(policy, prior_thetas={}, stable_steps=1, **kwargs)
+        self.assertFalse(no_update.stop)
+        self.assertEqual(no_update.stable_steps, 1)
+
+        small_update = evaluate_stop(policy, prior_thetas={1: 0.49}, stable_steps=1, **kwargs)
+        self.assertEqual((small_update.stop, small_update.reason), (True, "delta_theta"))
+
+
+class AsyncCatViewTests(CatAnswerTestBase):
+    async def test_invalid_token_gets_401_like_sync_view(self):
+        body = self.answer_body()
+        auth = {"Authorization": "Bearer khong-hop-le"}
+        sync = await sync_to_async(self.client.post)("/api/cat/answer/", body, format="json", headers=auth)
+        r = await self.async_client.post(
+            "/api/cat/async/answer/", body, content_type="application/json", headers=auth,
+        )
+        self.assertEqual((r.status_code, sync.status_code), (401, 401))
+        self.assertEqual(r["WWW-Authenticate"], sync["WWW-Authenticate"])
+        self.assertEqual(r.json()["code"], sync.json()["code"])
+
+    async def test_missing_session_gets_json_404(self):
+        await TestSession.objects.filter(id=self.session_id).aupdate(status="FINISHED")
+        r = await self.async_client.post(
+            "/api/cat/async/answer/", self.answer_body(), content_type="application/json",
+        )
+        self.assertEqual(r.status_code, 404)
+        self.assertIn("detail", r.json())
+
+    async def test_wrong_option_gets_json_404(self):
+        body = {**self.answer_body(), "option_id": 0}
+        r = await self.async_client.post("/api/cat/async/answer/", body, content_type="application/json")
+        self.assertEqual(r.status_code, 404)
+        self.assertIn("detail", r.json())
+        self.assertEqual(await TestResponse.objects.filter(session_id=self.session_id).acount(), 0)
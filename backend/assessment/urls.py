@@ -1,6 +1,7 @@
 # assessment/urls.py
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from . import async_views
 from .views import (
     SubjectViewSet,
     QuestionViewSet,
@@ -43,5 +44,9 @@ urlpatterns = [
         name="candidate-question-reject",
     ),
 
+    # CAT bản async (deploy ASGI), cùng hợp đồng với cat/start/ và cat/answer/
+    path("cat/async/start/", async_views.cat_start, name="cat-async-start"),
+    path("cat/async/answer/", async_views.cat_answer, name="cat-async-answer"),
+
     path("", include(router.urls)),
 ]
@@ -388,31 +388,39 @@
 
 
 # assessment/views.py
-from django.utils import timezone
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.db import transaction
+from django.http import Http404
 from django.shortcuts import get_object_or_404
-from django.db.models import Avg, Q
 
 from .services.question_pipeline import generate_candidate_questions
 from .serializers import GenerateQuestionRequestSerializer
 
 from assessment.models import (
-    Subject, Question, QuestionOption, QuestionIRT,
-    TestSession, TestItem, TestResponse,
-    StudentAbilityProfile, Topic, QuestionTag
+    Subject, Question, QuestionIRT,
+    TestSession,
+    Topic, QuestionTag, Rule,
 )
 
 from .serializers import (
     SubjectSerializer, QuestionWriteSerializer, QuestionDetailSerializer,
-    QuestionIRTSerializer, StartCatSerializer, AnswerCatSerializer,
-    GenerateFixedTestSerializer, TopicSerializer,
+    QuestionIRTSerializer, StartCatSerializer, AnswerCatSerializer, AnswerCatBatchSerializer,
+    GenerateFixedTestSerializer, TopicSerializer, RulePreviewSerializer,
 )
 
-from assessment.services.irt import update_theta_newton
-from assessment.services.rules import evaluate_rules, select_next_item
+from assessment.services.cat_steps import (
+    answer_retries, commit_answer_step, commit_first_item, compute_answer_step,
+    compute_batch_step, load_answer_inputs, load_batch_inputs, pick_first_item,
+)
+from assessment.services.idempotency import (
+    IN_FLIGHT, MISMATCH, REPLAY, begin_step, finish_step, step_key,
+)
+from assessment.services.question_cache import get_question_payload, get_question_payloads
+from assessment.services.rules import compile_preview_rules, evaluate_rules_batch
+from assessment.services.sampling import question_id_pool, sample_ids
+from assessment.services.session_state import build_state
 
 
 # === CRUD cơ bản ===
@@ -495,25 +503,40 @@ class QuestionViewSet(viewsets.ModelViewSet):
 
 
 # === CAT ===
+def _request_id(request, d):
+    return request.headers.get("Idempotency-Key") or d.get("request_id")
+
+
+def _idempotent(key, fingerprint, run):
+    """Chạy bước qua cache idempotency (services/idempotency.py); chỉ lưu kết quả 200."""
+    outcome, stored = begin_step(key, fingerprint)
+    if outcome == REPLAY:
+        return Response(stored, headers={"Idempotent-Replayed": "true"})
+    if outcome == IN_FLIGHT:
+        return Response(
+            {"error": "Yêu cầu này đang được xử lý, vui lòng chờ kết quả."},
+            status=status.HTTP_409_CONFLICT,
+        )
+    if outcome == MISMATCH:
+        return Response(
+            {"error": "Khoá idempotency đã được dùng cho một đáp án khác."},
+            status=status.HTTP_409_CONFLICT,
+        )
+
+    response = None
+    try:
+        response = run()
+    finally:
+        ok = response is not None and response.status_code == status.HTTP_200_OK
+        finish_step(key, fingerprint, response.data if ok else None)
+    return response
+
+
 class CATViewSet(viewsets.ViewSet):
     """
     ViewSet cho bài kiểm tra thích ứng (CAT).
     """
 
-    def _get_student_abilities(self, student_id, subject_id):
-        """
-        Lấy vector năng lực theo topic:
-          ability_vector = {topic_id: theta}
-          avg_theta      = trung bình, dùng fallback nếu câu không gắn topic.
-        """
-        profiles = StudentAbilityProfile.objects.filter(
-            student_id=student_id,
-            topic__subject_id=subject_id,
-        )
-        ability_vector = {p.topic_id: p.theta for p in profiles}
-        avg_theta = profiles.aggregate(Avg("theta"))["theta__avg"] or 0.0
-        return ability_vector, avg_theta
-
     @action(detail=False, methods=["post"], url_path="start")
     @transaction.atomic
     def start_session(self, request):
@@ -544,45 +567,26 @@ class CATViewSet(viewsets.ViewSet):
             target_items=target_items,
             mode="CAT",
             status="ONGOING",
+            stopping_policy=data["stopping_policy"],  # đã gộp với của môn + kiểm tra
         )
 
-        # Lấy năng lực hiện tại (nếu có)
-        ability_vector, avg_theta = self._get_student_abilities(student_id, subject_id)
-
-        # Context rule chung (mastery, cooldown, …)
-        rule_ctx = evaluate_rules(
-            student_id=student_id,
-            subject_id=subject_id,
-            ability_vector=ability_vector,
-        )
+        # Trạng thái phiên (năng lực, mastery hiện tại) -> giữ trong cache suốt phiên
+        state = build_state(session, used_ids=[])
+        ability_vector = state.abilities
 
-        # Nếu có topic được chọn -> truyền vào select_next_item
-        topic_ids = [topic_obj.id] if topic_obj is not None else None
-
-        next_q = select_next_item(
-            ability_vector=ability_vector,
-            avg_theta=avg_theta,
-            subject_id=session.subject_id,
-            used_q_ids=set(),
-            rule_ctx=rule_ctx,
-            position_in_session=1,
-            topic_ids=topic_ids,  # lock theo topic nếu có
-        )
-
-        if next_q is None:
+        next_qid, next_q_data = pick_first_item(session, state)
+        if next_qid is None:
             return Response(
                 {"error": "Không tìm thấy câu hỏi nào cho môn học này."},
                 status=status.HTTP_404_NOT_FOUND,
             )
-
-        TestItem.objects.create(session=session, question=next_q, position=1)
-        q_serializer = QuestionDetailSerializer(next_q)
+        commit_first_item(session, state, next_qid)
 
         return Response(
             {
                 "session_id": str(session.id),
                 "ability_vector": ability_vector,
-                "next_question": q_serializer.data,
+                "next_question": next_q_data,
                 "stop": False,
                 "current_position": 1,
                 "target_items": session.target_items,
@@ -591,123 +595,137 @@ class CATViewSet(viewsets.ViewSet):
         )
 
     @action(detail=False, methods=["post"], url_path="answer")
-    @transaction.atomic
     def post_answer(self, request):
         """
         Nhận đáp án:
         - Cập nhật năng lực IRT theo các topic của câu hỏi vừa làm
         - Quyết định dừng / tiếp tục
         - Nếu tiếp tục: chọn câu tiếp theo (giữ nguyên topic nếu phiên đó có topic).
+
+        Optimistic concurrency: tính toán ngoài transaction, cuối cùng ghi bước
+        bằng compare-and-swap trên TestSession.version. Bị request khác ghi trước
+        -> tính lại trên trạng thái mới; câu không phải câu đang chờ trả lời
+        (đã trả lời / chưa phát) -> 409.
+
+        Idempotent: khoá theo header Idempotency-Key / request_id, mặc định theo
+        (session, question). Gửi lại -> trả kết quả đã lưu, không chạm DB;
+        request giống hệt đang chạy -> 409 ngay.
         """
         ser = AnswerCatSerializer(data=request.data)
         ser.is_valid(raise_exception=True)
         d = ser.validated_data
 
-        session = get_object_or_404(
-            TestSession.objects.select_for_update(),
-            id=d["session_id"],
-            status="ONGOING",
-        )
-        q = get_object_or_404(Question.objects.select_related("irt"), id=d["question_id"])
-        opt = get_object_or_404(QuestionOption, id=d["option_id"], question=q)
+        key = step_key(d["session_id"], _request_id(request, d), d["question_id"])
+        return _idempotent(key, (d["question_id"], d["option_id"]), lambda: self._answer(d))
+
+    def _answer(self, d):
+        for attempt in range(answer_retries() + 1):
+            session = TestSession.objects.filter(id=d["session_id"], status="ONGOING").first()
+            if session is None:
+                if attempt == 0:
+                    raise Http404("Không tìm thấy phiên đang làm.")
+                return Response(
+                    {"error": "Phiên đã kết thúc bởi một yêu cầu khác."},
+                    status=status.HTTP_409_CONFLICT,
+                )
 
-        is_correct = bool(opt.is_correct)
+            state, opt, profiles = load_answer_inputs(session, d)
+            step = compute_answer_step(session, d, state, opt, profiles)
+            if step is None:
+                return Response(
+                    {"error": "Câu hỏi này không phải câu đang chờ trả lời (đã trả lời hoặc chưa được phát)."},
+                    status=status.HTTP_409_CONFLICT,
+                )
+            if commit_answer_step(session, step):
+                return Response(step["payload"])
 
-        TestResponse.objects.create(
-            session=session,
-            question=q,
-            option=opt,
-            is_correct=is_correct,
-            latency_ms=d.get("latency_ms"),
+        return Response(
+            {"error": "Phiên đang được cập nhật đồng thời, vui lòng thử lại."},
+            status=status.HTTP_409_CONFLICT,
         )
 
-        # Các topic của câu hỏi
-        question_topics = Topic.objects.filter(
-            questiontag__question_id=q.id
-        ).distinct()
-
-        # Cập nhật IRT cho từng topic
-        total_se = 0.0
-        for topic in question_topics:
-            profile, _ = StudentAbilityProfile.objects.get_or_create(
-                student=session.student,
-                topic=topic,
-                defaults={"theta": 0.0, "se": 1.0},
-            )
-            theta_prior = profile.theta
-            try:
-                irt = q.irt  # có thể không tồn tại
-                resp_simple = [
-                    {"a": irt.a, "b": irt.b, "c": irt.c, "y": 1 if is_correct else 0}
-                ]
-                new_theta, new_se = update_theta_newton(theta_prior, resp_simple)
-            except QuestionIRT.DoesNotExist:
-                new_theta, new_se = theta_prior, profile.se
-
-            profile.theta = new_theta
-            profile.se = new_se
-            profile.save(update_fields=["theta", "se", "updated_at"])
-            total_se += new_se
-
-        # Lấy lại full ability vector sau khi update
-        full_ability_vector, avg_theta = self._get_student_abilities(
-            session.student_id,
-            session.subject_id,
-        )
+    @action(detail=False, methods=["post"], url_path="answer-batch")
+    def post_answer_batch(self, request):
+        """
+        Nộp lại lịch sử đáp án của phiên (client mất kết nối, không biết request
+        nào đã tới server) - tiện ích bọc quanh /answer/.
 
-        item_count = session.items.count()
-        avg_se = total_se / (question_topics.count() or 1)
-        stop = (avg_se < 0.3) or (item_count >= session.target_items)
+        Câu kế tiếp chỉ được chọn sau khi có đáp án câu trước, nên mỗi lúc phiên
+        chỉ có 1 câu đang chờ: trong lô, mọi câu khác phải là câu đã ghi nhận
+        (được bỏ qua, gửi lại an toàn), tức 1 lô ghi thêm tối đa 1 đáp án. Trả về
+        trạng thái cuối + câu kế tiếp như /answer/.
 
-        next_q_data = None
-        if not stop:
-            rule_ctx = evaluate_rules(
-                student_id=session.student_id,
-                subject_id=session.subject_id,
-                ability_vector=full_ability_vector,
-            )
-            used_ids = set(session.items.values_list("question_id", flat=True))
-
-            # Lấy topic cố định của phiên (nếu có)
-            session_topic_id = getattr(session, "topic_id", None)
-            topic_ids = [session_topic_id] if session_topic_id is not None else None
-
-            next_q = select_next_item(
-                ability_vector=full_ability_vector,
-                avg_theta=avg_theta,
-                subject_id=session.subject_id,
-                used_q_ids=used_ids,
-                rule_ctx=rule_ctx,
-                position_in_session=item_count + 1,
-                topic_ids=topic_ids,
-            )
+        Có Idempotency-Key / request_id thì gửi lại trả kết quả đã lưu như /answer/.
+        """
+        ser = AnswerCatBatchSerializer(data=request.data)
+        ser.is_valid(raise_exception=True)
+        d = ser.validated_data
 
-            if next_q:
-                TestItem.objects.create(
-                    session=session,
-                    question=next_q,
-                    position=item_count + 1,
+        request_id = _request_id(request, d)
+        if not request_id:
+            # Không có khoá: câu đã ghi được bỏ qua sẵn nên gửi lại vẫn an toàn
+            return self._answer_batch(d)
+        fingerprint = tuple((a["question_id"], a["option_id"]) for a in d["answers"])
+        key = step_key(d["session_id"], request_id)
+        return _idempotent(key, fingerprint, lambda: self._answer_batch(d))
+
+    def _answer_batch(self, d):
+        for attempt in range(answer_retries() + 1):
+            session = TestSession.objects.filter(id=d["session_id"], status="ONGOING").first()
+            if session is None:
+                if attempt == 0:
+                    raise Http404("Không tìm thấy phiên đang làm.")
+                return Response(
+                    {"error": "Phiên đã kết thúc bởi một yêu cầu khác."},
+                    status=status.HTTP_409_CONFLICT,
                 )
-                next_q_data = QuestionDetailSerializer(next_q).data
-            else:
-                stop = True
 
-        if stop:
-            session.status = "FINISHED"
-            session.finished_at = timezone.now()
-            session.save(update_fields=["status", "finished_at"])
+            state, options, profiles, answered = load_batch_inputs(session, d["answers"])
+            step = compute_batch_step(session, d["answers"], state, options, profiles, answered)
+            if step is None:
+                # Mọi câu trong lô đã được ghi -> trả lại câu đang chờ trả lời.
+                # current_position như /answer/: số câu đã trả lời của phiên
+                current = state.current_question_id
+                return Response({
+                    "results": [],
+                    "skipped_question_ids": [a["question_id"] for a in d["answers"]],
+                    "ability_vector": state.abilities,
+                    "next_question": get_question_payload(current) if current is not None else None,
+                    "stop": False,
+                    "current_position": len(answered),
+                    "target_items": session.target_items,
+                    "stop_reason": None,
+                    "classification": None,
+                })
+            if commit_answer_step(session, step):
+                return Response(step["payload"])
 
         return Response(
-            {
-                "is_correct": is_correct,
-                "ability_vector": full_ability_vector,
-                "next_question": next_q_data,
-                "stop": stop,
-                "current_position": item_count,
-                "target_items": session.target_items,
-            }
+            {"error": "Phiên đang được cập nhật đồng thời, vui lòng thử lại."},
+            status=status.HTTP_409_CONFLICT,
         )
 
+    @action(detail=False, methods=["post"], url_path="rules-preview")
+    def rules_preview(self, request):
+        """
+        Xem trước luật cho cả lớp: context của từng học sinh + thống kê gộp.
+        Có thể thêm luật nháp (chưa lưu) để so sánh trước khi bật.
+        """
+        ser = RulePreviewSerializer(data=request.data)
+        ser.is_valid(raise_exception=True)
+        d = ser.validated_data
+
+        drafts = [Rule(**r) for r in d["rules"]]
+        if drafts or not d["include_active"]:
+            compiled = compile_preview_rules(d["subject_id"], drafts, d["include_active"])
+        else:
+            compiled = None
+
+        result = evaluate_rules_batch(d["student_ids"], d["subject_id"], compiled)
+        if not d["include_contexts"]:
+            result.pop("contexts")
+        return Response(result)
+
 
 # === Fixed test (demo) ===
 class FixedTestViewSet(viewsets.ViewSet):
@@ -717,13 +735,11 @@ class FixedTestViewSet(viewsets.ViewSet):
         ser.is_valid(raise_exception=True)
         d = ser.validated_data
 
-        query = Q(subject_id=d["subject_id"])
-        if "difficulty_tag" in d:
-            query &= Q(difficulty_tag=d["difficulty_tag"])
-
-        questions = Question.objects.filter(query).order_by("?")[: d["num_questions"]]
-        q_serializer = QuestionDetailSerializer(questions, many=True)
-        return Response({"questions": q_serializer.data}, status=status.HTTP_200_OK)
+        # Bốc ngẫu nhiên từ mảng id cache sẵn (thay order_by("?")); payload từng câu
+        # lấy từ cache đã serialize, chỉ câu chưa có trong cache mới query + serialize
+        pool = question_id_pool(d["subject_id"], difficulty_tag=d.get("difficulty_tag"))
+        questions = get_question_payloads(sample_ids(pool, d["num_questions"]))
+        return Response({"questions": questions}, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=["post"], url_path="submit")
     def submit_fixed_test(self, request):
@@ -46,6 +46,9 @@ CORS_ALLOWED_ORIGINS = [
 ]
 # Nếu dùng cookie/session:
 CORS_ALLOW_CREDENTIALS = True
+# Header chống gửi trùng đáp án CAT (assessment/services/idempotency.py)
+from corsheaders.defaults import default_headers
+CORS_ALLOW_HEADERS = (*default_headers, "idempotency-key")
 CSRF_TRUSTED_ORIGINS = ["http://localhost:5173", "http://127.0.0.1:5173"]
 # Application definition
 
@@ -142,6 +145,26 @@ DATABASES = {
     }
 }
 
+# Cache
+# Version counter (services/versioning.py), idempotency, exposure, trạng thái
+# phiên CAT đều nằm trong cache -> chạy nhiều worker / process (gunicorn,
+# uvicorn, lệnh calibrate_irt) phải dùng cache chung: đặt REDIS_URL.
+# Không đặt -> LocMemCache, chỉ đúng khi chạy 1 process (dev).
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
 WSGI_APPLICATION = "my_app.wsgi.application"
 
 